@@ -0,0 +1,91 @@
+from typing import Dict
+
+import numpy as np
+import supervisely as sly
+
+GEOMETRIES = {
+    "rectangle": sly.Rectangle,
+    "polygon": sly.Polygon,
+    "bitmap": sly.Bitmap,
+}
+
+CONFIDENCE_TAG = "confidence"
+
+
+def make_model_meta(geometry: str, classes_count: int = 10) -> sly.ProjectMeta:
+    """Returns a model meta with classes of the geometry type and the confidence tag."""
+    obj_classes = [
+        sly.ObjClass(f"model_class_{i}", GEOMETRIES[geometry]) for i in range(classes_count)
+    ]
+    tag_metas = [sly.TagMeta(CONFIDENCE_TAG, sly.TagValueType.ANY_NUMBER)]
+    return sly.ProjectMeta(obj_classes=obj_classes, tag_metas=tag_metas)
+
+
+def make_project_meta(classes_count: int) -> sly.ProjectMeta:
+    """Returns a project meta of the given size, its classes don't intersect with the model classes."""
+    geometry_types = list(GEOMETRIES.values())
+    obj_classes = [
+        sly.ObjClass(f"project_class_{i}", geometry_types[i % len(geometry_types)])
+        for i in range(classes_count)
+    ]
+    return sly.ProjectMeta(obj_classes=obj_classes)
+
+
+def make_geometry(
+    geometry: str, rng: np.random.Generator, height: int, width: int
+) -> sly.geometry.geometry.Geometry:
+    box_height = int(rng.integers(20, max(21, height // 4)))
+    box_width = int(rng.integers(20, max(21, width // 4)))
+    top = int(rng.integers(0, height - box_height))
+    left = int(rng.integers(0, width - box_width))
+    if geometry == "rectangle":
+        return sly.Rectangle(top, left, top + box_height - 1, left + box_width - 1)
+
+    # Polygons and masks are ellipses inscribed in the box.
+    center_row, center_col = top + box_height / 2, left + box_width / 2
+    if geometry == "polygon":
+        angles = np.linspace(0, 2 * np.pi, 32, endpoint=False)
+        rows = center_row + (box_height / 2 - 1) * np.sin(angles)
+        cols = center_col + (box_width / 2 - 1) * np.cos(angles)
+        exterior = [sly.PointLocation(int(r), int(c)) for r, c in zip(rows, cols)]
+        return sly.Polygon(exterior)
+    rows, cols = np.ogrid[:box_height, :box_width]
+    mask = ((rows - box_height / 2) / (box_height / 2)) ** 2 + (
+        (cols - box_width / 2) / (box_width / 2)
+    ) ** 2 <= 1
+    return sly.Bitmap(mask, origin=sly.PointLocation(top, left))
+
+
+def make_prediction(
+    model_meta: sly.ProjectMeta,
+    geometry: str,
+    labels_count: int,
+    height: int = 1080,
+    width: int = 1920,
+    seed: int = 0,
+) -> Dict:
+    """Returns a frame prediction JSON with random labels of the model classes.
+
+    :param model_meta: Meta of the model, see `make_model_meta`.
+    :type model_meta: sly.ProjectMeta
+    :param geometry: Geometry type of the labels: rectangle, polygon or bitmap.
+    :type geometry: str
+    :param labels_count: Number of labels.
+    :type labels_count: int
+    :return: Annotation JSON.
+    :rtype: Dict
+    """
+    rng = np.random.default_rng(seed)
+    obj_classes = list(model_meta.obj_classes)
+    confidence = model_meta.get_tag_meta(CONFIDENCE_TAG)
+    labels = []
+    for i in range(labels_count):
+        tag = sly.Tag(confidence, value=round(float(rng.uniform(0.3, 1.0)), 4))
+        labels.append(
+            sly.Label(
+                make_geometry(geometry, rng, height, width),
+                obj_classes[i % len(obj_classes)],
+                tags=sly.TagCollection([tag]),
+            )
+        )
+    return sly.Annotation((height, width), labels=labels).to_json()
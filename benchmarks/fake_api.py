@@ -0,0 +1,214 @@
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional
+
+import supervisely as sly
+from supervisely.api.module_api import ApiField
+
+
+@dataclass
+class Latency:
+    """Simulated network latency of the fake endpoints.
+
+    :param default: Latency of every API call in seconds.
+    :type default: float
+    :param per_mb: Additional latency for each megabyte of the request payload.
+    :type per_mb: float
+    :param inference: Latency of the model for one frame in seconds.
+    :type inference: float
+    :param endpoints: Latency overrides for the specific endpoints, e.g. {"figures.bulk.add": 0.1}.
+    :type endpoints: Dict[str, float]
+    """
+
+    default: float = 0.0
+    per_mb: float = 0.0
+    inference: float = 0.0
+    endpoints: Dict[str, float] = field(default_factory=dict)
+
+    def get(self, endpoint: str, payload_bytes: int = 0) -> float:
+        latency = self.endpoints.get(endpoint, self.default)
+        return latency + self.per_mb * payload_bytes / (1024 * 1024)
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class FakeApi:
+    """Local stand-in for the endpoints of `sly.Api` used by the apply pipeline.
+    Keeps projects and created entities in memory, counts calls by endpoint
+    and sleeps for the configured latency on each call.
+
+    :param latency: Simulated latency.
+    :type latency: Latency, optional
+    """
+
+    def __init__(self, latency: Optional[Latency] = None):
+        self.latency = latency or Latency()
+        self.server_address = "http://localhost"
+        self.calls = Counter()
+        self.payload_bytes = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._metas: Dict[int, Dict] = {}
+        self._versions: Dict[int, int] = {}
+        self._videos: Dict[int, SimpleNamespace] = {}
+        self.figures: List[Dict] = []
+
+        self.video = SimpleNamespace(
+            get_info_by_id=self._get_video_info,
+            figure=SimpleNamespace(download=self._download_figures),
+        )
+        self.project = SimpleNamespace(
+            get_info_by_id=self._get_project_info,
+            get_meta=self._get_meta,
+            update_meta=self._update_meta,
+            pull_meta_ids=self._pull_meta_ids,
+        )
+        self.advanced = SimpleNamespace(add_tag_to_object=self._add_tag_to_object)
+
+    def add_project(self, project_id: int, meta: sly.ProjectMeta) -> None:
+        self._metas[project_id] = self._with_ids(meta.to_json())
+        self._versions[project_id] = 0
+
+    def add_video(
+        self, video_id: int, dataset_id: int, frames_count: int, height: int, width: int
+    ) -> None:
+        self._videos[video_id] = SimpleNamespace(
+            id=video_id,
+            dataset_id=dataset_id,
+            frames_count=frames_count,
+            frame_height=height,
+            frame_width=width,
+        )
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.payload_bytes = 0
+
+    def post(self, method: str, data: Dict) -> FakeResponse:
+        payload_bytes = len(json.dumps(data))
+        self._call(method, payload_bytes)
+        if method == "annotation-objects.bulk.add":
+            items = data[ApiField.ANNOTATION_OBJECTS]
+        elif method == "figures.bulk.add":
+            items = data[ApiField.FIGURES]
+            self.figures.extend(items)
+        elif method == "figures.tags.bulk.add":
+            items = data[ApiField.TAGS]
+        else:
+            raise NotImplementedError(f"Fake API doesn't implement {method}")
+        return FakeResponse([{ApiField.ID: self._next_id()} for _ in items])
+
+    def _call(self, endpoint: str, payload_bytes: int = 0) -> None:
+        with self._lock:
+            self.calls[endpoint] += 1
+            self.payload_bytes += payload_bytes
+        latency = self.latency.get(endpoint, payload_bytes)
+        if latency > 0:
+            time.sleep(latency)
+
+    def _next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def _with_ids(self, meta_json: Dict) -> Dict:
+        for item in meta_json.get("classes", []) + meta_json.get("tags", []):
+            if item.get(ApiField.ID) is None:
+                item[ApiField.ID] = self._next_id()
+        return meta_json
+
+    def _get_video_info(self, id: int) -> SimpleNamespace:
+        self._call("videos.info")
+        return self._videos[id]
+
+    def _download_figures(self, dataset_id: int, video_ids: List[int], **kwargs) -> Dict:
+        self._call("figures.list")
+        return {video_id: [] for video_id in video_ids}
+
+    def _get_project_info(self, id: int) -> SimpleNamespace:
+        self._call("projects.info")
+        return SimpleNamespace(id=id, updated_at=str(self._versions[id]))
+
+    def _get_meta(self, id: int) -> Dict:
+        self._call("projects.meta")
+        return json.loads(json.dumps(self._metas[id]))
+
+    def _update_meta(self, id: int, meta: Dict) -> None:
+        self._call("projects.meta.update", len(json.dumps(meta)))
+        self._metas[id] = self._with_ids(json.loads(json.dumps(meta)))
+        self._versions[id] += 1
+
+    def _pull_meta_ids(self, id: int, meta: sly.ProjectMeta) -> None:
+        server_meta = sly.ProjectMeta.from_json(self._get_meta(id))
+        meta.obj_classes.refresh_ids_from(server_meta.obj_classes)
+        meta.tag_metas.refresh_ids_from(server_meta.tag_metas)
+
+    def _add_tag_to_object(self, tag_meta_id: int, figure_id: int, value=None) -> Dict:
+        self._call("figures.tags.add")
+        return {ApiField.ID: self._next_id()}
+
+
+class FakeSession:
+    """Local stand-in for `sly.nn.inference.Session` returning the same prediction for every frame.
+    The prediction is stored as JSON and deserialized on each request as the real session does.
+
+    :param api: Fake API to count the inference requests in.
+    :type api: FakeApi
+    :param model_meta: Meta of the model.
+    :type model_meta: sly.ProjectMeta
+    :param prediction: Annotation JSON returned for each frame.
+    :type prediction: Dict
+    """
+
+    def __init__(self, api: FakeApi, model_meta: sly.ProjectMeta, prediction: Dict):
+        self.api = api
+        self.task_id = 1
+        self.inference_settings = {}
+        self._model_meta = model_meta
+        self._prediction = prediction
+
+    def get_model_meta(self) -> sly.ProjectMeta:
+        return self._model_meta
+
+    def set_inference_settings(self, settings: Dict) -> None:
+        self.inference_settings = settings
+
+    def inference_video_id(
+        self,
+        video_id: int,
+        start_frame_index: int = None,
+        frames_count: int = None,
+        frames_direction: str = "forward",
+    ) -> List[sly.Annotation]:
+        self.api._call("inference_video_id")
+        return [self._predict() for _ in range(frames_count)]
+
+    def inference_video_id_async(
+        self,
+        video_id: int,
+        start_frame_index: int = None,
+        frames_count: int = None,
+        frames_direction: str = "forward",
+    ) -> Iterator[sly.Annotation]:
+        self.api._call("inference_video_id_async")
+        for _ in range(frames_count):
+            yield self._predict()
+
+    def stop_async_inference(self) -> None:
+        self.api._call("stop_async_inference")
+
+    def _predict(self) -> sly.Annotation:
+        if self.api.latency.inference > 0:
+            time.sleep(self.api.latency.inference)
+        return sly.Annotation.from_json(self._prediction, self._model_meta)
@@ -0,0 +1,263 @@
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+import supervisely as sly
+from supervisely._utils import camel_to_snake
+from supervisely.api.module_api import ApiField
+from supervisely.api.project_api import ProjectApi
+from supervisely.api.video.video_api import VideoApi
+
+from benchmarks.data import make_model_meta, make_prediction
+from benchmarks.fake_api import Latency
+
+# The model sessions are served on `<server address>/net/<session token>/<endpoint>`.
+MODEL_SESSION_TOKEN = "fake-model"
+
+
+def info_json(info_sequence: List, **values) -> Dict:
+    """Returns the info JSON with all fields of the info sequence of the SDK module, the nested
+    fields (e.g. the frames count of a video in `fileMeta`) are created as nested dicts.
+    Fields are None unless they are passed by the name of the info tuple field.
+    """
+    result = {}
+    for field in info_sequence:
+        if type(field) is str:
+            if result.get(field) is None:
+                result[field] = values.get(camel_to_snake(field))
+            continue
+        path, name = field
+        parent = result
+        for key in path[:-1]:
+            if parent.get(key) is None:
+                parent[key] = {}
+            parent = parent[key]
+        parent[path[-1]] = values.get(name)
+    return result
+
+
+class FakeServer:
+    """Local stand-in for the Supervisely public API and a deployed model session, served over HTTP
+    for the app running in another process. Keeps the projects and created entities in memory,
+    counts calls by endpoint and sleeps for the configured latency. The model processes
+    `model_workers` requests at a time, like a serving app with a single GPU.
+    Endpoints that are not implemented return an empty object and are counted as unhandled.
+
+    :param latency: Simulated latency.
+    :type latency: Latency
+    :param task_id: Task id of the model session.
+    :type task_id: int
+    :param geometry: Geometry type of the predictions.
+    :type geometry: str
+    :param labels_count: Number of labels predicted on each frame.
+    :type labels_count: int
+    :param model_workers: Number of requests the model processes concurrently.
+    :type model_workers: int
+    """
+
+    def __init__(
+        self,
+        latency: Latency,
+        task_id: int = 1,
+        geometry: str = "rectangle",
+        labels_count: int = 10,
+        model_workers: int = 1,
+    ):
+        self.latency = latency
+        self.task_id = task_id
+        self.calls = Counter()
+        self.unhandled = Counter()
+        self.model_meta = make_model_meta(geometry)
+        self.prediction = make_prediction(self.model_meta, geometry, labels_count)
+        self._model_semaphore = threading.BoundedSemaphore(model_workers)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._metas: Dict[int, Dict] = {}
+        self._versions: Dict[int, int] = {}
+        self._videos: Dict[int, Dict] = {}
+        self._httpd: Optional[ThreadingHTTPServer] = None
+        self._handlers: Dict[str, Callable[[Dict], object]] = {
+            "tasks.info": self._task_info,
+            "tasks.request.direct": self._task_request,
+            "projects.info": self._project_info,
+            "projects.meta": self._project_meta,
+            "projects.meta.update": self._update_project_meta,
+            "videos.info": self._video_info,
+            "annotation-objects.bulk.add": lambda data: self._create(
+                data[ApiField.ANNOTATION_OBJECTS]
+            ),
+            "figures.bulk.add": lambda data: self._create(data[ApiField.FIGURES]),
+            "figures.tags.bulk.add": lambda data: self._create(data[ApiField.TAGS]),
+            "figures.list": lambda data: {"entities": [], "total": 0, "pagesCount": 1},
+            "annotation-tool.run-action": lambda data: {},
+        }
+
+    @property
+    def address(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_project(self, project_id: int, meta: sly.ProjectMeta) -> None:
+        self._metas[project_id] = self._with_ids(meta.to_json())
+        self._versions[project_id] = 0
+
+    def add_video(
+        self,
+        video_id: int,
+        project_id: int,
+        dataset_id: int,
+        frames_count: int,
+        height: int = 1080,
+        width: int = 1920,
+    ) -> None:
+        self._videos[video_id] = info_json(
+            VideoApi.info_sequence(),
+            id=video_id,
+            name=f"video_{video_id}.mp4",
+            project_id=project_id,
+            dataset_id=dataset_id,
+            frames_count=frames_count,
+            frame_height=height,
+            frame_width=width,
+        )
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        """Starts serving in a background thread, port 0 picks a free port."""
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.unhandled.clear()
+
+    def handle(self, path: str, data: Dict, payload_bytes: int) -> object:
+        """Returns the response of the API method or the model endpoint at the path."""
+        if path.startswith(f"/net/{MODEL_SESSION_TOKEN}/"):
+            return self._model_request(path.rsplit("/", 1)[-1], data.get("state", {}))
+        method = path.split("/v3/", 1)[-1].strip("/")
+        self._call(method, payload_bytes)
+        handler = self._handlers.get(method)
+        if handler is None:
+            with self._lock:
+                self.unhandled[method] += 1
+            return {}
+        return handler(data)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length > 0 else b""
+                try:
+                    data = json.loads(body) if body else {}
+                except ValueError:
+                    data = {}
+                self._respond(server.handle(self.path.split("?", 1)[0], data, len(body)))
+
+            def do_GET(self):
+                self._respond(server.handle(self.path.split("?", 1)[0], {}, 0))
+
+            def _respond(self, result: object):
+                content = json.dumps(result).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _call(self, endpoint: str, payload_bytes: int = 0) -> None:
+        with self._lock:
+            self.calls[endpoint] += 1
+        latency = self.latency.get(endpoint, payload_bytes)
+        if latency > 0:
+            time.sleep(latency)
+
+    def _next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def _with_ids(self, meta_json: Dict) -> Dict:
+        for item in meta_json.get("classes", []) + meta_json.get("tags", []):
+            if item.get(ApiField.ID) is None:
+                item[ApiField.ID] = self._next_id()
+        return meta_json
+
+    def _create(self, items: List) -> List[Dict]:
+        return [{ApiField.ID: self._next_id()} for _ in items]
+
+    def _task_info(self, data: Dict) -> Dict:
+        return {
+            ApiField.ID: data[ApiField.ID],
+            "status": "started",
+            "meta": {"sessionToken": MODEL_SESSION_TOKEN},
+        }
+
+    def _task_request(self, data: Dict) -> object:
+        return self._model_request(data[ApiField.COMMAND], data.get(ApiField.STATE, {}))
+
+    def _project_info(self, data: Dict) -> Dict:
+        project_id = data[ApiField.ID]
+        with self._lock:
+            version = self._versions[project_id]
+        return info_json(
+            ProjectApi.info_sequence(), id=project_id, name="project", updated_at=str(version)
+        )
+
+    def _project_meta(self, data: Dict) -> Dict:
+        with self._lock:
+            return json.loads(json.dumps(self._metas[data[ApiField.ID]]))
+
+    def _update_project_meta(self, data: Dict) -> Dict:
+        meta = self._with_ids(data[ApiField.META])
+        with self._lock:
+            self._metas[data[ApiField.ID]] = meta
+            self._versions[data[ApiField.ID]] += 1
+        return {}
+
+    def _video_info(self, data: Dict) -> Dict:
+        return self._videos[data[ApiField.ID]]
+
+    def _model_request(self, endpoint: str, state: Dict) -> object:
+        self._call(f"model:{endpoint}")
+        if endpoint == "get_session_info":
+            return {
+                "app_name": "Fake model",
+                "session_id": self.task_id,
+                "task type": "object detection",
+                "model name": "fake",
+                "checkpoint name": "fake.pth",
+                "videos_support": True,
+            }
+        if endpoint == "get_output_classes_and_tags":
+            return self.model_meta.to_json()
+        if endpoint == "get_custom_inference_settings":
+            return {"settings": "conf: 0.25\n"}
+        if endpoint == "inference_video_id":
+            frames_count = state.get("framesCount") or 1
+            with self._model_semaphore:
+                if self.latency.inference > 0:
+                    time.sleep(self.latency.inference * frames_count)
+            return {"ann": [{"annotation": self.prediction} for _ in range(frames_count)]}
+        with self._lock:
+            self.unhandled[f"model:{endpoint}"] += 1
+        return {}
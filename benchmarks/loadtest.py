@@ -0,0 +1,460 @@
+"""Load test of the app with concurrent annotators against a local stand-in for the Supervisely API.
+
+Launches `uvicorn` with the app in a separate process, pointed to a local HTTP server that fakes
+the Supervisely API and the model session. Each simulated annotator opens its own video, switches
+frames (`VideoChanged` events) and clicks the apply button with random think times in between.
+For each number of annotators reports the latency percentiles, throughput, error rate and memory.
+
+Run from the repository root:
+    python -m benchmarks.loadtest --annotators 1 5 10 25 --duration 30 --output loadtest.json
+    python -m benchmarks.loadtest --inference-latency 0.1 --model-workers 2 --baseline loadtest.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import supervisely as sly
+from supervisely.api.module_api import ApiField
+
+from benchmarks.data import make_project_meta
+from benchmarks.fake_api import Latency
+from benchmarks.fake_server import FakeServer
+from benchmarks.startup import get_app_env, get_environment, get_free_port
+
+PROJECT_ID = 1
+DATASET_ID = 1
+MODEL_TASK_ID = 1
+VIDEO_FRAMES_COUNT = 1000
+# Seconds between the polls of the apply job status.
+JOB_POLL_INTERVAL = 0.05
+# Seconds between the samples of the app memory.
+MEMORY_SAMPLE_INTERVAL = 0.2
+
+
+def request_json(
+    url: str, data: Optional[Dict] = None, timeout: float = 60.0
+) -> Tuple[int, Optional[object]]:
+    """Sends a POST request with the JSON body, or a GET request if there is no body.
+
+    :return: Status code and the decoded response, None if the response is not JSON.
+    :rtype: Tuple[int, Optional[object]]
+    """
+    body = None if data is None else json.dumps(data).encode("utf-8")
+    request = urllib.request.Request(url, data=body, method="GET" if data is None else "POST")
+    if body is not None:
+        request.add_header("Content-Type", "application/json")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, content = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, content = e.code, e.read()
+    try:
+        return status, json.loads(content) if content else None
+    except ValueError:
+        return status, None
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def summarize(values: List[float]) -> Dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """Returns the resident memory of the process in bytes, None if it's unknown (not Linux)."""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler:
+    """Samples the resident memory of the process in a background thread."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.start_rss = read_rss(pid)
+        self.peak_rss = self.start_rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "MemorySampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.end_rss = read_rss(self.pid)
+
+    def _run(self) -> None:
+        while not self._stop.wait(MEMORY_SAMPLE_INTERVAL):
+            rss = read_rss(self.pid)
+            if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+                self.peak_rss = rss
+
+
+class LevelStats:
+    """Latencies and errors of all annotators of one load level."""
+
+    def __init__(self):
+        self.event_seconds: List[float] = []
+        self.click_seconds: List[float] = []
+        self.job_seconds: List[float] = []
+        self.requests = 0
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: Optional[float] = None, error: Optional[str] = None):
+        with self._lock:
+            if name != "job":
+                self.requests += 1
+            if error is not None:
+                self.errors[error] += 1
+            elif seconds is not None:
+                getattr(self, f"{name}_seconds").append(seconds)
+
+
+class AppProcess:
+    """The app launched with uvicorn and pointed to the fake server."""
+
+    def __init__(self, server_address: str, data_dir: str, env_overrides: Dict[str, str]):
+        self.port = get_free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = get_app_env(data_dir)
+        self.env["SERVER_ADDRESS"] = server_address
+        self.env.update(env_overrides)
+        self.log_path = os.path.join(data_dir, "app.log")
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float) -> None:
+        command = [
+            *[sys.executable, "-m", "uvicorn", "benchmarks.loadtest_app:app"],
+            *["--port", str(self.port), "--log-level", "warning"],
+        ]
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(
+                command, env=self.env, stdout=log, stderr=subprocess.STDOUT
+            )
+        started_at = time.perf_counter()
+        while time.perf_counter() - started_at < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The app has exited:\n{self.log_tail()}")
+            try:
+                request_json(f"{self.url}/loadtest/routes", timeout=1)
+                return
+            except OSError:
+                # Refused connections and read timeouts while uvicorn is still starting.
+                time.sleep(0.05)
+        raise TimeoutError(f"The app didn't respond in {timeout} s.")
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def log_tail(self, lines: int = 50) -> str:
+        with open(self.log_path) as file:
+            return "".join(file.readlines()[-lines:])
+
+
+def connect_model(app: AppProcess, server: FakeServer, routes: Dict) -> None:
+    """Selects the model session in the app UI and clicks the connect button."""
+    state = {routes["select_session"]: {"sessionId": MODEL_TASK_ID}}
+    status, _ = request_json(f"{app.url}{routes['connect']}", {"context": {}, "state": state})
+    if status != 200 or server.calls["model:get_output_classes_and_tags"] == 0:
+        raise RuntimeError(f"The app couldn't connect to the fake model:\n{app.log_tail()}")
+
+
+def run_annotator(
+    app: AppProcess,
+    routes: Dict,
+    index: int,
+    stop_at: float,
+    think_time: float,
+    job_timeout: float,
+    stats: LevelStats,
+    seed: int,
+) -> None:
+    """Opens a video and repeatedly switches to a random frame and applies the model to it,
+    waiting for the apply job to finish before the next frame.
+    """
+    rng = random.Random(seed + index)
+    video_id = index + 1
+
+    def think():
+        if think_time > 0:
+            time.sleep(rng.expovariate(1 / think_time))
+
+    while time.perf_counter() < stop_at:
+        context = {
+            ApiField.TEAM_ID: 1,
+            ApiField.WORKSPACE_ID: 1,
+            ApiField.PROJECT_ID: PROJECT_ID,
+            ApiField.DATASET_ID: DATASET_ID,
+            ApiField.ENTITY_ID: video_id,
+            ApiField.FRAME: rng.randrange(VIDEO_FRAMES_COUNT),
+            ApiField.SESSION_ID: f"loadtest-{index}",
+            "apiToken": app.env["API_TOKEN"],
+        }
+        body = {"context": context, "state": {}}
+        started_at = time.perf_counter()
+        try:
+            status, _ = request_json(
+                f"{app.url}{sly.Event.ManualSelected.VideoChanged.endpoint}", body
+            )
+        except OSError:
+            status = None
+        seconds = time.perf_counter() - started_at
+        stats.add("event", seconds, None if status == 200 else f"event_{status}")
+        think()
+        if time.perf_counter() >= stop_at:
+            break
+
+        started_at = time.perf_counter()
+        try:
+            status, job = request_json(f"{app.url}{routes['apply']}", body)
+        except OSError:
+            status, job = None, None
+        seconds = time.perf_counter() - started_at
+        if status != 200 or not job:
+            stats.add("click", error=f"apply_{status}" if status != 200 else "apply_no_job")
+            think()
+            continue
+        stats.add("click", seconds)
+        stats.add("job", *wait_job(app.url, job, started_at, job_timeout))
+        think()
+
+
+def wait_job(
+    app_url: str, job: Dict, started_at: float, timeout: float
+) -> Tuple[Optional[float], Optional[str]]:
+    """Polls the apply job until it's finished.
+
+    :return: Seconds from the click to the end of the job and the error, if any.
+    :rtype: Tuple[Optional[float], Optional[str]]
+    """
+    while job["status"] not in ("done", "failed", "cancelled"):
+        if time.perf_counter() - started_at > timeout:
+            return None, "job_timeout"
+        time.sleep(JOB_POLL_INTERVAL)
+        try:
+            status, job = request_json(f"{app_url}/apply-jobs/{job['id']}")
+        except OSError:
+            return None, "job_status_unavailable"
+        if status != 200:
+            return None, f"job_status_{status}"
+    if job["status"] != "done":
+        return None, f"job_{job['status']}"
+    return time.perf_counter() - started_at, None
+
+
+def run_level(
+    app: AppProcess,
+    server: FakeServer,
+    routes: Dict,
+    annotators: int,
+    duration: float,
+    think_time: float,
+    job_timeout: float,
+    seed: int,
+) -> Dict:
+    """Runs the annotators concurrently for the duration and waits for their last jobs."""
+    server.reset_counters()
+    stats = LevelStats()
+    stop_at = time.perf_counter() + duration
+    threads = [
+        threading.Thread(
+            target=run_annotator,
+            args=(app, routes, i, stop_at, think_time, job_timeout, stats, seed),
+            daemon=True,
+        )
+        for i in range(annotators)
+    ]
+    started_at = time.perf_counter()
+    with MemorySampler(app.process.pid) as memory:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started_at
+    errors = sum(stats.errors.values())
+    return {
+        "annotators": annotators,
+        "seconds": elapsed,
+        "requests": stats.requests,
+        "jobs_done": len(stats.job_seconds),
+        "throughput": len(stats.job_seconds) / elapsed,
+        "error_rate": errors / stats.requests if stats.requests else 0.0,
+        "errors": dict(stats.errors),
+        "event_seconds": summarize(stats.event_seconds),
+        "click_seconds": summarize(stats.click_seconds),
+        "job_seconds": summarize(stats.job_seconds),
+        "rss_bytes": {"start": memory.start_rss, "peak": memory.peak_rss, "end": memory.end_rss},
+        "api_calls": dict(server.calls),
+        "unhandled_api_calls": dict(server.unhandled),
+    }
+
+
+def print_results(results: List[Dict], baseline: Optional[List[Dict]] = None) -> None:
+    baseline = {result["annotators"]: result for result in baseline or []}
+
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value * 1000:.0f}"
+
+    header = (
+        f"{'users':>5} {'requests':>8} {'errors':>7} {'click p50/p95/p99, ms':>22} "
+        f"{'job p50/p95/p99, ms':>22} {'jobs/s':>7} {'peak RSS, MB':>13}"
+    )
+    if baseline:
+        header += f" {'job p95 vs base':>16}"
+    print(header)
+    for result in results:
+        click, job = result["click_seconds"], result["job_seconds"]
+        peak = result["rss_bytes"]["peak"]
+        line = (
+            f"{result['annotators']:>5} {result['requests']:>8} "
+            f"{result['error_rate'] * 100:>6.1f}% "
+            f"{'/'.join(ms(click[q]) for q in ('p50', 'p95', 'p99')):>22} "
+            f"{'/'.join(ms(job[q]) for q in ('p50', 'p95', 'p99')):>22} "
+            f"{result['throughput']:>7.2f} "
+            f"{'-' if peak is None else f'{peak / 1024 / 1024:.0f}':>13}"
+        )
+        base = baseline.get(result["annotators"])
+        if base is not None and base["job_seconds"]["p95"] and job["p95"]:
+            line += f" {job['p95'] / base['job_seconds']['p95']:>15.2f}x"
+        print(line)
+        if result["unhandled_api_calls"]:
+            print(f"      unhandled API calls: {result['unhandled_api_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--annotators", type=int, nargs="+", default=[1, 5, 10, 25])
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per load level.")
+    parser.add_argument(
+        "--think-time", type=float, default=2.0, help="Mean seconds between the actions."
+    )
+    parser.add_argument(
+        "--geometry", choices=["rectangle", "polygon", "bitmap"], default="rectangle"
+    )
+    parser.add_argument("--labels", type=int, default=10, help="Predicted labels per frame.")
+    parser.add_argument("--meta-classes", type=int, default=100, help="Classes in the project.")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="Seconds per API call.")
+    parser.add_argument(
+        "--per-mb-latency", type=float, default=0.05, help="Seconds per payload MB."
+    )
+    parser.add_argument("--inference-latency", type=float, default=0.1, help="Seconds per frame.")
+    parser.add_argument(
+        "--model-workers", type=int, default=1, help="Frames the model infers concurrently."
+    )
+    parser.add_argument("--job-timeout", type=float, default=120.0, help="Seconds per apply job.")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--app-env",
+        nargs="*",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Environment of the app, e.g. API_MAX_CONCURRENCY=16 (the prediction store is disabled "
+        "by default, so that every click is inferred).",
+    )
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    sly.logger.setLevel("WARNING")
+    latency = Latency(
+        default=args.api_latency, per_mb=args.per_mb_latency, inference=args.inference_latency
+    )
+    server = FakeServer(
+        latency,
+        task_id=MODEL_TASK_ID,
+        geometry=args.geometry,
+        labels_count=args.labels,
+        model_workers=args.model_workers,
+    )
+    server.add_project(PROJECT_ID, make_project_meta(args.meta_classes))
+    for i in range(max(args.annotators)):
+        server.add_video(i + 1, PROJECT_ID, DATASET_ID, VIDEO_FRAMES_COUNT)
+    server.start()
+
+    env_overrides = {"PREDICTION_STORE_MAX_MB": "0"}
+    env_overrides.update(item.split("=", 1) for item in args.app_env)
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        app = AppProcess(server.address, data_dir, env_overrides)
+        try:
+            app.start(args.startup_timeout)
+            _, routes = request_json(f"{app.url}/loadtest/routes")
+            connect_model(app, server, routes)
+            for annotators in args.annotators:
+                results.append(
+                    run_level(
+                        app,
+                        server,
+                        routes,
+                        annotators,
+                        args.duration,
+                        args.think_time,
+                        args.job_timeout,
+                        args.seed,
+                    )
+                )
+            _, metrics = request_json(f"{app.url}/metrics?format=json")
+        finally:
+            app.stop()
+            server.stop()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    print_results(results, baseline)
+
+    environment = get_environment()
+    environment["supervisely"] = getattr(sly, "__version__", None)
+    report = {
+        "environment": environment,
+        "config": vars(args),
+        "results": results,
+        "app_metrics": metrics,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
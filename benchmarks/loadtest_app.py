@@ -0,0 +1,19 @@
+"""The app with an extra route for the load test: widget ids are generated on each start,
+so the routes of the buttons can only be discovered in the app process.
+
+    python -m uvicorn benchmarks.loadtest_app:app
+"""
+
+from supervisely.app.widgets import Button
+
+from src.main import app, server
+from src.ui import apply_button, connect_button, select_session
+
+
+@server.get("/loadtest/routes")
+def get_routes():
+    return {
+        "apply": apply_button.get_route_path(Button.Routes.CLICK),
+        "connect": connect_button.get_route_path(Button.Routes.CLICK),
+        "select_session": select_session.widget_id,
+    }
@@ -0,0 +1,262 @@
+"""Offline benchmark of the apply pipeline (inference, postprocessing and upload of one frame)
+against the local fake of the Supervisely API.
+
+Run from the repository root:
+    python -m benchmarks.run --labels 1 10 100 500 --output results.json
+    python -m benchmarks.run --baseline previous_release.json
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import time
+from dataclasses import asdict, replace
+from typing import Dict, List, Optional
+
+# src.globals creates API clients from the environment on import, they are replaced with the fake API.
+os.environ.setdefault("SERVER_ADDRESS", "http://localhost")
+os.environ.setdefault("API_TOKEN", "0" * 128)
+os.environ.setdefault("context.spawnApiToken", "0" * 128)
+os.environ.setdefault("TEAM_ID", "1")
+
+import supervisely as sly  # noqa: E402
+
+import src.functions as f  # noqa: E402
+import src.globals as g  # noqa: E402
+import src.upload as upload  # noqa: E402
+from benchmarks.data import (  # noqa: E402
+    GEOMETRIES,
+    make_model_meta,
+    make_prediction,
+    make_project_meta,
+)
+from benchmarks.fake_api import FakeApi, FakeSession, Latency  # noqa: E402
+from src.filtering import FilterSettings  # noqa: E402
+from src.geometry import GeometrySettings  # noqa: E402
+from src.mask_pool import start_pool  # noqa: E402
+from src.meta_cache import ProjectMetaCache  # noqa: E402
+from src.metrics import Metrics  # noqa: E402
+from src.state import ApplyContext  # noqa: E402
+from src.tracking import ObjectIndexCache  # noqa: E402
+
+PROJECT_ID = 1
+DATASET_ID = 1
+VIDEO_ID = 1
+
+
+def reset_app_state(api: FakeApi) -> None:
+    """Points the app to the fake API and clears the caches left by the previous case."""
+    g.api = api
+    g.spawn_api = api
+    g.project_meta_cache = ProjectMetaCache()
+    g.object_index_cache = ObjectIndexCache()
+    g.metrics = Metrics()
+    g.prefetcher.frames_count = 0
+    f._merge_cache.clear()
+    f._name_indexes.clear()
+    upload._video_infos.clear()
+    upload._bulk_figure_tags_supported = True
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def run_case(
+    geometry: str,
+    labels_count: int,
+    meta_classes: int,
+    repeats: int,
+    latency: Latency,
+    geometry_settings: GeometrySettings = GeometrySettings(),
+    filter_settings: FilterSettings = FilterSettings(),
+) -> Dict:
+    """Measures clicks on consecutive frames of a video: the first click adds the model classes
+    to the project meta, the next ones find everything in the caches.
+
+    :return: Latency, API calls and stage timings of the case.
+    :rtype: Dict
+    """
+    api = FakeApi(latency)
+    api.add_project(PROJECT_ID, make_project_meta(meta_classes))
+    api.add_video(VIDEO_ID, DATASET_ID, frames_count=repeats + 1, height=1080, width=1920)
+    model_meta = make_model_meta(geometry)
+    prediction = make_prediction(model_meta, geometry, labels_count)
+    reset_app_state(api)
+    ctx = ApplyContext(
+        api=api,
+        session_id="benchmark",
+        video_id=VIDEO_ID,
+        project_id=PROJECT_ID,
+        frame=0,
+        model_session=FakeSession(api, model_meta, prediction),
+        model_meta=model_meta,
+        selected_classes=list(model_meta.obj_classes),
+        selected_tags=list(model_meta.tag_metas),
+        suffix="model",
+        use_suffix=False,
+        filters=filter_settings,
+        geometry=geometry_settings,
+    )
+
+    clicks = []
+    for frame in range(repeats + 1):
+        if frame == 1:
+            # Stage timings are reported for the warm clicks only.
+            g.metrics = Metrics()
+        api.reset_counters()
+        start = time.perf_counter()
+        stats = f.inference(replace(ctx, frame=frame))
+        clicks.append(
+            {
+                "seconds": time.perf_counter() - start,
+                "api_calls": sum(api.calls.values()),
+                "api_calls_by_endpoint": dict(api.calls),
+                "payload_bytes": api.payload_bytes,
+                "figures": stats.figures if stats is not None else 0,
+            }
+        )
+
+    first, warm = clicks[0], clicks[1:]
+    seconds = [click["seconds"] for click in warm]
+    return {
+        "geometry": geometry,
+        "labels": labels_count,
+        "project_meta_classes": meta_classes,
+        "first_click": first,
+        "click_seconds": {
+            "median": statistics.median(seconds),
+            "p95": percentile(seconds, 0.95),
+            "min": min(seconds),
+            "max": max(seconds),
+        },
+        "api_calls": warm[-1]["api_calls"],
+        "api_calls_by_endpoint": warm[-1]["api_calls_by_endpoint"],
+        "payload_bytes": warm[-1]["payload_bytes"],
+        "figures": warm[-1]["figures"],
+        "stages": g.metrics.to_json()["stages"],
+    }
+
+
+def case_key(result: Dict):
+    return result["geometry"], result["labels"], result["project_meta_classes"]
+
+
+def print_results(results: List[Dict], baseline: Optional[List[Dict]] = None) -> None:
+    baseline = {case_key(result): result for result in baseline or []}
+    header = (
+        f"{'geometry':<10} {'labels':>6} {'meta':>6} {'first, ms':>10} "
+        f"{'median, ms':>11} {'p95, ms':>9} {'calls':>6}"
+    )
+    if baseline:
+        header += f" {'vs base':>8}"
+    print(header)
+    for result in results:
+        line = (
+            f"{result['geometry']:<10} {result['labels']:>6} {result['project_meta_classes']:>6} "
+            f"{result['first_click']['seconds'] * 1000:>10.1f} "
+            f"{result['click_seconds']['median'] * 1000:>11.1f} "
+            f"{result['click_seconds']['p95'] * 1000:>9.1f} {result['api_calls']:>6}"
+        )
+        base = baseline.get(case_key(result))
+        if base is not None:
+            ratio = result["click_seconds"]["median"] / base["click_seconds"]["median"]
+            line += f" {ratio:>7.2f}x"
+        print(line)
+
+
+def get_environment() -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "supervisely": getattr(sly, "__version__", None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--labels", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument(
+        "--geometries", nargs="+", choices=list(GEOMETRIES), default=list(GEOMETRIES)
+    )
+    parser.add_argument("--meta-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeats", type=int, default=5, help="Warm clicks per case.")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds per API call.")
+    parser.add_argument("--per-mb-latency", type=float, default=0.0, help="Seconds per payload MB.")
+    parser.add_argument("--inference-latency", type=float, default=0.0, help="Seconds per frame.")
+    parser.add_argument("--min-confidence", type=float, default=0.0)
+    parser.add_argument("--nms", action="store_true", help="Class-wise NMS with IoU 0.5.")
+    parser.add_argument("--masks-to-polygons", action="store_true")
+    parser.add_argument("--simplify-polygons", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="Simplification, px.")
+    parser.add_argument("--min-area", type=int, default=0, help="Min label area, px.")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    sly.logger.setLevel("WARNING")
+    # The app starts the mask encoding workers in the background on startup.
+    start_pool()
+    latency = Latency(
+        default=args.api_latency, per_mb=args.per_mb_latency, inference=args.inference_latency
+    )
+    geometry_settings = GeometrySettings(
+        min_area=args.min_area,
+        masks_to_polygons=args.masks_to_polygons,
+        simplify_polygons=args.simplify_polygons,
+        tolerance=args.tolerance,
+    )
+    filter_settings = FilterSettings(confidence=args.min_confidence, nms=args.nms)
+    results = []
+    for geometry in args.geometries:
+        for labels_count in args.labels:
+            for meta_classes in args.meta_sizes:
+                results.append(
+                    run_case(
+                        geometry,
+                        labels_count,
+                        meta_classes,
+                        args.repeats,
+                        latency,
+                        geometry_settings,
+                        filter_settings,
+                    )
+                )
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    print_results(results, baseline)
+
+    report = {
+        "environment": get_environment(),
+        "config": {
+            **vars(args),
+            "latency": asdict(latency),
+            "geometry": asdict(geometry_settings),
+            "filters": asdict(filter_settings),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Cold start benchmark of the app: time from launching `uvicorn src.main:app` to the first response.
+
+Run from the repository root:
+    python -m benchmarks.startup --runs 5 --output startup.json
+    python -m benchmarks.startup --baseline previous_release.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+# The app reads the instance address and tokens from the environment, no requests are sent
+# to the instance until an annotator opens a video.
+APP_ENV = {
+    "ENV": "production",
+    "SERVER_ADDRESS": "http://localhost",
+    "API_TOKEN": "0" * 128,
+    "context.spawnApiToken": "0" * 128,
+    "TEAM_ID": "1",
+}
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def get_app_env(data_dir: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    for key, value in APP_ENV.items():
+        env.setdefault(key, value)
+    env["SLY_APP_DATA_DIR"] = data_dir
+    return env
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_response(env: Dict[str, str], path: str, timeout: float) -> Dict:
+    """Launches the app and polls it until the first successful response.
+
+    :return: Seconds to the first response and the response status.
+    :rtype: Dict
+    """
+    port = get_free_port()
+    url = f"http://127.0.0.1:{port}{path}"
+    command = [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(port)]
+    started_at = time.perf_counter()
+    process = subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    try:
+        while time.perf_counter() - started_at < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"The app has exited:\n{process.stderr.read()}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    return {
+                        "first_response": time.perf_counter() - started_at,
+                        "status": response.status,
+                    }
+            except OSError:
+                # Refused connections and read timeouts while uvicorn is still starting.
+                time.sleep(0.01)
+        raise TimeoutError(f"The app didn't respond in {timeout} s.")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def profile_imports(env: Dict[str, str], top: int) -> Dict:
+    """Imports the app module with `-X importtime` and returns the slowest imports.
+
+    :return: Total import time of the app and the slowest app modules and top-level packages.
+    :rtype: Dict
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import src.main"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"The app can't be imported:\n{result.stderr}")
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match is None:
+            continue
+        _, cumulative_us, indent, module = match.groups()
+        # Nesting is shown with two spaces per level after the separator.
+        depth = (len(indent) - 1) // 2
+        if module.startswith("src.") or depth == 0:
+            cumulative[module] = max(cumulative.get(module, 0), int(cumulative_us) / 1e6)
+    slowest = sorted(cumulative.items(), key=lambda item: -item[1])[:top]
+    return {
+        "import_app": cumulative.get("src.main", 0.0),
+        "slowest_imports": [{"module": module, "seconds": seconds} for module, seconds in slowest],
+    }
+
+
+def get_environment() -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def summarize(values: List[float]) -> Dict:
+    return {
+        "median": statistics.median(values),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def print_results(report: Dict, baseline: Optional[Dict] = None) -> None:
+    first_response = report["first_response"]
+    line = (
+        f"Time to first response: median {first_response['median'] * 1000:.0f} ms, "
+        f"min {first_response['min'] * 1000:.0f} ms, max {first_response['max'] * 1000:.0f} ms"
+    )
+    if baseline is not None:
+        previous = baseline["first_response"]["median"]
+        line += f" (baseline {previous * 1000:.0f} ms, {first_response['median'] / previous:.2f}x)"
+    print(line)
+    print(f"Import of src.main: {report['import_app'] * 1000:.0f} ms")
+    print(f"{'module':<40} {'cumulative, ms':>15}")
+    for item in report["slowest_imports"]:
+        print(f"{item['module']:<40} {item['seconds'] * 1000:>15.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Number of app launches.")
+    parser.add_argument("--path", default="/", help="Route requested after the launch.")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for the app.")
+    parser.add_argument("--top", type=int, default=15, help="Number of the slowest imports.")
+    parser.add_argument("--output", default="startup_results.json")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = get_app_env(data_dir)
+        runs = [measure_first_response(env, args.path, args.timeout) for _ in range(args.runs)]
+        imports = profile_imports(env, args.top)
+
+    report = {
+        "environment": get_environment(),
+        "config": vars(args),
+        "first_response": summarize([run["first_response"] for run in runs]),
+        "runs": runs,
+        **imports,
+    }
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_results(report, baseline)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import supervisely as sly
+
+
+class CheckpointStore:
+    """Progress of the whole-video labeling saved to local disk, one JSON file per video.
+    Frames are uploaded in order, so the progress is the index of the first frame
+    that wasn't uploaded yet. Files are replaced atomically, a crash can't leave a broken checkpoint.
+    Each checkpoint has the fingerprint of the models and settings it was made with,
+    the progress of another model or other settings is not resumed.
+
+    :param directory: Directory to store the checkpoints in.
+    :type directory: str
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def get(self, video_id: int) -> Optional[Dict]:
+        """Returns the checkpoint of the video or None if there is no checkpoint."""
+        path = self._get_path(video_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            sly.logger.warning(f"Checkpoint of video {video_id} can't be read: {repr(e)}")
+            return None
+
+    def get_next_frame(self, video_id: int, fingerprint: str) -> int:
+        """Returns the index of the first frame to process, 0 if there is no checkpoint
+        or it was made with other models or settings.
+
+        :param video_id: Video id.
+        :type video_id: int
+        :param fingerprint: Fingerprint of the current models and settings.
+        :type fingerprint: str
+        :return: Index of the first frame to process.
+        :rtype: int
+        """
+        checkpoint = self.get(video_id)
+        if checkpoint is None:
+            return 0
+        if checkpoint.get("fingerprint") != fingerprint:
+            sly.logger.info(
+                f"Checkpoint of video {video_id} was made with other models or settings, "
+                "the video will be labeled from the start."
+            )
+            return 0
+        return int(checkpoint.get("next_frame", 0))
+
+    def save(self, video_id: int, next_frame: int, frames_count: int, fingerprint: str) -> None:
+        """Saves the progress of the video.
+
+        :param video_id: Video id.
+        :type video_id: int
+        :param next_frame: Index of the first frame that wasn't uploaded yet.
+        :type next_frame: int
+        :param frames_count: Number of frames in the video.
+        :type frames_count: int
+        :param fingerprint: Fingerprint of the models and settings the frames were labeled with.
+        :type fingerprint: str
+        """
+        checkpoint = {
+            "video_id": video_id,
+            "next_frame": next_frame,
+            "frames_count": frames_count,
+            "fingerprint": fingerprint,
+            "updated_at": time.time(),
+        }
+        path = self._get_path(video_id)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(checkpoint, file)
+            os.replace(tmp_path, path)
+
+    def remove(self, video_id: int) -> None:
+        with self._lock:
+            path = self._get_path(video_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _get_path(self, video_id: int) -> str:
+        return os.path.join(self.directory, f"video_{video_id}.json")
@@ -0,0 +1,135 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import supervisely as sly
+import yaml
+
+from src.transport import PooledSession
+
+
+class SessionManager:
+    """Keeps one model Session per model task and reuses it across clicks.
+    Session info is revalidated with a single request when it is older than `ttl` seconds
+    or after the session was invalidated (e.g. the inference has failed).
+
+    :param ttl: Time in seconds during which the session info is considered valid.
+    :type ttl: float
+    """
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self._sessions: Dict[int, sly.nn.inference.Session] = {}
+        self._session_infos: Dict[int, Dict[str, Any]] = {}
+        self._validated_at: Dict[int, float] = {}
+        self._settings_hashes: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def connect(self, api: sly.Api, task_id: int) -> Tuple[sly.nn.inference.Session, Dict]:
+        """Creates a new Session for the model task and replaces the stored one.
+
+        :return: Session, session info.
+        :rtype: Tuple[sly.nn.inference.Session, Dict]
+        """
+        session = PooledSession(api, task_id=task_id)
+        session_info = session.get_session_info()
+        with self._lock:
+            self._sessions[task_id] = session
+            self._session_infos[task_id] = session_info
+            self._validated_at[task_id] = time.monotonic()
+            self._settings_hashes.pop(task_id, None)
+        return session, session_info
+
+    def get(self, api: sly.Api, task_id: int) -> Tuple[sly.nn.inference.Session, Dict]:
+        """Returns the stored Session and the session info, revalidating it if the TTL has expired.
+        If there is no stored Session, connects to the model.
+
+        :return: Session, session info.
+        :rtype: Tuple[sly.nn.inference.Session, Dict]
+        """
+        with self._lock:
+            session = self._sessions.get(task_id)
+            session_info = self._session_infos.get(task_id)
+            validated_at = self._validated_at.get(task_id, 0)
+        if session is None:
+            return self.connect(api, task_id)
+        if time.monotonic() - validated_at < self.ttl:
+            return session, session_info
+
+        session_info = api.task.send_request(task_id, "get_session_info", data={}, timeout=3)
+        if not session_info:
+            raise RuntimeError(f"Model session {task_id} didn't return session info.")
+        with self._lock:
+            self._session_infos[task_id] = session_info
+            self._validated_at[task_id] = time.monotonic()
+        sly.logger.debug(f"Model session {task_id} was revalidated.")
+        return session, session_info
+
+    def invalidate(self, task_id: int) -> None:
+        """Forces revalidation of the session info on the next `get` call."""
+        with self._lock:
+            self._validated_at.pop(task_id, None)
+
+    def disconnect(self, task_id: int) -> None:
+        """Forgets the stored Session of the model task."""
+        with self._lock:
+            self._sessions.pop(task_id, None)
+            self._session_infos.pop(task_id, None)
+            self._validated_at.pop(task_id, None)
+            self._settings_hashes.pop(task_id, None)
+
+    def apply_settings(
+        self, session: sly.nn.inference.Session, settings_yaml: str, default_yaml: str
+    ) -> Optional[Dict]:
+        """Parses the inference settings from YAML and sets them to the session.
+        Nothing is done if the parsed settings haven't changed since the last call, so reformatting
+        the YAML or changing comments and the order of keys doesn't resend them.
+        If the YAML can't be parsed, the default settings are used.
+
+        :param session: Model session.
+        :type session: sly.nn.inference.Session
+        :param settings_yaml: Inference settings in YAML format.
+        :type settings_yaml: str
+        :param default_yaml: Default inference settings of the model in YAML format.
+        :type default_yaml: str
+        :return: Parsed settings or None if the settings haven't changed.
+        :rtype: Optional[Dict]
+        """
+        try:
+            inf_settings = yaml.safe_load(settings_yaml)
+        except Exception as e:
+            inf_settings = yaml.safe_load(default_yaml)
+            sly.logger.warning(
+                f"Model Inference launched without additional settings. \n" f"Reason: {e}",
+                exc_info=True,
+            )
+        dumped = json.dumps(inf_settings, sort_keys=True, default=str)
+        content_hash = hashlib.md5(dumped.encode("utf-8")).hexdigest()
+        with self._lock:
+            if self._settings_hashes.get(session.task_id) == content_hash:
+                return None
+        session.set_inference_settings(inf_settings)
+        with self._lock:
+            self._settings_hashes[session.task_id] = content_hash
+        sly.logger.info(f"Inference Settings: {inf_settings}")
+        return inf_settings
+
+
+def fork_session(session: sly.nn.inference.Session) -> sly.nn.inference.Session:
+    """Returns a copy of the session for a single async inference.
+    The Session stores the id of its running async inference and stops it when a new one is started,
+    so concurrent jobs can't share it. The copy shares the client, the settings and the model meta
+    and doesn't send any requests.
+
+    :param session: Model session.
+    :type session: sly.nn.inference.Session
+    :return: Session without a running async inference.
+    :rtype: sly.nn.inference.Session
+    """
+    forked = copy.copy(session)
+    forked._async_inference_uuid = None
+    forked._stop_async_inference_flag = False
+    return forked
@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, Literal, Optional, TypeVar
+
+import numpy as np
+import supervisely as sly
+
+from src.filtering import CONFIDENCE_TAG_NAMES, label_confidence
+from src.tracking import boxes_iou, label_box
+
+T = TypeVar("T")
+
+# Requests to the additional models are sent from this pool, the first model is queried
+# from the calling thread.
+ENSEMBLE_WORKERS = 8
+_executor = ThreadPoolExecutor(max_workers=ENSEMBLE_WORKERS, thread_name_prefix="ensemble")
+
+
+@dataclass(frozen=True)
+class FusionSettings:
+    """Merging of the predictions of several models for the same frame.
+
+    :param method: "none" keeps all labels, "dedup" keeps the most confident label of each group
+        of overlapping labels of the same class, "wbf" fuses each group into one label:
+        boxes are averaged and masks are voted with the confidences as weights.
+    :type method: Literal["none", "dedup", "wbf"]
+    :param iou: Labels of the same class with a higher IoU of bounding boxes are grouped.
+    :type iou: float
+    """
+
+    method: Literal["none", "dedup", "wbf"] = "none"
+    iou: float = 0.55
+
+
+def run_concurrently(funcs: List[Callable[[], T]]) -> List[T]:
+    """Calls the functions concurrently and returns their results in the same order.
+    The first function is called in the current thread, an error of any function is re-raised.
+
+    :param funcs: Functions without arguments.
+    :type funcs: List[Callable[[], T]]
+    :return: Results of the functions.
+    :rtype: List[T]
+    """
+    futures = [_executor.submit(func) for func in funcs[1:]]
+    try:
+        results = [funcs[0]()]
+    finally:
+        # The other requests are awaited even if the first one failed, so that they don't pile up.
+        for future in futures:
+            future.exception()
+    return results + [future.result() for future in futures]
+
+
+def combine_model_metas(model_metas: List[sly.ProjectMeta]) -> sly.ProjectMeta:
+    """Combines the classes and tags of several models into one meta.
+    Classes with the same name are predicted as the same class. If their geometry types differ,
+    the class accepts any geometry. For tags with the same name, the first model's tag is kept.
+
+    :param model_metas: Metas of the models, the first one is the main model.
+    :type model_metas: List[sly.ProjectMeta]
+    :return: Combined meta.
+    :rtype: sly.ProjectMeta
+    """
+    if len(model_metas) == 1:
+        return model_metas[0]
+    obj_classes = {}
+    tag_metas = {}
+    for model_meta in model_metas:
+        for obj_class in model_meta.obj_classes:
+            existing = obj_classes.get(obj_class.name)
+            if existing is None:
+                obj_classes[obj_class.name] = obj_class
+            elif existing.geometry_type not in [obj_class.geometry_type, sly.AnyGeometry]:
+                sly.logger.warning(
+                    f"Models predict class {obj_class.name} with different geometry types, "
+                    "it will accept any geometry."
+                )
+                obj_classes[obj_class.name] = existing.clone(geometry_type=sly.AnyGeometry)
+        for tag_meta in model_meta.tag_metas:
+            existing = tag_metas.get(tag_meta.name)
+            if existing is None:
+                tag_metas[tag_meta.name] = tag_meta
+            elif existing.value_type != tag_meta.value_type:
+                sly.logger.warning(
+                    f"Models predict tag {tag_meta.name} with different value types, "
+                    "the tags of the additional models are ignored."
+                )
+    return sly.ProjectMeta(
+        obj_classes=sly.ObjClassCollection(list(obj_classes.values())),
+        tag_metas=sly.TagMetaCollection(list(tag_metas.values())),
+    )
+
+
+def fuse_predictions(anns: List[sly.Annotation], settings: FusionSettings) -> sly.Annotation:
+    """Merges the predictions of several models for the same frame into one annotation.
+
+    :param anns: Predictions of the models, the first one is the main model.
+    :type anns: List[sly.Annotation]
+    :param settings: Fusion settings.
+    :type settings: FusionSettings
+    :return: Merged annotation.
+    :rtype: sly.Annotation
+    """
+    labels = [label for ann in anns for label in ann.labels]
+    if settings.method != "none":
+        labels = fuse_labels(labels, settings, len(anns))
+    img_tags = []
+    tag_names = set()
+    for ann in anns:
+        for tag in ann.img_tags:
+            if tag.meta.name not in tag_names:
+                tag_names.add(tag.meta.name)
+                img_tags.append(tag)
+    return anns[0].clone(labels=labels, img_tags=sly.TagCollection(img_tags))
+
+
+def fuse_labels(
+    labels: List[sly.Label], settings: FusionSettings, models_count: int
+) -> List[sly.Label]:
+    """Groups overlapping labels of the same class and replaces each group with one label.
+    Groups are built greedily: the most confident label takes all remaining labels
+    of its class that overlap it with an IoU above the threshold.
+
+    :param labels: Labels predicted by all models.
+    :type labels: List[sly.Label]
+    :param settings: Fusion settings.
+    :type settings: FusionSettings
+    :param models_count: Number of models, the confidence of a fused label is decreased
+        if fewer models predicted it.
+    :type models_count: int
+    :return: Fused labels.
+    :rtype: List[sly.Label]
+    """
+    if len(labels) < 2:
+        return labels
+    boxes = np.array([label_box(label) for label in labels], dtype=np.float64)
+    class_names = np.array([label.obj_class.name for label in labels])
+    scores = np.array([label_confidence(label) for label in labels], dtype=np.float64)
+
+    result = []
+    for class_name in np.unique(class_names):
+        indexes = np.nonzero(class_names == class_name)[0]
+        indexes = indexes[np.argsort(-scores[indexes], kind="stable")]
+        iou = boxes_iou(boxes[indexes], boxes[indexes])
+        grouped = np.zeros(len(indexes), dtype=bool)
+        for i in range(len(indexes)):
+            if grouped[i]:
+                continue
+            in_group = ~grouped & (iou[i] > settings.iou)
+            in_group[i] = True
+            members = np.nonzero(in_group)[0]
+            grouped[members] = True
+            group = [labels[index] for index in indexes[members]]
+            if settings.method == "wbf" and len(group) > 1:
+                result.append(_fuse_group(group, scores[indexes[members]], models_count))
+            else:
+                result.append(group[0])
+    return result
+
+
+def _fuse_group(group: List[sly.Label], scores: np.ndarray, models_count: int) -> sly.Label:
+    """Fuses the group of labels sorted by confidence into one label."""
+    weights = np.maximum(scores, 1e-6)
+    geometry = group[0].geometry
+    if all(type(label.geometry) is sly.Rectangle for label in group):
+        boxes = np.array([label_box(label) for label in group], dtype=np.float64)
+        box = np.round(np.average(boxes, axis=0, weights=weights)).astype(int).tolist()
+        geometry = sly.Rectangle(*box)
+    elif all(type(label.geometry) is sly.Bitmap for label in group):
+        mask = _vote_masks([label.geometry for label in group], weights)
+        if mask is not None:
+            geometry = mask
+    # Other geometries can't be averaged, the most confident one is kept.
+    confidence = float(scores.mean()) * min(len(group), models_count) / models_count
+    tags = [
+        tag.clone(value=round(confidence, 4)) if tag.meta.name in CONFIDENCE_TAG_NAMES else tag
+        for tag in group[0].tags
+    ]
+    return group[0].clone(geometry=geometry, tags=sly.TagCollection(tags))
+
+
+def _vote_masks(bitmaps: List[sly.Bitmap], weights: np.ndarray) -> Optional[sly.Bitmap]:
+    """Returns the mask of pixels covered by the bitmaps with more than half of the total weight,
+    None if there are no such pixels.
+    """
+    top = min(bitmap.origin.row for bitmap in bitmaps)
+    left = min(bitmap.origin.col for bitmap in bitmaps)
+    bottom = max(bitmap.origin.row + bitmap.data.shape[0] for bitmap in bitmaps)
+    right = max(bitmap.origin.col + bitmap.data.shape[1] for bitmap in bitmaps)
+    votes = np.zeros((bottom - top, right - left), dtype=np.float64)
+    for bitmap, weight in zip(bitmaps, weights):
+        row, col = bitmap.origin.row - top, bitmap.origin.col - left
+        height, width = bitmap.data.shape
+        votes[row : row + height, col : col + width] += bitmap.data * weight
+    mask = votes > weights.sum() / 2
+    if not mask.any():
+        return None
+    return sly.Bitmap(mask, origin=sly.PointLocation(top, left))
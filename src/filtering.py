@@ -0,0 +1,166 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+import numpy as np
+import supervisely as sly
+import yaml
+
+from src.tracking import boxes_iou, label_box
+
+# Serving apps add the confidence of the prediction as a label tag.
+CONFIDENCE_TAG_NAMES = ["confidence", "conf", "score"]
+
+
+@dataclass(frozen=True)
+class FilterSettings:
+    """Filtering of the predicted labels applied before the meta merging and the upload.
+
+    :param confidence: Minimum confidence of a label, labels without confidence are kept.
+    :type confidence: float
+    :param class_confidence: Minimum confidence for specific classes, overrides `confidence`.
+    :type class_confidence: Dict[str, float]
+    :param min_area: Minimum area of the label bounding box in pixels, 0 to disable.
+    :type min_area: int
+    :param max_area: Maximum area of the label bounding box in pixels, 0 to disable.
+    :type max_area: int
+    :param top_k: Maximum number of labels of each class with the highest confidence, 0 to disable.
+    :type top_k: int
+    :param nms: Apply non-maximum suppression to the labels of each class.
+    :type nms: bool
+    :param nms_iou: Labels overlapping a more confident label of the same class with a higher IoU
+        of bounding boxes are removed.
+    :type nms_iou: float
+    """
+
+    confidence: float = 0.0
+    class_confidence: Dict[str, float] = field(default_factory=dict)
+    min_area: int = 0
+    max_area: int = 0
+    top_k: int = 0
+    nms: bool = False
+    nms_iou: float = 0.5
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.confidence > 0
+            or len(self.class_confidence) > 0
+            or self.min_area > 0
+            or self.max_area > 0
+            or self.top_k > 0
+            or self.nms
+        )
+
+
+def parse_class_confidence(text: str) -> Dict[str, float]:
+    """Parses per-class confidence thresholds written as YAML mapping, e.g. "person: 0.6".
+
+    :param text: Thresholds text.
+    :type text: str
+    :return: Confidence threshold for each class.
+    :rtype: Dict[str, float]
+    :raises ValueError: If the text is not a mapping of class names to numbers.
+    """
+    if text is None or text.strip() == "":
+        return {}
+    data = yaml.safe_load(text)
+    if not isinstance(data, dict):
+        raise ValueError("Class confidence thresholds must be written as 'class name: threshold'.")
+    try:
+        return {str(name).strip(): float(threshold) for name, threshold in data.items()}
+    except (TypeError, ValueError):
+        raise ValueError("Class confidence thresholds must be numbers.")
+
+
+def label_confidence(label: sly.Label) -> float:
+    """Returns the confidence of the label or 1 if the model didn't provide it."""
+    for tag in label.tags:
+        if tag.meta.name in CONFIDENCE_TAG_NAMES and isinstance(tag.value, (int, float)):
+            return float(tag.value)
+    return 1.0
+
+
+def nms(boxes: np.ndarray, iou_threshold: float, top_k: int = 0) -> np.ndarray:
+    """Greedy non-maximum suppression of the boxes sorted by confidence.
+    The IoU matrix is computed once, each kept box suppresses the rest with one array operation.
+
+    :param boxes: Boxes with shape (N, 4) in (top, left, bottom, right) format, sorted by confidence.
+    :type boxes: np.ndarray
+    :param iou_threshold: Boxes overlapping a kept box with a higher IoU are suppressed.
+    :type iou_threshold: float
+    :param top_k: Maximum number of kept boxes, 0 to disable.
+    :type top_k: int
+    :return: Indexes of the kept boxes.
+    :rtype: np.ndarray
+    """
+    return suppress(boxes_iou(boxes, boxes), iou_threshold, top_k)
+
+
+def suppress(overlaps: np.ndarray, threshold: float, top_k: int = 0) -> np.ndarray:
+    """Greedy suppression by a precomputed overlap matrix of the items sorted by confidence:
+    each kept item suppresses the rest with one array operation.
+
+    :param overlaps: Square matrix of overlaps of the items.
+    :type overlaps: np.ndarray
+    :param threshold: Items overlapping a kept item more than the threshold are suppressed.
+    :type threshold: float
+    :param top_k: Maximum number of kept items, 0 to disable.
+    :type top_k: int
+    :return: Indexes of the kept items.
+    :rtype: np.ndarray
+    """
+    suppressed = np.zeros(len(overlaps), dtype=bool)
+    kept = []
+    for i in range(len(overlaps)):
+        if suppressed[i]:
+            continue
+        kept.append(i)
+        if top_k > 0 and len(kept) >= top_k:
+            break
+        suppressed |= overlaps[i] > threshold
+    return np.array(kept, dtype=np.int64)
+
+
+def filter_labels(labels: List[sly.Label], settings: FilterSettings) -> Tuple[List[sly.Label], int]:
+    """Filters the labels by confidence, bounding box area, top-K and NMS.
+    Scores, areas and thresholds of all labels are compared as arrays,
+    top-K and NMS are applied separately to each class.
+
+    :param labels: Predicted labels.
+    :type labels: List[sly.Label]
+    :param settings: Filtering settings.
+    :type settings: FilterSettings
+    :return: Kept labels in the original order, number of removed labels.
+    :rtype: Tuple[List[sly.Label], int]
+    """
+    if len(labels) == 0:
+        return labels, 0
+    boxes = np.array([label_box(label) for label in labels], dtype=np.float64)
+    class_names = np.array([label.obj_class.name for label in labels])
+    scores = np.array([label_confidence(label) for label in labels], dtype=np.float64)
+    thresholds = np.array(
+        [settings.class_confidence.get(name, settings.confidence) for name in class_names],
+        dtype=np.float64,
+    )
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+
+    keep = scores >= thresholds
+    if settings.min_area > 0:
+        keep &= areas >= settings.min_area
+    if settings.max_area > 0:
+        keep &= areas <= settings.max_area
+
+    if settings.top_k > 0 or settings.nms:
+        for class_name in np.unique(class_names[keep]):
+            indexes = np.nonzero(keep & (class_names == class_name))[0]
+            # Sorting by confidence, stable sort keeps the model order for equal scores.
+            indexes = indexes[np.argsort(-scores[indexes], kind="stable")]
+            if settings.nms:
+                kept = indexes[nms(boxes[indexes], settings.nms_iou, settings.top_k)]
+            else:
+                kept = indexes[: settings.top_k]
+            keep[indexes] = False
+            keep[kept] = True
+
+    result = [label for label, is_kept in zip(labels, keep.tolist()) if is_kept]
+    return result, len(labels) - len(result)
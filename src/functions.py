@@ -1,9 +1,35 @@
-from typing import Dict, Literal, Tuple, Union
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from typing import Dict, FrozenSet, Iterator, List, Literal, Optional, Tuple, Union
 
 import supervisely as sly
 import yaml
 
 import src.globals as g
+from src.connection import fork_session
+from src.ensemble import fuse_predictions, run_concurrently
+from src.filtering import filter_labels
+from src.geometry import GeometryStats, optimize_geometry, polygon_meta
+from src.jobs import Job
+from src.prefetch import settings_hash
+from src.registry import UploadedFigure, diff_figures, geometry_hash, tags_hash
+from src.sampling import FrameSampler
+from src.state import ApplyContext
+from src.tiling import infer_tiled
+from src.tracking import ObjectIndex, associate, label_box
+from src.upload import UploadStats, get_video_info, upload_annotation, upload_diff
+
+# Resolved class/tag mappings are cached, because the selection and the project meta rarely change
+# between clicks, while resolving the names for projects with hundreds of classes is noticeable.
+MERGE_CACHE_SIZE = 32
+_merge_cache = OrderedDict()
+_merge_cache_lock = threading.Lock()
+_meta_versions: Dict[int, str] = {}
+_name_indexes = OrderedDict()
 
 
 def connect_to_model(api: sly.Api, model_session_id: int) -> bool:
@@ -55,12 +81,15 @@ def get_inference_settings(api: sly.Api, model_session_id: int) -> str:
     return inference_settings
 
 
-def load_classes(model_meta) -> sly.ObjClassCollection:
-    """Fills the widget with the classes from the model metadata."""
-    if g.is_my_labeling_job:
+def load_classes(
+    model_meta: sly.ProjectMeta, allowed_classes: Optional[FrozenSet[str]] = None
+) -> sly.ObjClassCollection:
+    """Fills the widget with the classes from the model metadata.
+    If the set of allowed classes is passed (labeling job), other classes are skipped."""
+    if allowed_classes is not None:
         obj_classes = []
         for obj_class in model_meta.obj_classes:
-            if obj_class.name in g.allowed_classes:
+            if obj_class.name in allowed_classes:
                 obj_classes.append(obj_class)
     else:
         obj_classes = model_meta.obj_classes
@@ -68,12 +97,15 @@ def load_classes(model_meta) -> sly.ObjClassCollection:
     return obj_classes
 
 
-def load_tags(model_meta) -> sly.TagMetaCollection:
-    """Fills the widget with the tags from the model metadata."""
-    if g.is_my_labeling_job:
+def load_tags(
+    model_meta: sly.ProjectMeta, allowed_tags: Optional[FrozenSet[str]] = None
+) -> sly.TagMetaCollection:
+    """Fills the widget with the tags from the model metadata.
+    If the set of allowed tags is passed (labeling job), other tags are skipped."""
+    if allowed_tags is not None:
         obj_tags = []
         for tag_meta in model_meta.tag_metas:
-            if tag_meta.name in g.allowed_tags:
+            if tag_meta.name in allowed_tags:
                 obj_tags.append(tag_meta)
     else:
         obj_tags = model_meta.tag_metas
@@ -81,53 +113,469 @@ def load_tags(model_meta) -> sly.TagMetaCollection:
     return obj_tags
 
 
-def inference():
-    """Applies the model to the selected frame."""
-    project_meta = g.project_metas[g.project_id]
+def inference(ctx: ApplyContext, job: Optional[Job] = None) -> Optional[UploadStats]:
+    """Applies the model to the selected frame.
 
-    predictions_list = g.session.inference_video_id(
-        g.video_id, start_frame_index=g.frame, frames_count=1, frames_direction="forward"
-    )
-    if len(predictions_list) == 1:
+    :param ctx: Apply request context.
+    :type ctx: ApplyContext
+    :param job: Background job to report progress to.
+    :type job: Job, optional
+    :return: Statistics of the upload or None if the model returned no predictions.
+    :rtype: Optional[UploadStats]
+    """
+    if job is not None:
+        job.total = 1
+    if len(ctx.extra_sessions) > 0 or ctx.tiling.enabled:
+        # The prefetched predictions are of the whole frame of the main model only.
+        predictions_list = infer_models(ctx, ctx.frame, 1, "forward")
+        if len(predictions_list) != 1:
+            return None
+        return upload_prediction(ctx, predictions_list[0], ctx.frame, job, load_object_index(ctx))
+    ann = None
+    # The settings are taken before the inference together with the keys, so that a prediction
+    # made while the settings are being changed is not saved under the new settings.
+    settings = settings_hash(ctx.model_session.inference_settings)
+    if g.prefetcher.enabled:
+        ann = g.prefetcher.get(ctx.model_session, ctx.video_id, ctx.frame, settings)
+        sly.logger.info(f"Prediction cache: {g.prediction_cache.stats()}")
+    # Predictions of the same checkpoint with the same settings survive reconnects and restarts.
+    store_key = None
+    if g.prediction_store.enabled and ctx.model_key is not None:
+        store_key = (ctx.model_key, ctx.video_id, ctx.frame, settings)
+    if ann is None and store_key is not None:
+        with g.metrics.span("prediction_store", video_id=ctx.video_id, frame=ctx.frame):
+            ann = g.prediction_store.get(*store_key, ctx.model_meta)
+        if ann is not None:
+            g.metrics.inc("prediction_store_hits")
+            store_key = None
+    if ann is None:
+        with g.metrics.span("inference", video_id=ctx.video_id, frame=ctx.frame):
+            predictions_list = ctx.model_session.inference_video_id(
+                ctx.video_id,
+                start_frame_index=ctx.frame,
+                frames_count=1,
+                frames_direction="forward",
+            )
+        if len(predictions_list) != 1:
+            return None
         ann = predictions_list[0]
-        ann, res_project_meta = postprocess(
-            ann, project_meta, g.selected_classes, g.selected_tags, g.suffix, g.use_suffix
+        if settings_hash(ctx.model_session.inference_settings) != settings:
+            sly.logger.debug(
+                "Inference settings were changed during the inference, the prediction is not saved."
+            )
+            return upload_prediction(ctx, ann, ctx.frame, job, load_object_index(ctx))
+        if g.prefetcher.enabled:
+            key = g.prefetcher.get_key(ctx.model_session, ctx.video_id, ctx.frame, settings)
+            g.prediction_cache.put(key, ann)
+    if store_key is not None:
+        g.prediction_store.put(*store_key, ann)
+    return upload_prediction(ctx, ann, ctx.frame, job, load_object_index(ctx))
+
+
+def inference_range(
+    ctx: ApplyContext,
+    frames_count: int,
+    direction: Literal["forward", "backward"],
+    stride: int,
+    job: Optional[Job] = None,
+) -> UploadStats:
+    """Applies the model to the range of frames starting from the selected frame.
+    Predictions are consumed as a stream: each frame is postprocessed and uploaded
+    while the next frames are still being inferred by the model.
+
+    :param ctx: Apply request context.
+    :type ctx: ApplyContext
+    :param frames_count: Number of frames to label.
+    :type frames_count: int
+    :param direction: Direction of the range from the selected frame.
+    :type direction: Literal["forward", "backward"]
+    :param stride: Step between labeled frames.
+    :type stride: int
+    :param job: Background job to report progress to.
+    :type job: Job, optional
+    :return: Total statistics of the upload.
+    :rtype: UploadStats
+    """
+    frame_indexes = get_range_frame_indexes(ctx, frames_count, direction, stride)
+    sly.logger.info(
+        f"Applying model to {len(frame_indexes)} frames: {frame_indexes[0]}..{frame_indexes[-1]}"
+    )
+    if job is not None:
+        job.total = len(frame_indexes)
+    is_keyframe = [True] * len(frame_indexes)
+    if ctx.sampling.enabled:
+        sampler = FrameSampler(ctx.api, ctx.video_id, ctx.sampling)
+        is_keyframe = select_keyframes(sampler, frame_indexes)
+        sly.logger.info(f"Frame sampling: {sampler}")
+    keyframe_indexes = [index for index, key in zip(frame_indexes, is_keyframe) if key]
+
+    total_stats = UploadStats()
+    # The index is loaded once and updated with the uploaded figures, so that objects
+    # are extended from frame to frame along the range.
+    object_index = load_object_index(ctx)
+    predictions = stream_predictions(ctx, keyframe_indexes, direction)
+    keyframe = None
+    try:
+        for frame_index, key in zip(frame_indexes, is_keyframe):
+            if key:
+                keyframe = prepare_prediction(ctx, next(predictions), frame_index, job)
+            elif not ctx.sampling.copy_figures:
+                if job is not None:
+                    job.skipped += 1
+                continue
+            else:
+                g.metrics.inc("frames_copied")
+            # Copies of the keyframe figures are associated with the keyframe objects.
+            stats = upload_prepared(ctx, *keyframe, frame_index, job, object_index)
+            total_stats.update(stats)
+    finally:
+        predictions.close()
+    sly.logger.info(f"Range of {len(frame_indexes)} frames uploaded: {total_stats}")
+    return total_stats
+
+
+def select_keyframes(sampler: FrameSampler, frame_indexes: List[int]) -> List[bool]:
+    """Selects the keyframes with the sampler and counts the skipped frames.
+
+    :return: For each frame, True if it is a keyframe.
+    :rtype: List[bool]
+    """
+    with g.metrics.span("sampling", video_id=sampler.video_id, frame=frame_indexes[0]):
+        is_keyframe = sampler.select(frame_indexes)
+    g.metrics.inc("frames_skipped", is_keyframe.count(False))
+    return is_keyframe
+
+
+def get_range_frame_indexes(
+    ctx: ApplyContext,
+    frames_count: int,
+    direction: Literal["forward", "backward"],
+    stride: int,
+) -> List[int]:
+    """Returns indexes of the frames to label starting from the context frame,
+    the range is clipped by the video boundaries.
+
+    :return: Frame indexes in the order of inference.
+    :rtype: List[int]
+    """
+    video_frames_count = get_video_info(ctx.api, ctx.video_id).frames_count
+    step = stride if direction == "forward" else -stride
+    frame_indexes = []
+    for frame_index in range(ctx.frame, ctx.frame + step * frames_count, step):
+        if frame_index < 0 or frame_index >= video_frames_count:
+            break
+        frame_indexes.append(frame_index)
+    return frame_indexes
+
+
+def stream_predictions(
+    ctx: ApplyContext, frame_indexes: List[int], direction: Literal["forward", "backward"]
+) -> Iterator[sly.Annotation]:
+    """Yields model predictions for the frames as soon as they are ready.
+    Consecutive frames are inferred with a single async inference request.
+    The serving apps can't skip frames, so with a stride or frame sampling
+    each frame is requested separately, as well as with tiled inference.
+
+    :return: Iterator over the predictions in the order of frame indexes.
+    :rtype: Iterator[sly.Annotation]
+    """
+    if (
+        len(frame_indexes) > 1
+        and abs(frame_indexes[-1] - frame_indexes[0]) == len(frame_indexes) - 1
+        and not ctx.tiling.enabled
+    ):
+        # Each stream has its own session: starting or stopping an async inference on the shared one
+        # would stop the inference of another job.
+        session = fork_session(ctx.model_session)
+        frame_iterator = session.inference_video_id_async(
+            ctx.video_id,
+            start_frame_index=frame_indexes[0],
+            frames_count=len(frame_indexes),
+            frames_direction=direction,
         )
-        if project_meta != res_project_meta:
-            project_meta = res_project_meta
-            g.spawn_api.project.update_meta(g.project_id, project_meta.to_json())
-        g.api.project.pull_meta_ids(g.project_id, project_meta)
-        g.project_metas[g.project_id] = project_meta
-
-        video_objects = []
-        for label in ann.labels:
-            obj_class = project_meta.get_obj_class(label.obj_class.name)
-            video_object = sly.VideoObject(obj_class, sly.VideoTagCollection())
-            video_objects.append(video_object)
-        ids = g.api.video.object.append_bulk(g.video_id, video_objects, sly.KeyIdMap())
-
-        for label, obj_id in zip(ann.labels, ids):
-            geometry_json = label.geometry.to_json()
-            geometry_type = label.geometry.geometry_name()
-            fig_id = g.api.video.figure.create(
-                g.video_id, obj_id, g.frame, geometry_json, geometry_type
+        received = 0
+        exhausted = False
+        try:
+            while True:
+                # Waiting for the next prediction is the inference latency seen by the app.
+                with g.metrics.span("inference", video_id=ctx.video_id):
+                    ann = next(frame_iterator, None)
+                if ann is None:
+                    exhausted = True
+                    break
+                received += 1
+                yield ann
+        finally:
+            if received < len(frame_indexes) and not exhausted:
+                # The consumer has failed or stopped early, the model doesn't need to infer the rest.
+                try:
+                    session.stop_async_inference()
+                except Exception as e:
+                    sly.logger.warning(f"Couldn't stop async inference: {repr(e)}")
+        if received < len(frame_indexes):
+            raise RuntimeError(
+                f"Model returned {received} predictions instead of {len(frame_indexes)} "
+                f"for frames {frame_indexes[0]}..{frame_indexes[-1]} of video {ctx.video_id}."
+            )
+        return
+    for frame_index in frame_indexes:
+        predictions_list = infer_models(ctx, frame_index, 1, direction)
+        yield predictions_list[0] if len(predictions_list) == 1 else sly.Annotation((0, 0))
+
+
+def infer_models(
+    ctx: ApplyContext, start: int, count: int, direction: Literal["forward", "backward"]
+) -> List[sly.Annotation]:
+    """Infers the frames with the model and the additional models of the context.
+    The models are queried concurrently, so the latency is the one of the slowest model.
+    Predictions of the models for each frame are fused into one annotation.
+    With tiled inference the frames are downloaded once and tiled for each model.
+
+    :return: Predictions for the frames in the order of inference.
+    :rtype: List[sly.Annotation]
+    """
+    frames = None
+    if ctx.tiling.enabled:
+        step = 1 if direction == "forward" else -1
+        video_frames_count = get_video_info(ctx.api, ctx.video_id).frames_count
+        frame_indexes = [
+            index
+            for index in range(start, start + step * count, step)
+            if 0 <= index < video_frames_count
+        ]
+        with g.metrics.span("download_frames", video_id=ctx.video_id, frame=start):
+            frames = ctx.api.video.frame.download_nps(ctx.video_id, frame_indexes)
+
+    def _infer(session: sly.nn.inference.Session) -> List[sly.Annotation]:
+        with g.metrics.span(
+            "inference", video_id=ctx.video_id, frame=start, task_id=session.task_id
+        ):
+            if frames is not None:
+                return infer_tiled(session, frames, ctx.tiling)
+            return session.inference_video_id(
+                ctx.video_id,
+                start_frame_index=start,
+                frames_count=count,
+                frames_direction=direction,
             )
-            for tag in label.tags:
-                tag_meta = project_meta.get_tag_meta(tag.meta.name)
-                g.api.advanced.add_tag_to_object(tag_meta.sly_id, fig_id, tag.value)
+
+    if len(ctx.extra_sessions) == 0:
+        return _infer(ctx.model_session)
+    sessions = [ctx.model_session, *ctx.extra_sessions]
+    results = run_concurrently([partial(_infer, session) for session in sessions])
+    g.metrics.inc("ensemble_requests", len(sessions))
+    with g.metrics.span("fusion", frame=start):
+        return [fuse_predictions(list(anns), ctx.fusion) for anns in zip(*results)]
+
+
+def load_object_index(ctx: ApplyContext) -> Optional[ObjectIndex]:
+    """Returns the index of the video figures for cross-frame association if it is enabled.
+    The index is cached for the video and updated with the uploads of the app.
+
+    :return: Index of the video figures or None if the association is disabled.
+    :rtype: Optional[ObjectIndex]
+    """
+    if not ctx.associate:
+        return None
+    dataset_id = get_video_info(ctx.api, ctx.video_id).dataset_id
+    with g.metrics.span("object_index", video_id=ctx.video_id):
+        return g.object_index_cache.get(ctx.api, ctx.video_id, dataset_id)
+
+
+def upload_prediction(
+    ctx: ApplyContext,
+    ann: sly.Annotation,
+    frame_index: int,
+    job: Optional[Job] = None,
+    object_index: Optional[ObjectIndex] = None,
+) -> UploadStats:
+    """Postprocesses the model prediction, updates project meta if needed and uploads the result.
+
+    :param ctx: Apply request context.
+    :type ctx: ApplyContext
+    :param ann: Model prediction for the frame.
+    :type ann: sly.Annotation
+    :param frame_index: Index of the frame.
+    :type frame_index: int
+    :param job: Background job to report progress to, the upload is skipped if it was cancelled.
+    :type job: Job, optional
+    :param object_index: Index of the video figures to extend existing objects.
+    :type object_index: ObjectIndex, optional
+    :return: Statistics of the upload.
+    :rtype: UploadStats
+    """
+    ann, project_meta = prepare_prediction(ctx, ann, frame_index, job)
+    return upload_prepared(ctx, ann, project_meta, frame_index, job, object_index)
+
+
+def prepare_prediction(
+    ctx: ApplyContext,
+    ann: sly.Annotation,
+    frame_index: int,
+    job: Optional[Job] = None,
+) -> Tuple[sly.Annotation, sly.ProjectMeta]:
+    """Postprocesses the model prediction and updates project meta if new classes or tags were added.
+
+    :return: Annotation ready for the upload, project meta with ids of classes and tags.
+    :rtype: Tuple[sly.Annotation, sly.ProjectMeta]
+    """
+    if job is not None:
+        job.inferred += 1
+        job.check_cancelled()
+    g.metrics.inc("frames_inferred")
+    with g.metrics.span("meta_get", project_id=ctx.project_id):
+        project_meta = g.project_meta_cache.get(ctx.api, ctx.project_id)
+    with g.metrics.span("postprocess", frame=frame_index):
+        ann, res_project_meta = postprocess(ctx, ann, project_meta)
+    if job is not None:
+        job.postprocessed += 1
+        job.check_cancelled()
+    # merge_metas returns the same object if no classes or tags were added.
+    if res_project_meta is not project_meta:
+        project_meta = res_project_meta
+        with g.metrics.span("meta_update", project_id=ctx.project_id):
+            g.spawn_api.project.update_meta(ctx.project_id, project_meta.to_json())
+            ctx.api.project.pull_meta_ids(ctx.project_id, project_meta)
+        g.project_meta_cache.put(ctx.project_id, project_meta)
+        g.metrics.inc("api_calls", 2)
+    return ann, project_meta
+
+
+def upload_prepared(
+    ctx: ApplyContext,
+    ann: sly.Annotation,
+    project_meta: sly.ProjectMeta,
+    frame_index: int,
+    job: Optional[Job] = None,
+    object_index: Optional[ObjectIndex] = None,
+) -> UploadStats:
+    """Uploads the postprocessed annotation, extending the objects from the index if it is passed.
+
+    :return: Statistics of the upload.
+    :rtype: UploadStats
+    """
+    object_ids = None
+    labels = list(ann.labels)
+    class_ids = [project_meta.get_obj_class(label.obj_class.name).sly_id for label in labels]
+    if object_index is not None:
+        with g.metrics.span("associate", frame=frame_index):
+            object_ids = associate(
+                labels,
+                class_ids,
+                object_index,
+                frame_index,
+                ctx.association_window,
+                ctx.association_iou,
+            )
+
+    key = (ctx.video_id, frame_index, ctx.task_ids)
+    previous = g.figure_registry.get(key) if ctx.replace_previous else None
+    with g.metrics.span("upload", frame=frame_index), invalidate_on_error(ctx, object_index):
+        if previous:
+            diff = diff_figures(previous, labels, class_ids)
+            # Objects created for the removed figures are removed too, unless they were extended
+            # to other frames. The registry only filters out the known cases, the objects are
+            # checked on the server before they are removed.
+            remove_object_ids = [
+                figure.object_id
+                for figure in diff.remove
+                if figure.created_object
+                and not g.figure_registry.has_other_figures(figure.object_id, key)
+            ]
+            stats = upload_diff(
+                ctx.api,
+                ctx.video_id,
+                ctx.project_id,
+                frame_index,
+                ann,
+                project_meta,
+                diff,
+                object_ids,
+                remove_object_ids,
+            )
+        else:
+            stats = upload_annotation(
+                ctx.api, ctx.video_id, ctx.project_id, frame_index, ann, project_meta, object_ids
+            )
+    g.metrics.inc("api_calls", stats.api_calls)
+    g.metrics.inc("figures_uploaded", stats.figures)
+    g.metrics.inc("bytes_uploaded", stats.payload_bytes)
+    g.metrics.inc("geometry_bytes_uploaded", stats.geometry_bytes)
+    g.metrics.inc("figures_kept", stats.kept)
+    g.metrics.inc("figures_updated", stats.updated)
+    g.metrics.inc("figures_removed", stats.removed)
+    boxes = [label_box(label) for label in labels]
+    g.figure_registry.put(
+        key, uploaded_figures(labels, class_ids, boxes, stats, previous or [], object_ids)
+    )
+    if object_index is not None:
+        if previous:
+            # The figures of the frame are added again with their new boxes.
+            object_index.remove([figure.object_id for figure in previous], frame_index)
+            object_index.remove(stats.removed_object_ids)
+        object_index.add(stats.object_ids, class_ids, frame_index, boxes)
+    if job is not None:
+        job.uploaded += 1
+    return stats
+
+
+@contextmanager
+def invalidate_on_error(ctx: ApplyContext, object_index: Optional[ObjectIndex]):
+    """Invalidates the cached object index of the video if the upload fails: the index
+    may reference objects removed by the annotators or miss figures that were uploaded.
+    """
+    try:
+        yield
+    except Exception:
+        if object_index is not None:
+            g.object_index_cache.invalidate(ctx.video_id)
+        raise
+
+
+def uploaded_figures(
+    labels: List[sly.Label],
+    class_ids: List[int],
+    boxes: List[List[int]],
+    stats: UploadStats,
+    previous: List[UploadedFigure],
+    object_ids: Optional[List[Optional[int]]] = None,
+) -> List[UploadedFigure]:
+    """Returns the registry records of the uploaded labels. Objects of the previous figures
+    stay marked as created by the app for the kept, updated and replaced figures.
+    """
+    created_before = {figure.object_id: figure.created_object for figure in previous}
+    figures = []
+    for i, label in enumerate(labels):
+        object_id = stats.object_ids[i]
+        if object_id in created_before:
+            created_object = created_before[object_id]
+        else:
+            created_object = object_ids is None or object_ids[i] is None
+        figures.append(
+            UploadedFigure(
+                figure_id=stats.figure_ids[i],
+                object_id=object_id,
+                class_id=class_ids[i],
+                created_object=created_object,
+                geometry_hash=geometry_hash(label),
+                tags_hash=tags_hash(label),
+                box=boxes[i],
+            )
+        )
+    return figures
 
 
 def postprocess(
+    ctx: ApplyContext,
     ann: sly.Annotation,
     project_meta: sly.ProjectMeta,
-    keep_classes: sly.ObjClassCollection,
-    keep_tags: sly.TagMetaCollection,
-    suffix: str,
-    use_suffix: bool,
 ) -> Tuple[sly.Annotation, sly.ProjectMeta]:
     """Postprocesses annotation after model inference and returns the result annotation and project meta.
-    Removes classes and tags that are not selected in the UI.
+    Removes classes and tags that are not selected in the UI, filters the labels by confidence,
+    area and overlap, and optimizes geometries of the labels.
 
+    :param ctx: Apply request context with the selected classes and tags.
+    :type ctx: ApplyContext
     :param ann: Annotation to postprocess.
     :type ann: sly.Annotation
     :param project_meta: Project meta.
@@ -136,32 +584,59 @@ def postprocess(
     :rtype: Tuple[sly.Annotation, sly.ProjectMeta]
     """
 
+    keep_classes = ctx.selected_classes
+    keep_tags = ctx.selected_tags
+    keep_class_names = ctx.selected_class_names
+    keep_tag_names = ctx.selected_tag_names
+
+    labels = [label for label in ann.labels if label.obj_class.name in keep_class_names]
+    if ctx.filters.enabled:
+        labels, removed = filter_labels(labels, ctx.filters)
+        g.metrics.inc("labels_filtered", removed)
+        sly.logger.debug(f"Filtering: {removed} of {len(labels) + removed} labels removed.")
+
+    model_meta = ctx.model_meta
+    if ctx.geometry.masks_to_polygons:
+        model_meta = polygon_meta(model_meta)
     res_project_meta, class_mapping, tag_meta_mapping = merge_metas(
-        project_meta, keep_classes, keep_tags, suffix, use_suffix
+        project_meta, model_meta, keep_classes, keep_tags, ctx.suffix, ctx.use_suffix
     )
-    keep_class_names = [obj_class.name for obj_class in keep_classes]
-    keep_tag_names = [tag_meta.name for tag_meta in keep_tags]
 
     image_tags = []
     for tag in ann.img_tags:
-        if tag.meta.name not in keep_tags:
+        if tag.meta.name not in keep_tag_names:
             continue
         image_tags.append(tag.clone(meta=tag_meta_mapping[tag.meta.name]))
 
     new_labels = []
-    for label in ann.labels:
-        if label.obj_class.name not in keep_class_names:
-            continue
+    geometry_stats = GeometryStats()
+    for label in labels:
+        geometries = [label.geometry]
+        if ctx.geometry.enabled:
+            geometries = optimize_geometry(label.geometry, ctx.geometry, geometry_stats)
         label_tags = []
         for tag in label.tags:
             if tag.meta.name not in keep_tag_names:
                 continue
             label_tags.append(tag.clone(meta=tag_meta_mapping[tag.meta.name]))
-        new_label = label.clone(
-            obj_class=class_mapping[label.obj_class.name.strip()],
-            tags=sly.TagCollection(label_tags),
-        )
-        new_labels.append(new_label)
+        for geometry in geometries:
+            new_label = label.clone(
+                geometry=geometry,
+                obj_class=class_mapping[label.obj_class.name.strip()],
+                tags=sly.TagCollection(label_tags),
+            )
+            new_labels.append(new_label)
+    if ctx.geometry.enabled:
+        sly.logger.debug(f"Geometry optimization: {geometry_stats}")
+        g.metrics.inc("geometry_mask_pixels_converted", geometry_stats.mask_pixels)
+        g.metrics.inc("geometry_points_converted", geometry_stats.converted_points)
+        g.metrics.inc("geometry_points_before", geometry_stats.points_before)
+        g.metrics.inc("geometry_points_after", geometry_stats.points_after)
+        g.metrics.inc("geometry_changed", geometry_stats.changed)
+        g.metrics.inc("geometry_sampled", geometry_stats.sampled)
+        g.metrics.inc("geometry_sampled_bytes_before", geometry_stats.sampled_bytes_before)
+        g.metrics.inc("geometry_sampled_bytes_after", geometry_stats.sampled_bytes_after)
+        g.metrics.inc("labels_removed_by_area", geometry_stats.removed)
 
     res_ann = ann.clone(labels=new_labels, img_tags=sly.TagCollection(image_tags))
     return res_ann, res_project_meta
@@ -169,121 +644,273 @@ def postprocess(
 
 def merge_metas(
     project_meta: sly.ProjectMeta,
+    model_meta: sly.ProjectMeta,
     keep_classes: sly.ObjClassCollection,
     keep_tags: sly.TagMetaCollection,
     suffix: str,
     use_suffix: bool,
 ) -> Tuple[sly.ProjectMeta, Dict[str, sly.ObjClass], Dict[str, sly.TagMeta]]:
-    result_meta = project_meta.clone()
+    """Merges selected model classes and tags to the project meta.
+    The result is memoized by the versions of the metas (hashes of their JSON) and the selection:
+    while they stay the same, the mapping is returned without resolving the names again.
+    If nothing was added, the same project meta object is returned.
+
+    :return: Result project meta, mapping of the model classes, mapping of the model tags.
+    :rtype: Tuple[sly.ProjectMeta, Dict[str, sly.ObjClass], Dict[str, sly.TagMeta]]
+    """
+    project_version = meta_version(project_meta)
+    key = (
+        project_version,
+        meta_version(model_meta),
+        tuple(obj_class.name for obj_class in keep_classes),
+        tuple(tag_meta.name for tag_meta in keep_tags),
+        suffix,
+        use_suffix,
+    )
+    with _merge_cache_lock:
+        cached = _merge_cache.get(key)
+        if cached is not None:
+            _merge_cache.move_to_end(key)
+    if cached is not None:
+        result_meta, class_mapping, tag_mapping = cached
+        # An equal meta can be a different object, the caller compares the result with its own meta.
+        if result_meta is None:
+            result_meta = project_meta
+        return result_meta, class_mapping, tag_mapping
+
+    result = _merge_metas(
+        project_meta, project_version, model_meta, keep_classes, keep_tags, suffix, use_suffix
+    )
+    result_meta, class_mapping, tag_mapping = result
+    with _merge_cache_lock:
+        _merge_cache[key] = (
+            None if result_meta is project_meta else result_meta,
+            class_mapping,
+            tag_mapping,
+        )
+        while len(_merge_cache) > MERGE_CACHE_SIZE:
+            _merge_cache.popitem(last=False)
+    return result
+
 
+def meta_version(meta: sly.ProjectMeta) -> str:
+    """Returns the version of the meta: the hash of its JSON.
+    The hash is computed once for each meta object and forgotten when the object is garbage collected,
+    so an id reused by another object doesn't return a stale version.
+
+    :param meta: Project or model meta.
+    :type meta: sly.ProjectMeta
+    :return: Hash of the meta.
+    :rtype: str
+    """
+    meta_id = id(meta)
+    version = _meta_versions.get(meta_id)
+    if version is not None:
+        return version
+    version = settings_hash(meta.to_json())
+    with _merge_cache_lock:
+        if meta_id not in _meta_versions:
+            _meta_versions[meta_id] = version
+            # The finalizer can run in any thread (even with the lock held), dict.pop is atomic.
+            weakref.finalize(meta, _meta_versions.pop, meta_id, None)
+    return version
+
+
+def _merge_metas(
+    project_meta: sly.ProjectMeta,
+    project_version: str,
+    model_meta: sly.ProjectMeta,
+    keep_classes: sly.ObjClassCollection,
+    keep_tags: sly.TagMetaCollection,
+    suffix: str,
+    use_suffix: bool,
+) -> Tuple[sly.ProjectMeta, Dict[str, sly.ObjClass], Dict[str, sly.TagMeta]]:
     def _merge(
-        result_meta: sly.ProjectMeta,
         data_type=Literal["class", "tag"],
         suffix: str = "model",
         use_suffix: bool = False,
     ):
-        """Merges classes or tags from the model meta to the project meta.
+        """Resolves classes or tags from the model meta in the project meta.
 
-        :param result_meta: Project meta to merge to.
-        :type result_meta: sly.ProjectMeta
         :param data_type: Data type to merge (class or tag).
         :type data_type: Literal["class", "tag"]
-        :return: Result project meta, mapping of the model classes/tags to the project classes/tags.
-        :rtype: Tuple[sly.ProjectMeta, Dict[str, sly.ObjClass]]
+        :return: Items to add to the project meta, mapping of the model classes/tags to the project classes/tags.
+        :rtype: Tuple[List[Union[sly.ObjClass, sly.TagMeta]], Dict[str, Union[sly.ObjClass, sly.TagMeta]]]
         """
         if data_type == "class":
             project_collection = project_meta.obj_classes
             keep_names = [obj_class.name for obj_class in keep_classes]
-            model_collection = g.model_meta.obj_classes
+            model_collection = model_meta.obj_classes
         else:
             project_collection = project_meta.tag_metas
             keep_names = [tag_meta.name for tag_meta in keep_tags]
-            model_collection = g.model_meta.tag_metas
+            model_collection = model_meta.tag_metas
+        name_index = _get_name_index(project_version, data_type, project_collection, suffix)
+        new_items = []
         mapping = {}
         for name in keep_names:
             model_item = model_collection.get(name)
-            res_item, res_name = find_item(project_collection, model_item, suffix, use_suffix)
+            res_item, res_name = find_item(
+                project_collection, model_item, suffix, use_suffix, name_index
+            )
             if res_item is None:
                 res_item = model_item.clone(name=res_name)
-                result_meta = (
-                    result_meta.add_obj_class(res_item)
-                    if data_type == "class"
-                    else result_meta.add_tag_meta(res_item)
-                )
+                new_items.append(res_item)
             mapping[model_item.name.strip()] = res_item
-        return result_meta, mapping
+        return new_items, mapping
 
-    result_meta, class_mapping = _merge(
-        result_meta,
-        data_type="class",
-        suffix=suffix,
-        use_suffix=use_suffix,
-    )
-    result_meta, tag_mapping = _merge(
-        result_meta,
-        data_type="tag",
-        suffix=suffix,
-        use_suffix=use_suffix,
-    )
+    new_classes, class_mapping = _merge(data_type="class", suffix=suffix, use_suffix=use_suffix)
+    new_tag_metas, tag_mapping = _merge(data_type="tag", suffix=suffix, use_suffix=use_suffix)
+
+    # Adding all new items at once, each add_* call copies the whole meta.
+    result_meta = project_meta
+    if len(new_classes) > 0:
+        result_meta = result_meta.add_obj_classes(new_classes)
+    if len(new_tag_metas) > 0:
+        result_meta = result_meta.add_tag_metas(new_tag_metas)
     return result_meta, class_mapping, tag_mapping
 
 
+def _get_name_index(
+    version: str,
+    data_type: str,
+    collection: Union[sly.ObjClassCollection, sly.TagMetaCollection],
+    suffix: str,
+) -> Dict[str, Dict[int, Union[sly.ObjClass, sly.TagMeta]]]:
+    key = (version, data_type, suffix)
+    with _merge_cache_lock:
+        name_index = _name_indexes.get(key)
+        if name_index is not None:
+            _name_indexes.move_to_end(key)
+            return name_index
+    name_index = build_name_index(collection, suffix)
+    with _merge_cache_lock:
+        _name_indexes[key] = name_index
+        while len(_name_indexes) > MERGE_CACHE_SIZE:
+            _name_indexes.popitem(last=False)
+    return name_index
+
+
+def build_name_index(
+    collection: Union[sly.ObjClassCollection, sly.TagMetaCollection], suffix: str
+) -> Dict[str, Dict[int, Union[sly.ObjClass, sly.TagMeta]]]:
+    """Groups the items of the collection by the names they could be generated from with
+    `generate_res_name`: `{"name": {-1: <name>, 0: <name-suffix>, 1: <name-suffix-1>, ...}}`.
+    Each item is also indexed by its own name at position -1.
+
+    :param collection: Collection of the project classes or tags.
+    :type collection: Union[sly.ObjClassCollection, sly.TagMetaCollection]
+    :param suffix: Suffix added to the names of the model classes and tags.
+    :type suffix: str
+    :return: Items by the name and the position of the suffix.
+    :rtype: Dict[str, Dict[int, Union[sly.ObjClass, sly.TagMeta]]]
+    """
+    pattern = re.compile(rf"^(.*)-{re.escape(suffix)}(?:-([1-9][0-9]*))?$", re.DOTALL)
+    name_index = {}
+    for existing_item in collection:
+        name_index.setdefault(existing_item.name, {})[-1] = existing_item
+        match = pattern.match(existing_item.name)
+        if match is not None:
+            position = int(match.group(2)) if match.group(2) is not None else 0
+            name_index.setdefault(match.group(1), {})[position] = existing_item
+    return name_index
+
+
 def find_item(
     collection: Union[sly.ObjClassCollection, sly.TagMetaCollection],
     item: Union[sly.ObjClass, sly.TagMeta],
     suffix: str,
     use_suffix: bool,
+    name_index: Optional[Dict[str, Dict[int, Union[sly.ObjClass, sly.TagMeta]]]] = None,
 ) -> Tuple[Union[sly.ObjClass, sly.TagMeta], str]:
     """Finds an item in the collection and returns it or generates a new name for the item.
+    The item is searched by its name, then by the names with the suffix in the order of `generate_res_name`
+    while the existing items with these names are different from the item.
 
     :param collection: Collection to search in.
     :type collection: Union[sly.ObjClassCollection, sly.TagMetaCollection]
     :param item: Item to find.
     :type item: Union[sly.ObjClass, sly.TagMeta]
+    :param suffix: Suffix to add to the name.
+    :type suffix: str
+    :param use_suffix: Always use the suffix for the model items.
+    :type use_suffix: bool
+    :param name_index: Index of the collection built with `build_name_index`.
+    :type name_index: Dict[str, Dict[int, Union[sly.ObjClass, sly.TagMeta]]], optional
     :return: Found item, new name for the item.
     :rtype: Tuple[Union[sly.ObjClass, sly.TagMeta], str]
     """
-    index = 0
-    res_name = item.name.strip()
+    if name_index is None:
+        name_index = build_name_index(collection, suffix)
+    base_name = item.name.strip()
+    suffixed = name_index.get(item.name, {})
+
+    def _get(position: int) -> Optional[Union[sly.ObjClass, sly.TagMeta]]:
+        if position == -1:
+            return name_index.get(base_name, {}).get(-1)
+        return suffixed.get(position)
+
+    def _name(position: int) -> str:
+        return base_name if position == -1 else generate_res_name(item, suffix, position)
+
+    position = -1
     while True:
-        existing_item = collection.get(res_name.strip())
+        existing_item = _get(position)
         if existing_item is None:
             if use_suffix is True:
-                res_name = generate_res_name(item, suffix, index)
-                existing_item = collection.get(res_name)
+                existing_item = _get(position + 1)
                 if existing_item is not None:
                     return existing_item, None
-            return None, res_name
-        else:
-            if existing_item == item.clone(name=res_name):
-                if use_suffix is True:
-                    res_name = generate_res_name(item, suffix, index)
-                    existing_item = collection.get(res_name)
-                    if existing_item is None:
-                        return None, res_name
-                    elif existing_item == item.clone(name=res_name):
-                        res_name = generate_res_name(item, suffix, index)
-                        existing_item = collection.get(res_name)
-                        if existing_item is None:
-                            return None, res_name
-                        return existing_item, None
-                    else:
-                        index += 1
-                        res_name = generate_res_name(item, suffix, index)
-                        existing_item = collection.get(res_name)
-                        if existing_item is None:
-                            return None, res_name
-                return existing_item, None
-            else:
-                if type(existing_item) == sly.ObjClass:
-                    if existing_item.name == res_name:
-                        if existing_item.geometry_type != item.geometry_type:
-                            sly.logger.warning(
-                                f"Class {res_name} with different geometry type already exists in the project. "
-                                "Suffix will be added to the class name."
-                            )
-                res_name = generate_res_name(item, suffix, index)
-                index += 1
+                return None, _name(position + 1)
+            return None, _name(position)
+        if is_same_item(existing_item, item):
+            if use_suffix is True:
+                next_item = _get(position + 1)
+                if next_item is None:
+                    return None, _name(position + 1)
+                if is_same_item(next_item, item):
+                    return next_item, None
+                next_item = _get(position + 2)
+                if next_item is None:
+                    return None, _name(position + 2)
+                return next_item, None
+            return existing_item, None
+        if type(existing_item) == sly.ObjClass:
+            if existing_item.geometry_type != item.geometry_type:
+                sly.logger.warning(
+                    f"Class {_name(position)} with different geometry type already exists in the project. "
+                    "Suffix will be added to the class name."
+                )
+        position += 1
+
+
+def is_same_item(
+    existing_item: Union[sly.ObjClass, sly.TagMeta], item: Union[sly.ObjClass, sly.TagMeta]
+) -> bool:
+    """Checks that the items are equal ignoring their names.
+    Same as `existing_item == item.clone(name=existing_item.name)` but without cloning the item.
+
+    :param existing_item: Item from the project collection.
+    :type existing_item: Union[sly.ObjClass, sly.TagMeta]
+    :param item: Item from the model collection.
+    :type item: Union[sly.ObjClass, sly.TagMeta]
+    :return: True if the items are equal, False otherwise.
+    :rtype: bool
+    """
+    if isinstance(item, sly.ObjClass):
+        return (
+            isinstance(existing_item, sly.ObjClass)
+            and (
+                existing_item.geometry_type == item.geometry_type
+                or sly.AnyGeometry in [existing_item.geometry_type, item.geometry_type]
+            )
+            and existing_item.geometry_config == item.geometry_config
+        )
+    return (
+        isinstance(existing_item, sly.TagMeta)
+        and existing_item.value_type == item.value_type
+        and existing_item.possible_values == item.possible_values
+    )
 
 
 def generate_res_name(item: Union[sly.ObjClass, sly.TagMeta], suffix: str, index: int) -> str:
@@ -0,0 +1,271 @@
+import json
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+import cv2
+import numpy as np
+import supervisely as sly
+from supervisely.geometry.constants import BITMAP, DATA, GEOMETRY_SHAPE, GEOMETRY_TYPE, ORIGIN
+from supervisely.geometry.geometry import Geometry
+from supervisely.geometry.point_location import row_col_list_to_points
+
+from src.mask_pool import encode_mask, encode_masks
+
+# Model metas with bitmap classes replaced by polygon classes, the same object is returned for
+# the same model meta, so that the memoized meta merging keeps working.
+_polygon_metas = {}
+_polygon_metas_lock = threading.Lock()
+
+# Sizes of the geometries before and after the optimization are measured for one of this many
+# changed geometries of a frame: serializing every original mask would cost as much as the upload.
+GEOMETRY_SIZE_SAMPLE_RATE = 16
+
+
+@dataclass(frozen=True)
+class GeometrySettings:
+    """Geometry optimization applied to the predictions before the upload.
+
+    :param min_area: Labels and mask fragments with a smaller area in pixels are removed.
+    :type min_area: int
+    :param masks_to_polygons: Convert bitmap masks to polygons.
+    :type masks_to_polygons: bool
+    :param simplify_polygons: Simplify polygons predicted by the model.
+    :type simplify_polygons: bool
+    :param tolerance: Maximum distance in pixels between the original and the simplified contour.
+    :type tolerance: float
+    """
+
+    min_area: int = 0
+    masks_to_polygons: bool = False
+    simplify_polygons: bool = False
+    tolerance: float = 1.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_area > 0 or self.masks_to_polygons or self.simplify_polygons
+
+
+@dataclass
+class GeometryStats:
+    """Statistics of the geometry optimization of a frame. Payload sizes are measured for a sample
+    of the changed geometries (see `GEOMETRY_SIZE_SAMPLE_RATE`), the size of the whole uploaded payload
+    is measured by the upload.
+    """
+
+    removed: int = 0
+    converted: int = 0
+    simplified: int = 0
+    # Pixels of the converted masks and points of the polygons they were converted to.
+    mask_pixels: int = 0
+    converted_points: int = 0
+    # Points of the simplified polygons before and after the simplification.
+    points_before: int = 0
+    points_after: int = 0
+    # Changed geometries and the JSON sizes of the sampled ones before and after the optimization.
+    changed: int = 0
+    sampled: int = 0
+    sampled_bytes_before: int = 0
+    sampled_bytes_after: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.removed} removed, {self.converted} masks converted ({self.mask_pixels} px -> "
+            f"{self.converted_points} points), {self.simplified} polygons simplified "
+            f"({self.points_before} -> {self.points_after} points), "
+            f"{self.sampled_bytes_before} -> {self.sampled_bytes_after} bytes "
+            f"in {self.sampled} of {self.changed} changed geometries"
+        )
+
+
+def _bitmap_json(bitmap: sly.Bitmap, data: str) -> Dict:
+    return {
+        BITMAP: {
+            ORIGIN: [bitmap.origin.col, bitmap.origin.row],
+            DATA: data,
+        },
+        GEOMETRY_SHAPE: BITMAP,
+        GEOMETRY_TYPE: BITMAP,
+    }
+
+
+def geometry_to_json(geometry: Geometry) -> Dict:
+    """Serializes the geometry for the upload, bitmaps are encoded with `encode_mask`.
+
+    :param geometry: Geometry of the label.
+    :type geometry: Geometry
+    :return: Geometry JSON.
+    :rtype: Dict
+    """
+    if type(geometry) is not sly.Bitmap:
+        return geometry.to_json()
+    return _bitmap_json(geometry, encode_mask(geometry.data))
+
+
+def geometries_to_json(geometries: List[Geometry]) -> Iterator[Dict]:
+    """Serializes the geometries like `geometry_to_json`, large masks are encoded
+    in parallel in the worker processes.
+
+    :param geometries: Geometries of the labels.
+    :type geometries: List[Geometry]
+    :return: Iterator over the geometry JSONs in the order of the geometries.
+    :rtype: Iterator[Dict]
+    """
+    bitmaps = [geometry for geometry in geometries if type(geometry) is sly.Bitmap]
+    encoded = encode_masks([bitmap.data for bitmap in bitmaps])
+    try:
+        for geometry in geometries:
+            if type(geometry) is sly.Bitmap:
+                yield _bitmap_json(geometry, next(encoded))
+            else:
+                yield geometry.to_json()
+    finally:
+        encoded.close()
+
+
+def geometry_size(geometry: Geometry) -> int:
+    return len(json.dumps(geometry_to_json(geometry)))
+
+
+def polygon_points(polygon: sly.Polygon) -> int:
+    return len(polygon.exterior_np) + sum(len(ring) for ring in polygon.interior_np)
+
+
+def remove_redundant_points(ring: np.ndarray) -> np.ndarray:
+    """Removes repeated points and points lying on a straight segment between their neighbours.
+    The shape of the ring doesn't change.
+
+    :param ring: Points of a closed ring with shape (N, 2).
+    :type ring: np.ndarray
+    :return: Points of the ring.
+    :rtype: np.ndarray
+    """
+    ring = ring[np.any(ring != np.roll(ring, 1, axis=0), axis=1)]
+    if len(ring) < 3:
+        return ring
+    to_prev = np.roll(ring, 1, axis=0) - ring
+    to_next = np.roll(ring, -1, axis=0) - ring
+    cross = to_prev[:, 0] * to_next[:, 1] - to_prev[:, 1] * to_next[:, 0]
+    dot = (to_prev * to_next).sum(axis=1)
+    # A point is redundant if the neighbours are on the opposite sides of the same line,
+    # the tips of one pixel wide spikes (dot > 0) are kept.
+    return ring[(cross != 0) | (dot > 0)]
+
+
+def simplify_polygon(polygon: sly.Polygon, tolerance: float) -> sly.Polygon:
+    """Removes redundant points of the polygon and approximates its rings with the tolerance.
+
+    :param polygon: Polygon to simplify.
+    :type polygon: sly.Polygon
+    :param tolerance: Maximum distance in pixels between the original and the simplified contour.
+    :type tolerance: float
+    :return: Simplified polygon.
+    :rtype: sly.Polygon
+    """
+    exterior = remove_redundant_points(polygon.exterior_np)
+    if len(exterior) < 3:
+        return polygon
+    interior = [remove_redundant_points(ring) for ring in polygon.interior_np]
+    polygon = sly.Polygon(
+        row_col_list_to_points(exterior.tolist()),
+        [row_col_list_to_points(ring.tolist()) for ring in interior if len(ring) >= 3],
+    )
+    if tolerance > 0:
+        polygon = polygon.approx_dp(tolerance)
+    return polygon
+
+
+def remove_small_fragments(bitmap: sly.Bitmap, min_area: int) -> Optional[sly.Bitmap]:
+    """Removes connected components of the mask smaller than `min_area`,
+    the result is cropped to the remaining pixels.
+
+    :return: Bitmap without the small fragments or None if nothing remains.
+    :rtype: Optional[sly.Bitmap]
+    """
+    count, components, stats, _ = cv2.connectedComponentsWithStats(
+        bitmap.data.astype(np.uint8), connectivity=8
+    )
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    keep[0] = False  # background
+    if keep[1:].all():
+        return bitmap
+    if not keep.any():
+        return None
+    return sly.Bitmap(keep[components], origin=bitmap.origin)
+
+
+def optimize_geometry(
+    geometry: Geometry, settings: GeometrySettings, stats: GeometryStats
+) -> List[Geometry]:
+    """Applies the geometry optimization to the geometry of a label.
+    A mask can be converted to several polygons, one for each connected component.
+
+    :param geometry: Geometry of the label.
+    :type geometry: Geometry
+    :param settings: Optimization settings.
+    :type settings: GeometrySettings
+    :param stats: Statistics to update.
+    :type stats: GeometryStats
+    :return: Resulting geometries, empty if the geometry was removed.
+    :rtype: List[Geometry]
+    """
+    if settings.min_area > 0 and geometry.area < settings.min_area:
+        stats.removed += 1
+        return []
+
+    result = [geometry]
+    if type(geometry) is sly.Bitmap:
+        if settings.min_area > 0:
+            bitmap = remove_small_fragments(geometry, settings.min_area)
+            if bitmap is None:
+                stats.removed += 1
+                return []
+            result = [bitmap]
+        if settings.masks_to_polygons:
+            stats.mask_pixels += int(np.count_nonzero(result[0].data))
+            polygons = result[0].to_contours()
+            result = [simplify_polygon(polygon, settings.tolerance) for polygon in polygons]
+            if settings.min_area > 0:
+                result = [polygon for polygon in result if polygon.area >= settings.min_area]
+            stats.converted += 1
+            stats.converted_points += sum(polygon_points(polygon) for polygon in result)
+    elif type(geometry) is sly.Polygon and settings.simplify_polygons:
+        result = [simplify_polygon(geometry, settings.tolerance)]
+        stats.simplified += 1
+        stats.points_before += polygon_points(geometry)
+        stats.points_after += polygon_points(result[0])
+
+    if len(result) != 1 or result[0] is not geometry:
+        if stats.changed % GEOMETRY_SIZE_SAMPLE_RATE == 0:
+            stats.sampled += 1
+            stats.sampled_bytes_before += geometry_size(geometry)
+            stats.sampled_bytes_after += sum(geometry_size(item) for item in result)
+        stats.changed += 1
+    return result
+
+
+def polygon_meta(model_meta: sly.ProjectMeta) -> sly.ProjectMeta:
+    """Returns the model meta with bitmap classes replaced by polygon classes of the same names.
+    Used when the masks are converted to polygons, so that the polygon classes are added to the project.
+
+    :param model_meta: Model meta.
+    :type model_meta: sly.ProjectMeta
+    :return: Model meta with polygon classes.
+    :rtype: sly.ProjectMeta
+    """
+    with _polygon_metas_lock:
+        cached = _polygon_metas.get(id(model_meta))
+        if cached is not None and cached[0] is model_meta:
+            return cached[1]
+
+    obj_classes = []
+    for obj_class in model_meta.obj_classes:
+        if obj_class.geometry_type == sly.Bitmap:
+            obj_class = obj_class.clone(geometry_type=sly.Polygon)
+        obj_classes.append(obj_class)
+    result = model_meta.clone(obj_classes=sly.ObjClassCollection(obj_classes))
+    with _polygon_metas_lock:
+        # Model metas change only on reconnection, the old entries are not needed.
+        _polygon_metas.clear()
+        _polygon_metas[id(model_meta)] = (model_meta, result)
+    return result
@@ -3,35 +3,105 @@ import os
 import supervisely as sly
 from dotenv import load_dotenv
 
+from src.checkpoints import CheckpointStore
+from src.connection import SessionManager
+from src.jobs import JobQueue
+from src.meta_cache import ProjectMetaCache
+from src.metrics import Metrics
+from src.permissions import PermissionCache
+from src.prefetch import PredictionCache, Prefetcher
+from src.registry import FigureRegistry
+from src.state import StateStore
+from src.store import PredictionStore
+from src.tracking import ObjectIndexCache
+from src.transport import Transport, TransportSettings, create_api
+
 if sly.is_development():
     load_dotenv("local.env")
     load_dotenv(os.path.expanduser("~/supervisely.env"))
 
+# Stage latencies and counters of the apply pipeline, exposed on the /metrics route.
+# Set LOG_STAGE_TIMINGS=true to also write a structured log line for each stage.
+metrics = Metrics(log_spans=os.environ.get("LOG_STAGE_TIMINGS", "false").lower() in ["true", "1"])
+
+# Both API clients send the requests through one pool of keep-alive connections,
+# idempotent requests are retried with backoff on transient errors.
+transport = Transport(
+    TransportSettings(
+        pool_size=int(os.environ.get("API_POOL_SIZE", 16)),
+        max_concurrency=int(os.environ.get("API_MAX_CONCURRENCY", 8)),
+        retries=int(os.environ.get("API_RETRIES", 4)),
+    ),
+    metrics,
+)
+
 # Initializing global variables.
 spawn_api_token = sly.env.spawn_api_token()
-api = sly.Api.from_env()
-spawn_api = sly.Api(server_address=api.server_address, token=spawn_api_token)
 team_id = sly.env.team_id()
+api = create_api(transport)
+spawn_api = create_api(transport, server_address=api.server_address, token=spawn_api_token)
 
-is_my_labeling_job = False
-job_id = None
-allowed_classes = None
-allowed_tags = None
+# Each annotator (annotation tool session) has its own state: video, frame, labeling job, etc.
+states = StateStore()
 
-session_id = None
-video_id = None
-project_id = None
-frame = None
+# Labeling job permissions of the annotators, switching between jobs doesn't send requests.
+permission_cache = PermissionCache(
+    ttl=float(os.environ.get("PERMISSIONS_TTL", 300)),
+    refresh_after=float(os.environ.get("PERMISSIONS_REFRESH_AFTER", 60)),
+)
 
+# Apply requests are executed in the background, so that the request handler returns immediately.
+# Repeated clicks with the same settings within the window return the result of the first click.
+job_queue = JobQueue(dedup_window=float(os.environ.get("APPLY_DEDUP_WINDOW", 10)))
+
+# Model sessions are reused across clicks and revalidated only when their info gets stale.
+session_manager = SessionManager()
 session = None
 task_type = None
 model_session_id = None
 model_meta = None
 inference_settings = None
-selected_classes = None
-selected_tags = None
-suffix = None
-use_suffix = None
+# Additional models are queried together with the main one and their predictions are fused,
+# `model_meta` combines the classes and tags of all connected models.
+extra_model_session_ids = []
+model_metas = {}
+
+# We will cache project metas so that we do not have to download them every time,
+# the cache checks that the project wasn't changed by someone else before using the meta.
+project_meta_cache = ProjectMetaCache()
+
+# Predictions of the neighbouring frames are inferred in the background while the annotator
+# reviews the current frame, so that only the upload remains when "Apply" is pressed.
+prediction_cache = PredictionCache()
+prefetcher = Prefetcher(prediction_cache)
+
+# Raw predictions are also saved to disk, so that re-applying the same model to a frame
+# after a reconnect or a restart of the app costs only the postprocessing and the upload.
+prediction_store = PredictionStore(
+    os.environ.get(
+        "PREDICTION_STORE_PATH", os.path.join(sly.app.get_data_dir(), "predictions.sqlite")
+    ),
+    max_bytes=int(os.environ.get("PREDICTION_STORE_MAX_MB", 1024)) * 1024 * 1024,
+)
+
+# Progress of the whole-video labeling, so that an interrupted job continues where it stopped.
+checkpoints = CheckpointStore(
+    os.environ.get("CHECKPOINTS_DIR", os.path.join(sly.app.get_data_dir(), "checkpoints"))
+)
+
+# Figures created for each frame by each set of models, so that the next predictions
+# of the same models on the frame replace them with only the changes.
+figure_registry = FigureRegistry(int(os.environ.get("FIGURE_REGISTRY_FRAMES", 10000)))
+
+# Figures of the recently labeled videos for the cross-frame association, updated with the uploads
+# of the app, so that a click doesn't list all figures of the video.
+object_index_cache = ObjectIndexCache(ttl=float(os.environ.get("OBJECT_INDEX_TTL", 60)))
 
-# We will store project meta in a dictionary so that we do not have to download it every time.
-project_metas = {}
+metrics.register_gauges("prediction_cache", prediction_cache.stats)
+metrics.register_gauges("prediction_store", prediction_store.stats)
+metrics.register_gauges("project_meta_cache", project_meta_cache.stats)
+metrics.register_gauges("api_transport", transport.stats)
+metrics.register_gauges("job_queue", job_queue.stats)
+metrics.register_gauges("figure_registry", figure_registry.stats)
+metrics.register_gauges("object_index_cache", object_index_cache.stats)
+metrics.register_gauges("permission_cache", permission_cache.stats)
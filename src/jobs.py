@@ -0,0 +1,233 @@
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Hashable, List, Optional
+
+import supervisely as sly
+
+
+class JobCancelled(Exception):
+    """Raised inside the job when it was cancelled by the user."""
+
+
+class Job:
+    """Apply request executed in the background.
+
+    :param video_id: Video id, jobs for the same video are executed in the order of submission.
+    :type video_id: int
+    :param func: Function to execute, it receives the job to report progress and check cancellation.
+    :type func: Callable[[Job], None]
+    :param kind: Kind of the job: "apply" for clicks, "video" or "dataset" for pre-labeling.
+    :type kind: str
+    :param key: Jobs with the same key are executed one after another, the video id by default.
+    :type key: Hashable, optional
+    :param idempotency_key: Requests with the same idempotency key are merged into this job.
+    :type idempotency_key: Hashable, optional
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(
+        self,
+        video_id: Optional[int],
+        func: Callable[["Job"], None],
+        kind: str = "apply",
+        key: Optional[Hashable] = None,
+        idempotency_key: Optional[Hashable] = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.video_id = video_id
+        self.func = func
+        self.kind = kind
+        self.key = key if key is not None else video_id
+        self.idempotency_key = idempotency_key
+        # Number of repeated requests that were merged into the job.
+        self.coalesced = 0
+        self.status = Job.QUEUED
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.total = 0
+        self.inferred = 0
+        self.postprocessed = 0
+        self.uploaded = 0
+        # Near-duplicate frames that were not inferred and not uploaded.
+        self.skipped = 0
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in [Job.DONE, Job.FAILED, Job.CANCELLED]
+
+    @property
+    def fps(self) -> float:
+        """Processed (uploaded or skipped) frames per second since the job was started."""
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return (self.uploaded + self.skipped) / elapsed if elapsed > 0 else 0.0
+
+    def cancel(self) -> None:
+        self._cancel_event.set()
+
+    def check_cancelled(self) -> None:
+        """Raises JobCancelled if the job was cancelled, call it between the stages of the job."""
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.id} was cancelled.")
+
+    def to_json(self) -> Dict:
+        return {
+            "id": self.id,
+            "videoId": self.video_id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "inferred": self.inferred,
+            "postprocessed": self.postprocessed,
+            "uploaded": self.uploaded,
+            "skipped": self.skipped,
+            "fps": round(self.fps, 2),
+            "coalesced": self.coalesced,
+        }
+
+
+class JobQueue:
+    """Executes jobs in a worker pool. Jobs for different videos (keys) run concurrently,
+    jobs for the same video run one after another in the order of submission.
+
+    :param max_workers: Number of worker threads.
+    :type max_workers: int
+    :param keep_finished: Number of finished jobs to keep for status requests.
+    :type keep_finished: int
+    :param dedup_window: Seconds during which a repeated request returns the finished job
+        with the same idempotency key instead of running again.
+    :type dedup_window: float
+    """
+
+    def __init__(self, max_workers: int = 4, keep_finished: int = 100, dedup_window: float = 10.0):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="apply")
+        self._keep_finished = keep_finished
+        self.dedup_window = dedup_window
+        self.coalesced = 0
+        self._jobs: Dict[str, Job] = {}
+        self._idempotent_jobs: Dict[Hashable, Job] = {}
+        self._finished: Deque[str] = deque()
+        self._video_queues: Dict[int, Deque[Job]] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        video_id: Optional[int],
+        func: Callable[[Job], None],
+        kind: str = "apply",
+        key: Optional[Hashable] = None,
+        idempotency_key: Optional[Hashable] = None,
+    ) -> Job:
+        """Adds the job to the queue and returns it immediately.
+        If a job with the same idempotency key is queued, running or has succeeded within
+        the dedup window, that job is returned instead and the function is not executed.
+        """
+        with self._lock:
+            if idempotency_key is not None:
+                existing = self._idempotent_jobs.get(idempotency_key)
+                if existing is not None and self._is_reusable(existing):
+                    existing.coalesced += 1
+                    self.coalesced += 1
+                    sly.logger.info(f"Repeated request was merged into job {existing.id}.")
+                    return existing
+            job = Job(video_id, func, kind, key, idempotency_key)
+            if idempotency_key is not None:
+                self._idempotent_jobs[idempotency_key] = job
+            self._jobs[job.id] = job
+            video_queue = self._video_queues.setdefault(job.key, deque())
+            video_queue.append(job)
+            if len(video_queue) == 1:
+                self._executor.submit(self._run, job)
+        sly.logger.info(f"Job {job.id} ({kind}) for {job.key} was queued.")
+        return job
+
+    def _is_reusable(self, job: Job) -> bool:
+        if not job.finished:
+            return not job.cancelled
+        finished_at = job.finished_at
+        if job.status != Job.DONE or finished_at is None:
+            return False
+        return time.time() - finished_at < self.dedup_window
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            "queued": sum(job.status == Job.QUEUED for job in jobs),
+            "running": sum(job.status == Job.RUNNING for job in jobs),
+            "coalesced": self.coalesced,
+        }
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancels the job. A queued job is skipped, a running job stops at the next stage."""
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel()
+            sly.logger.info(f"Job {job_id} will be cancelled.")
+        return job
+
+    def _run(self, job: Job) -> None:
+        status = Job.FAILED
+        try:
+            job.check_cancelled()
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+            job.func(job)
+            status = Job.DONE
+        except JobCancelled:
+            status = Job.CANCELLED
+        except Exception as e:
+            sly.logger.warning(f"Job {job.id} failed", exc_info=True)
+            job.error = repr(e)
+        finally:
+            # The finish time is set before the terminal status is published,
+            # a concurrent `submit` reads it as soon as the job is finished.
+            job.finished_at = time.time()
+            job.status = status
+            self._on_finished(job)
+
+    def _on_finished(self, job: Job) -> None:
+        with self._lock:
+            video_queue = self._video_queues[job.key]
+            video_queue.popleft()
+            if len(video_queue) > 0:
+                self._executor.submit(self._run, video_queue[0])
+            else:
+                del self._video_queues[job.key]
+
+            if job.idempotency_key is not None and job.status != Job.DONE:
+                # Failed and cancelled requests can be repeated.
+                if self._idempotent_jobs.get(job.idempotency_key) is job:
+                    del self._idempotent_jobs[job.idempotency_key]
+
+            self._finished.append(job.id)
+            while len(self._finished) > self._keep_finished:
+                old_job = self._jobs.pop(self._finished.popleft(), None)
+                if old_job is not None and old_job.idempotency_key is not None:
+                    if self._idempotent_jobs.get(old_job.idempotency_key) is old_job:
+                        del self._idempotent_jobs[old_job.idempotency_key]
@@ -1,16 +1,45 @@
+import threading
+from typing import Optional
+
 import supervisely as sly
 import supervisely.app.development as sly_app_development
-from fastapi import Request
+from fastapi import HTTPException, Request
+from fastapi.responses import PlainTextResponse
 from supervisely.api.module_api import ApiField
 from supervisely.app.widgets import Button, Container
 
 import src.globals as g
-from src.ui import apply_button, apply_button_clicked, error_text, ui_content
+from src.mask_pool import start_pool
+from src.state import AnnotatorState
+from src.ui import (
+    apply_button,
+    apply_button_clicked,
+    error_text,
+    label_dataset_button,
+    label_video_button,
+    prelabel_clicked,
+    ui_content,
+)
+from src.upload import get_video_info
 
 layout = Container(widgets=[ui_content])
 app = sly.Application(layout=layout)
 server = app.get_server()
 
+
+def start_mask_pool() -> None:
+    try:
+        start_pool()
+    except Exception as e:
+        sly.logger.warning(
+            f"Mask encoding workers weren't started, masks are encoded in the app process: {repr(e)}"
+        )
+
+
+# The mask encoding workers take a few seconds to spawn, they are started in the background,
+# so that neither the startup nor the first click waits for them.
+threading.Thread(target=start_mask_pool, name="mask-pool", daemon=True).start()
+
 # Enabling advanced debug mode.
 if sly.is_development():
     sly_app_development.supervisely_vpn_network(action="up")
@@ -21,66 +50,146 @@ if sly.is_development():
 @app.event(sly.Event.ManualSelected.VideoChanged)
 def video_changed(event_api: sly.Api, event: sly.Event.ManualSelected.VideoChanged):
     sly.logger.info("Current video was changed")
-    # Saving the event parameters to global variables.
-    g.api = event_api
-    g.team_id = event.team_id
-    g.session_id = event.session_id
-    g.video_id = event.video_id
-    g.project_id = event.project_id
-    g.frame = event.frame
+    # Saving the event parameters to the state of the annotator.
+    state = g.states.get(event.session_id)
+    with state.lock:
+        state.api = event_api
+        state.team_id = event.team_id
+        state.video_id = event.video_id
+        state.project_id = event.project_id
+        state.frame = event.frame
+
+    g.project_meta_cache.get(event_api, event.project_id)
 
-    if event.project_id not in g.project_metas:
-        project_meta = sly.ProjectMeta.from_json(g.api.project.get_meta(event.project_id))
-        g.project_metas[event.project_id] = project_meta
+    session = g.session
+    # The prefetched predictions are not used when several models are connected.
+    if g.prefetcher.enabled and session is not None and len(g.extra_model_session_ids) == 0:
+        video_frames_count = get_video_info(event_api, event.video_id).frames_count
+        g.prefetcher.schedule(session, event.video_id, event.frame, video_frames_count)
 
 
 apply_button._click_handled = True
 
 
+def update_labeling_job(state: AnnotatorState, job_id: Optional[int]) -> None:
+    """Checks if the labeling job from the context is assigned to the annotator
+    and saves the allowed classes and tags to the state.
+    Permissions are cached, so switching between the jobs doesn't send requests.
+    """
+    api = state.api or g.api
+    if job_id is None:
+        error_text.hide()
+        state.job_id = None
+        state.is_my_labeling_job = False
+        return
+    permissions = g.permission_cache.get(api, g.spawn_api, job_id)
+    if permissions is None:
+        sly.logger.warning("Can't get annotator user info.")
+        state.job_id = None
+        state.is_my_labeling_job = False
+    elif permissions.assigned:
+        if state.job_id != job_id or not state.is_my_labeling_job:
+            error_text.set(
+                "Labeling job detected. Some classes and tags can be restricted.", status="info"
+            )
+            error_text.show()
+        state.is_my_labeling_job = True
+        state.allowed_classes = permissions.allowed_classes
+        state.allowed_tags = permissions.allowed_tags
+        state.job_id = job_id
+    else:
+        state.job_id = None
+        state.is_my_labeling_job = False
+        error_text.set("", status="warning")
+        error_text.hide()
+
+
 # * reimplementing the click event of the apply button to get the frame index from the context
 @server.post(apply_button.get_route_path(Button.Routes.CLICK))
 def apply_button_click(request: Request):
     state = request.get("state")
     if state:
         context = state.get("context")
-        job_id = context.get("jobId")
-        g.is_my_labeling_job = False
-        if job_id is None:
-            error_text.hide()
-            g.job_id = None
-            g.is_my_labeling_job = False
-        elif g.job_id != job_id:
-            me = g.api.user.get_my_info()
-            lableing_job = g.spawn_api.labeling_job.get_info_by_id(job_id)
-            if not me:
-                sly.logger.warning("Can't get annotator user info.")
-                g.job_id = None
-            elif me.id == lableing_job.assigned_to_id:
-                g.is_my_labeling_job = True
-                g.allowed_classes = lableing_job.classes_to_label
-                g.allowed_tags = lableing_job.tags_to_label
-                g.job_id = job_id
-                error_text.set(
-                    "Labeling job detected. Some classes and tags can be restricted.", status="info"
-                )
-                error_text.show()
-            else:
-                g.job_id = None
-                g.is_my_labeling_job = False
-                error_text.set("", status="warning")
-                error_text.hide()
-        else:
-            g.is_my_labeling_job = True
-
-        frame = context.get("frame")
-        g.project_id = context.get("projectId", g.project_id)
-        g.video_id = context.get("entityId", g.video_id)
-        g.session_id = context.get("sessionId", g.session_id)
-
-        if g.project_id:
-            if g.project_id not in g.project_metas:
-                project_meta = sly.ProjectMeta.from_json(g.api.project.get_meta(g.project_id))
-                g.project_metas[g.project_id] = project_meta
+        session_id = context.get("sessionId")
+        annotator_state = g.states.get(session_id)
+        with annotator_state.lock:
+            update_labeling_job(annotator_state, context.get("jobId"))
+            frame = context.get("frame")
+            annotator_state.project_id = context.get("projectId", annotator_state.project_id)
+            annotator_state.video_id = context.get("entityId", annotator_state.video_id)
+            if frame is not None:
+                annotator_state.frame = frame
+            api = annotator_state.api or g.api
+            project_id = annotator_state.project_id
+
+        if project_id:
+            g.project_meta_cache.get(api, project_id)
         if frame is not None:
-            g.frame = frame
-            apply_button_clicked()
+            job = apply_button_clicked(annotator_state)
+            if job is not None:
+                return job.to_json()
+
+
+label_video_button._click_handled = True
+label_dataset_button._click_handled = True
+
+
+def get_context_state(request: Request) -> Optional[AnnotatorState]:
+    """Updates the annotator state from the context of the request sent by the labeling tool."""
+    state = request.get("state")
+    if not state:
+        return None
+    context = state.get("context")
+    annotator_state = g.states.get(context.get("sessionId"))
+    with annotator_state.lock:
+        update_labeling_job(annotator_state, context.get("jobId"))
+        annotator_state.project_id = context.get("projectId", annotator_state.project_id)
+        annotator_state.video_id = context.get("entityId", annotator_state.video_id)
+    return annotator_state
+
+
+@server.post(label_video_button.get_route_path(Button.Routes.CLICK))
+def label_video_button_click(request: Request):
+    annotator_state = get_context_state(request)
+    if annotator_state is not None and annotator_state.video_id is not None:
+        job = prelabel_clicked(annotator_state)
+        if job is not None:
+            return job.to_json()
+
+
+@server.post(label_dataset_button.get_route_path(Button.Routes.CLICK))
+def label_dataset_button_click(request: Request):
+    annotator_state = get_context_state(request)
+    if annotator_state is not None and annotator_state.video_id is not None:
+        job = prelabel_clicked(annotator_state, whole_dataset=True)
+        if job is not None:
+            return job.to_json()
+
+
+@server.get("/apply-jobs")
+def list_apply_jobs():
+    return [job.to_json() for job in g.job_queue.list()]
+
+
+@server.get("/apply-jobs/{job_id}")
+def get_apply_job(job_id: str):
+    job = g.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job.to_json()
+
+
+@server.post("/apply-jobs/{job_id}/cancel")
+def cancel_apply_job(job_id: str):
+    job = g.job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job.to_json()
+
+
+@server.get("/metrics")
+def get_metrics(format: str = "prometheus"):
+    """Stage latencies, counters and cache stats in Prometheus text format or as JSON."""
+    if format == "json":
+        return g.metrics.to_json()
+    return PlainTextResponse(g.metrics.to_prometheus())
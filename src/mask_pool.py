@@ -0,0 +1,139 @@
+import base64
+import io
+import os
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context, shared_memory
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Number of worker processes encoding the masks, 0 to encode in the calling thread.
+# The workers import only this module, so they start without loading the Supervisely SDK.
+MASK_WORKERS = int(os.environ.get("MASK_WORKERS", min(8, os.cpu_count() or 1)))
+# Smaller masks are encoded in the calling thread, sending them to a worker costs more.
+MIN_POOL_PIXELS = 256 * 256
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+# Set when the worker processes of the current pool have started, until then the masks are encoded
+# in the calling thread, so that a click doesn't wait for the processes to spawn.
+_executor_ready = threading.Event()
+
+
+def encode_mask(mask: np.ndarray) -> str:
+    """Encodes the mask in the format of `sly.Bitmap.data_2_base64` with the maximum PNG compression.
+
+    :param mask: Boolean mask.
+    :type mask: np.ndarray
+    :return: Base64 encoded string.
+    :rtype: str
+    """
+    image = Image.fromarray(mask.astype(np.uint8))
+    image.putpalette([0, 0, 0, 255, 255, 255])
+    bytes_io = io.BytesIO()
+    image.save(bytes_io, format="PNG", transparency=0, optimize=True)
+    return base64.b64encode(zlib.compress(bytes_io.getvalue())).decode("utf-8")
+
+
+def _encode_shared(name: str, offset: int, shape: Tuple[int, int]) -> str:
+    """Encodes the mask stored in the shared memory block, runs in a worker process."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        mask = np.ndarray(shape, dtype=np.bool_, buffer=block.buf, offset=offset)
+        encoded = encode_mask(mask)
+        # The block can't be closed while an array references its buffer.
+        del mask
+        return encoded
+    finally:
+        block.close()
+
+
+def start_pool() -> None:
+    """Starts the worker processes and waits until they are ready. Called in a background thread
+    at the app startup and after a worker has died. Does nothing if the pool is disabled
+    or is already started.
+    """
+    global _executor
+    if MASK_WORKERS <= 0:
+        return
+    with _executor_lock:
+        if _executor is not None:
+            return
+        # Forking a process with running threads can deadlock the child.
+        executor = ProcessPoolExecutor(MASK_WORKERS, mp_context=get_context("spawn"))
+        _executor = executor
+    # The processes are spawned on submit, a worker is ready after it has imported this module.
+    wait([executor.submit(os.getpid) for _ in range(MASK_WORKERS)])
+    with _executor_lock:
+        if _executor is executor:
+            _executor_ready.set()
+
+
+def _get_executor() -> Optional[ProcessPoolExecutor]:
+    """Returns the worker pool if its processes have started."""
+    with _executor_lock:
+        return _executor if _executor_ready.is_set() else None
+
+
+def _reset_executor(executor: ProcessPoolExecutor) -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not executor:
+            return
+        _executor = None
+        _executor_ready.clear()
+    executor.shutdown(wait=False, cancel_futures=True)
+    # The masks are encoded in the calling threads until the new workers have started.
+    threading.Thread(target=start_pool, name="mask-pool", daemon=True).start()
+
+
+def encode_masks(masks: List[np.ndarray]) -> Iterator[str]:
+    """Encodes the masks with `encode_mask`, the large ones in parallel in the worker processes.
+    The large masks are copied once into a shared memory block that the workers read directly,
+    instead of pickling each mask. The results are yielded in the order of the masks as soon
+    as they are ready, the small masks are encoded in the calling thread meanwhile.
+
+    :param masks: Boolean masks.
+    :type masks: List[np.ndarray]
+    :return: Iterator over the base64 encoded masks.
+    :rtype: Iterator[str]
+    """
+    executor = _get_executor()
+    large = [i for i, mask in enumerate(masks) if mask.size >= MIN_POOL_PIXELS]
+    if executor is None or len(large) == 0:
+        for mask in masks:
+            yield encode_mask(mask)
+        return
+
+    block = shared_memory.SharedMemory(create=True, size=sum(masks[i].size for i in large))
+    futures = {}
+    try:
+        offset = 0
+        for i in large:
+            view = np.ndarray(masks[i].shape, dtype=np.bool_, buffer=block.buf, offset=offset)
+            view[...] = masks[i]
+            del view
+            futures[i] = executor.submit(_encode_shared, block.name, offset, masks[i].shape)
+            offset += masks[i].size
+        for i, mask in enumerate(masks):
+            future = futures.get(i)
+            if future is None:
+                yield encode_mask(mask)
+                continue
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                # A killed worker breaks the whole pool, a new one is started in the background.
+                _reset_executor(executor)
+                yield encode_mask(mask)
+    finally:
+        # The consumer may stop early, the workers must not attach to the removed block.
+        for future in futures.values():
+            future.cancel()
+        wait(futures.values())
+        block.close()
+        block.unlink()
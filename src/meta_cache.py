@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import supervisely as sly
+
+
+@dataclass
+class MetaEntry:
+    """Cached project meta with its version (`updated_at` of the project) and the check time."""
+
+    meta: sly.ProjectMeta
+    version: Optional[str]
+    checked_at: float
+    size: int
+
+
+class ProjectMetaCache:
+    """Thread-safe LRU cache of project metas limited by the number of projects.
+    Before an entry is used, its freshness is checked: if it was checked more than `ttl` seconds ago,
+    the `updated_at` field of the project is compared with the cached version (one light request),
+    and the meta is downloaded again only if the project has changed.
+
+    :param max_entries: Maximum number of cached project metas.
+    :type max_entries: int
+    :param ttl: Time in seconds during which the entry is used without checks.
+    :type ttl: float
+    """
+
+    def __init__(self, max_entries: int = 64, ttl: float = 30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, MetaEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    def get(self, api: sly.Api, project_id: int) -> sly.ProjectMeta:
+        """Returns the project meta, downloading it if it isn't cached or is outdated.
+
+        :param api: Supervisely API.
+        :type api: sly.Api
+        :param project_id: Project id.
+        :type project_id: int
+        :return: Project meta.
+        :rtype: sly.ProjectMeta
+        """
+        with self._lock:
+            entry = self._entries.get(project_id)
+            if entry is not None:
+                self._entries.move_to_end(project_id)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return self._download(api, project_id)
+        if time.monotonic() - entry.checked_at < self.ttl:
+            with self._lock:
+                self.hits += 1
+            return entry.meta
+
+        version = api.project.get_info_by_id(project_id).updated_at
+        if entry.version is not None and entry.version != version:
+            sly.logger.info(
+                f"Project {project_id} has been changed, meta will be downloaded again."
+            )
+            with self._lock:
+                self.refreshes += 1
+            return self._download(api, project_id, version)
+        with self._lock:
+            self.hits += 1
+            entry.version = version
+            entry.checked_at = time.monotonic()
+        return entry.meta
+
+    def put(self, project_id: int, meta: sly.ProjectMeta, version: Optional[str] = None) -> None:
+        """Stores the project meta. Use it after the app has updated the meta itself:
+        without the version, the next freshness check accepts the server version as is.
+
+        :param project_id: Project id.
+        :type project_id: int
+        :param meta: Project meta.
+        :type meta: sly.ProjectMeta
+        :param version: Version of the meta (`updated_at` of the project).
+        :type version: str, optional
+        """
+        entry = MetaEntry(meta, version, time.monotonic(), len(json.dumps(meta.to_json())))
+        with self._lock:
+            self._entries[project_id] = entry
+            self._entries.move_to_end(project_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, project_id: int) -> None:
+        """Removes the project meta from the cache."""
+        with self._lock:
+            self._entries.pop(project_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests = self.hits + self.misses + self.refreshes
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(entry.size for entry in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+    def _download(
+        self, api: sly.Api, project_id: int, version: Optional[str] = None
+    ) -> sly.ProjectMeta:
+        if version is None:
+            version = api.project.get_info_by_id(project_id).updated_at
+        meta = sly.ProjectMeta.from_json(api.project.get_meta(project_id))
+        self.put(project_id, meta, version)
+        return meta
@@ -0,0 +1,117 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+import supervisely as sly
+
+# Upper bounds of the latency histogram buckets in seconds.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class Histogram:
+    """Latency histogram with cumulative buckets (Prometheus style)."""
+
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_json(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+        }
+
+
+class Metrics:
+    """Thread-safe collection of stage latencies and counters of the apply pipeline.
+
+    :param log_spans: Write a structured log line for each finished span.
+    :type log_spans: bool
+    """
+
+    def __init__(self, log_spans: bool = False):
+        self.log_spans = log_spans
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, **extra) -> Iterator[None]:
+        """Measures the duration of the stage, the time is recorded even if the stage fails."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(stage, duration)
+            if self.log_spans:
+                sly.logger.info(
+                    "Stage finished",
+                    extra={"stage": stage, "duration": round(duration, 6), **extra},
+                )
+
+    def observe(self, stage: str, duration: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(duration)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register_gauges(self, name: str, func: Callable[[], Dict[str, float]]) -> None:
+        """Registers a function returning current values, e.g. stats of a cache."""
+        with self._lock:
+            self._gauges[name] = func
+
+    def to_json(self) -> Dict:
+        with self._lock:
+            stages = {stage: h.to_json() for stage, h in self._histograms.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        return {
+            "stages": stages,
+            "counters": counters,
+            "gauges": {name: func() for name, func in gauges.items()},
+        }
+
+    def to_prometheus(self, prefix: str = "nn_video_labeling") -> str:
+        """Returns the metrics in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            histograms = {stage: h for stage, h in self._histograms.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+
+            name = f"{prefix}_stage_duration_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for stage, histogram in histograms.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        for counter, value in counters.items():
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            lines.append(f"{prefix}_{counter}_total {value}")
+        for gauge_name, func in gauges.items():
+            for key, value in func().items():
+                lines.append(f"# TYPE {prefix}_{gauge_name}_{key} gauge")
+                lines.append(f"{prefix}_{gauge_name}_{key} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+
+import supervisely as sly
+
+
+@dataclass(frozen=True)
+class JobPermissions:
+    """Classes and tags the annotator is allowed to label in the labeling job.
+
+    :param job_id: Labeling job id.
+    :type job_id: int
+    :param user_id: Id of the annotator.
+    :type user_id: int
+    :param assigned: The job is assigned to the annotator.
+    :type assigned: bool
+    :param allowed_classes: Names of the classes to label.
+    :type allowed_classes: FrozenSet[str]
+    :param allowed_tags: Names of the tags to label.
+    :type allowed_tags: FrozenSet[str]
+    """
+
+    job_id: int
+    user_id: int
+    assigned: bool
+    allowed_classes: FrozenSet[str]
+    allowed_tags: FrozenSet[str]
+
+
+class PermissionCache:
+    """Thread-safe LRU cache of the labeling job permissions keyed by (user id, job id).
+    The user of an API token is requested once. Permissions older than `refresh_after` seconds
+    are returned as is and reloaded in the background, permissions older than `ttl` seconds
+    are reloaded before they are returned, so switching between jobs doesn't send requests.
+
+    :param ttl: Time in seconds after which the permissions are not used without reloading.
+    :type ttl: float
+    :param refresh_after: Time in seconds after which the permissions are reloaded in the background.
+    :type refresh_after: float
+    :param max_entries: Maximum number of cached permissions and users.
+    :type max_entries: int
+    """
+
+    def __init__(self, ttl: float = 300, refresh_after: float = 60, max_entries: int = 1024):
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.max_entries = max_entries
+        self._users: "OrderedDict[str, int]" = OrderedDict()
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[JobPermissions, float]]" = OrderedDict()
+        self._refreshing: Set[Tuple[int, int]] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="permissions")
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, api: sly.Api, spawn_api: sly.Api, job_id: int) -> Optional[JobPermissions]:
+        """Returns the permissions of the annotator in the labeling job.
+
+        :param api: API of the annotator.
+        :type api: sly.Api
+        :param spawn_api: API with the access to the labeling job.
+        :type spawn_api: sly.Api
+        :param job_id: Labeling job id.
+        :type job_id: int
+        :return: Permissions or None if the annotator is unknown.
+        :rtype: Optional[JobPermissions]
+        """
+        user_id = self._get_user_id(api)
+        if user_id is None:
+            return None
+        key = (user_id, job_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            permissions, loaded_at = entry
+            age = time.monotonic() - loaded_at
+            if age < self.ttl:
+                with self._lock:
+                    self.hits += 1
+                if age >= self.refresh_after:
+                    self._schedule_refresh(spawn_api, key)
+                return permissions
+        with self._lock:
+            self.misses += 1
+        return self._load(spawn_api, key)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "users": len(self._users),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+    def _get_user_id(self, api: sly.Api) -> Optional[int]:
+        with self._lock:
+            user_id = self._users.get(api.token)
+            if user_id is not None:
+                self._users.move_to_end(api.token)
+                return user_id
+        me = api.user.get_my_info()
+        if not me:
+            return None
+        with self._lock:
+            self._users[api.token] = me.id
+            while len(self._users) > self.max_entries:
+                self._users.popitem(last=False)
+        return me.id
+
+    def _load(self, spawn_api: sly.Api, key: Tuple[int, int]) -> JobPermissions:
+        user_id, job_id = key
+        job = spawn_api.labeling_job.get_info_by_id(job_id)
+        permissions = JobPermissions(
+            job_id=job_id,
+            user_id=user_id,
+            assigned=job.assigned_to_id == user_id,
+            allowed_classes=frozenset(job.classes_to_label or []),
+            allowed_tags=frozenset(job.tags_to_label or []),
+        )
+        with self._lock:
+            self._entries[key] = (permissions, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return permissions
+
+    def _schedule_refresh(self, spawn_api: sly.Api, key: Tuple[int, int]) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self._executor.submit(self._refresh, spawn_api, key)
+
+    def _refresh(self, spawn_api: sly.Api, key: Tuple[int, int]) -> None:
+        try:
+            self._load(spawn_api, key)
+            with self._lock:
+                self.refreshes += 1
+        except Exception as e:
+            # The cached permissions are used until the TTL expires.
+            sly.logger.warning(f"Permissions of labeling job {key[1]} weren't refreshed: {repr(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import supervisely as sly
+
+# Cache key: (model session id, video id, frame index, inference settings hash).
+PredictionKey = Tuple[int, int, int, str]
+
+
+def settings_hash(inference_settings: Optional[Dict]) -> str:
+    """Returns a stable hash of the inference settings.
+
+    :param inference_settings: Inference settings of the model session.
+    :type inference_settings: Optional[Dict]
+    :return: Hash of the settings.
+    :rtype: str
+    """
+    dumped = json.dumps(inference_settings or {}, sort_keys=True, default=str)
+    return hashlib.md5(dumped.encode("utf-8")).hexdigest()
+
+
+def annotation_size(ann: sly.Annotation) -> int:
+    """Returns the approximate size of the annotation in memory (size of its JSON).
+
+    :param ann: Annotation.
+    :type ann: sly.Annotation
+    :return: Size in bytes.
+    :rtype: int
+    """
+    return len(json.dumps(ann.to_json()))
+
+
+class PredictionCache:
+    """Thread-safe LRU cache of raw model predictions limited by the total size of stored annotations.
+    Predictions are stored before postprocessing, so changing the selected classes and tags
+    doesn't invalidate them.
+
+    :param max_bytes: Maximum total size of the stored annotations.
+    :type max_bytes: int
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Hashable, Tuple[sly.Annotation, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[sly.Annotation]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, ann: sly.Annotation) -> None:
+        size = annotation_size(ann)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (ann, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+
+class Prefetcher:
+    """Infers the neighbouring frames in the background and stores the predictions in the cache.
+    Only the latest prefetch request is kept: when the annotator moves to another frame,
+    the pending requests for the previous position are cancelled.
+
+    :param cache: Cache to store predictions in.
+    :type cache: PredictionCache
+    """
+
+    def __init__(self, cache: PredictionCache):
+        self.cache = cache
+        self.frames_count = 0
+        # Single worker, so that prefetching doesn't compete with the annotator's clicks for the model.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._pending: Dict[PredictionKey, Future] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.frames_count > 0
+
+    def get_key(
+        self,
+        session: sly.nn.inference.Session,
+        video_id: int,
+        frame: int,
+        settings: Optional[str] = None,
+    ) -> PredictionKey:
+        """Returns the cache key of the prediction. `settings` is the hash of the inference settings
+        taken before the inference, the current settings of the session are used if it is None.
+        """
+        if settings is None:
+            settings = settings_hash(session.inference_settings)
+        return (session.task_id, video_id, frame, settings)
+
+    def get(
+        self,
+        session: sly.nn.inference.Session,
+        video_id: int,
+        frame: int,
+        settings: Optional[str] = None,
+    ) -> Optional[sly.Annotation]:
+        """Returns the cached prediction for the frame. If the frame is being prefetched right now,
+        waits for the result instead of sending a new request to the model.
+        """
+        key = self.get_key(session, video_id, frame, settings)
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None and not future.cancelled():
+            try:
+                future.result()
+            except Exception:
+                pass
+        return self.cache.get(key)
+
+    def schedule(
+        self,
+        session: sly.nn.inference.Session,
+        video_id: int,
+        frame: int,
+        video_frames_count: int,
+    ) -> None:
+        """Schedules inference of the frames around the current one."""
+        if not self.enabled or session is None:
+            return
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+
+            forward = list(range(frame + 1, min(frame + 1 + self.frames_count, video_frames_count)))
+            backward = list(range(frame - 1, max(frame - 1 - self.frames_count, -1), -1))
+            for direction, frames in (("forward", forward), ("backward", backward)):
+                keys = [self.get_key(session, video_id, index) for index in frames]
+                missing = [key for key in keys if key not in self.cache]
+                if len(missing) == 0:
+                    continue
+                future = self._executor.submit(
+                    self._prefetch, session, video_id, frames, keys, direction
+                )
+                for key in missing:
+                    self._pending[key] = future
+                future.add_done_callback(lambda future, keys=missing: self._forget(future, keys))
+
+    def _forget(self, future: Future, keys: List[PredictionKey]) -> None:
+        with self._lock:
+            for key in keys:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+
+    def _prefetch(
+        self,
+        session: sly.nn.inference.Session,
+        video_id: int,
+        frames: List[int],
+        keys: List[PredictionKey],
+        direction: str,
+    ) -> None:
+        # The keys were made when the prefetch was scheduled, the settings could be changed since.
+        settings = settings_hash(session.inference_settings)
+        if settings != keys[0][3]:
+            sly.logger.debug(
+                f"Inference settings were changed, frames {frames} are not prefetched."
+            )
+            return
+        try:
+            predictions_list = session.inference_video_id(
+                video_id,
+                start_frame_index=frames[0],
+                frames_count=len(frames),
+                frames_direction=direction,
+            )
+        except Exception as e:
+            sly.logger.warning(f"Couldn't prefetch predictions for frames {frames}: {repr(e)}")
+            return
+        if settings_hash(session.inference_settings) != settings:
+            sly.logger.debug(
+                f"Inference settings were changed during the prefetch of frames {frames}, "
+                "the predictions are dropped."
+            )
+            return
+        for key, ann in zip(keys, predictions_list):
+            self.cache.put(key, ann)
+        sly.logger.debug(f"Prefetched {len(predictions_list)} frames, cache: {self.cache.stats()}")
@@ -0,0 +1,234 @@
+import queue
+import threading
+import time
+from dataclasses import replace
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import supervisely as sly
+
+import src.functions as f
+import src.globals as g
+from src.jobs import Job
+from src.sampling import FrameSampler
+from src.state import ApplyContext
+from src.upload import UploadStats, get_video_info
+
+# Failed chunks are retried with exponential backoff, e.g. while the serving app is restarting.
+INFERENCE_RETRIES = 3
+# Minimum interval between progress reports in seconds.
+PROGRESS_INTERVAL = 1.0
+
+_DONE = object()
+
+
+def infer_chunk(ctx: ApplyContext, start: int, count: int) -> List[sly.Annotation]:
+    """Infers the chunk of frames, failed requests are retried.
+
+    :param ctx: Apply request context.
+    :type ctx: ApplyContext
+    :param start: Index of the first frame of the chunk.
+    :type start: int
+    :param count: Number of frames in the chunk.
+    :type count: int
+    :return: Predictions for the frames of the chunk.
+    :rtype: List[sly.Annotation]
+    """
+    for attempt in range(INFERENCE_RETRIES + 1):
+        try:
+            with g.metrics.span("inference_chunk", video_id=ctx.video_id, frame=start):
+                predictions = f.infer_models(ctx, start, count, "forward")
+            if len(predictions) != count:
+                raise RuntimeError(
+                    f"Model returned {len(predictions)} predictions for {count} frames."
+                )
+            return predictions
+        except Exception as e:
+            if attempt == INFERENCE_RETRIES:
+                raise
+            delay = 2**attempt
+            sly.logger.warning(
+                f"Inference of frames {start}..{start + count - 1} of video {ctx.video_id} failed: "
+                f"{repr(e)}. Retrying in {delay} s."
+            )
+            g.session_manager.invalidate(ctx.model_session.task_id)
+            time.sleep(delay)
+
+
+def _put(items: queue.Queue, item, stop: threading.Event) -> bool:
+    """Puts the item to the bounded queue, waiting for the space until the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _consume(items: queue.Queue, stop: threading.Event) -> Iterator:
+    """Yields items of the queue until the end of the stage, re-raises errors of the stage."""
+    while not stop.is_set():
+        try:
+            item = items.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def _run_stage(produce: Callable[[], Iterator], output: queue.Queue, stop: threading.Event):
+    """Runs the stage in a thread, passing its items and errors to the next stage."""
+    try:
+        for item in produce():
+            if not _put(output, item, stop):
+                return
+        _put(output, _DONE, stop)
+    except BaseException as e:
+        _put(output, e, stop)
+
+
+def label_video(
+    ctx: ApplyContext,
+    start: int,
+    chunk_size: int,
+    job: Job,
+    on_progress: Optional[Callable[[Job], None]] = None,
+) -> UploadStats:
+    """Labels the video from the start frame to the end. Inference, postprocessing and upload
+    run concurrently in a pipeline: while a chunk is inferred, the previous one is postprocessed
+    and uploaded. The progress is saved to the checkpoint after each uploaded chunk.
+    With frame sampling, only the keyframes of each chunk are inferred.
+
+    :param ctx: Apply request context.
+    :type ctx: ApplyContext
+    :param start: Index of the first frame to label.
+    :type start: int
+    :param chunk_size: Number of frames inferred with one request.
+    :type chunk_size: int
+    :param job: Background job to report progress to.
+    :type job: Job
+    :param on_progress: Called with the job while the frames are uploaded.
+    :type on_progress: Callable[[Job], None], optional
+    :return: Statistics of the upload.
+    :rtype: UploadStats
+    """
+    frames_count = get_video_info(ctx.api, ctx.video_id).frames_count
+    chunks = [
+        (chunk_start, min(chunk_size, frames_count - chunk_start))
+        for chunk_start in range(start, frames_count, chunk_size)
+    ]
+    object_index = f.load_object_index(ctx)
+    fingerprint = ctx.settings_fingerprint()
+    # Bounded queues let the inference run at most one chunk ahead of the upload.
+    predictions = queue.Queue(maxsize=chunk_size)
+    prepared = queue.Queue(maxsize=chunk_size)
+    stop = threading.Event()
+
+    sampler = None
+    if ctx.sampling.enabled:
+        sampler = FrameSampler(ctx.api, ctx.video_id, ctx.sampling)
+
+    def infer() -> Iterator[Tuple[int, Optional[sly.Annotation]]]:
+        for chunk_start, count in chunks:
+            job.check_cancelled()
+            if sampler is None:
+                for i, ann in enumerate(infer_chunk(ctx, chunk_start, count)):
+                    yield chunk_start + i, ann
+                continue
+            # Only the keyframes are inferred, skipped frames are passed on without a prediction.
+            frame_indexes = list(range(chunk_start, chunk_start + count))
+            for frame_index, key in zip(frame_indexes, f.select_keyframes(sampler, frame_indexes)):
+                yield frame_index, (infer_chunk(ctx, frame_index, 1)[0] if key else None)
+
+    def prepare() -> Iterator[Tuple[int, Optional[sly.Annotation], Optional[sly.ProjectMeta]]]:
+        for frame_index, ann in _consume(predictions, stop):
+            if ann is None:
+                yield frame_index, None, None
+            else:
+                yield (frame_index, *f.prepare_prediction(ctx, ann, frame_index, job))
+
+    threads = [
+        threading.Thread(target=_run_stage, args=(infer, predictions, stop), daemon=True),
+        threading.Thread(target=_run_stage, args=(prepare, prepared, stop), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    stats = UploadStats()
+    chunk_ends = {chunk_start + count for chunk_start, count in chunks}
+    reported_at = time.monotonic()
+    try:
+        keyframe = None
+        for frame_index, ann, project_meta in _consume(prepared, stop):
+            if ann is not None:
+                keyframe = (ann, project_meta)
+            if ann is None and not ctx.sampling.copy_figures:
+                job.skipped += 1
+            else:
+                if ann is None:
+                    g.metrics.inc("frames_copied")
+                stats.update(f.upload_prepared(ctx, *keyframe, frame_index, job, object_index))
+            if frame_index + 1 in chunk_ends:
+                g.checkpoints.save(ctx.video_id, frame_index + 1, frames_count, fingerprint)
+            if on_progress is not None and time.monotonic() - reported_at >= PROGRESS_INTERVAL:
+                on_progress(job)
+                reported_at = time.monotonic()
+    finally:
+        # Stops the stages if the upload has failed or the job was cancelled.
+        stop.set()
+    sly.logger.info(f"Video {ctx.video_id} labeled from frame {start}: {stats}")
+    if sampler is not None:
+        sly.logger.info(f"Frame sampling of video {ctx.video_id}: {sampler}")
+    return stats
+
+
+def label_videos(
+    ctx: ApplyContext,
+    video_ids: List[int],
+    chunk_size: int,
+    job: Job,
+    resume: bool = True,
+    on_progress: Optional[Callable[[Job], None]] = None,
+) -> UploadStats:
+    """Labels the videos one after another, each video is processed with `label_video`.
+
+    :param ctx: Apply request context, the video and the frame in it are ignored.
+    :type ctx: ApplyContext
+    :param video_ids: Ids of the videos to label.
+    :type video_ids: List[int]
+    :param chunk_size: Number of frames inferred with one request.
+    :type chunk_size: int
+    :param job: Background job to report progress to.
+    :type job: Job
+    :param resume: Continue from the checkpoints, otherwise the videos are labeled from the start.
+    :type resume: bool
+    :param on_progress: Called with the job while the frames are uploaded.
+    :type on_progress: Callable[[Job], None], optional
+    :return: Total statistics of the upload.
+    :rtype: UploadStats
+    """
+    fingerprint = ctx.settings_fingerprint()
+    starts = {}
+    for video_id in video_ids:
+        starts[video_id] = g.checkpoints.get_next_frame(video_id, fingerprint) if resume else 0
+        job.total += max(0, get_video_info(ctx.api, video_id).frames_count - starts[video_id])
+
+    total_stats = UploadStats()
+    for i, video_id in enumerate(video_ids):
+        job.check_cancelled()
+        frames_count = get_video_info(ctx.api, video_id).frames_count
+        if starts[video_id] >= frames_count:
+            sly.logger.info(f"Video {video_id} is already labeled, skipping it.")
+            continue
+        if starts[video_id] > 0:
+            sly.logger.info(f"Resuming video {video_id} from frame {starts[video_id]}.")
+        sly.logger.info(f"Labeling video {video_id} ({i + 1}/{len(video_ids)}).")
+        video_ctx = replace(ctx, video_id=video_id, frame=starts[video_id])
+        stats = label_video(video_ctx, starts[video_id], chunk_size, job, on_progress)
+        total_stats.update(stats)
+    if on_progress is not None:
+        on_progress(job)
+    return total_stats
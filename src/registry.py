@@ -0,0 +1,191 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+import numpy as np
+import supervisely as sly
+
+from src.tracking import boxes_iou, label_box, match_boxes
+
+# Figures of a frame uploaded by the models: (video id, frame index, model task ids).
+FrameKey = Tuple[int, int, Tuple[int, ...]]
+
+
+@dataclass
+class UploadedFigure:
+    """Figure created by the app for a predicted label."""
+
+    figure_id: int
+    object_id: int
+    class_id: int
+    # The object was created for this figure, not extended from a nearby frame.
+    created_object: bool
+    geometry_hash: str
+    tags_hash: str
+    box: List[int]
+
+
+@dataclass
+class FigureDiff:
+    """Changes needed to turn the previously uploaded figures of a frame into the new labels.
+    Labels are referenced by their indexes in the new annotation.
+    """
+
+    keep: List[Tuple[int, UploadedFigure]] = field(default_factory=list)
+    update: List[Tuple[int, UploadedFigure]] = field(default_factory=list)
+    replace: List[Tuple[int, UploadedFigure]] = field(default_factory=list)
+    remove: List[UploadedFigure] = field(default_factory=list)
+    add: List[int] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.keep)} kept, {len(self.update)} moved, {len(self.replace)} replaced, "
+            f"{len(self.remove)} removed, {len(self.add)} added"
+        )
+
+
+def geometry_hash(label: sly.Label) -> str:
+    geometry = label.geometry
+    if type(geometry) is sly.Bitmap:
+        # Hashing the raw mask is much cheaper than encoding it to PNG.
+        header = f"{geometry.origin.row},{geometry.origin.col},{geometry.data.shape}"
+        data = np.packbits(geometry.data).tobytes()
+        return hashlib.md5(header.encode("utf-8") + data).hexdigest()
+    dumped = json.dumps(geometry.to_json(), sort_keys=True)
+    return hashlib.md5(dumped.encode("utf-8")).hexdigest()
+
+
+def tags_hash(label: sly.Label) -> str:
+    tags = sorted((tag.meta.name, str(tag.value)) for tag in label.tags)
+    return hashlib.md5(json.dumps(tags).encode("utf-8")).hexdigest()
+
+
+def diff_figures(
+    previous: List[UploadedFigure],
+    labels: List[sly.Label],
+    class_ids: List[int],
+    iou_threshold: float = 0.5,
+) -> FigureDiff:
+    """Matches the new labels of the frame with the figures uploaded for it before.
+    Figures with the same class, geometry and tags are kept. Other figures of the same class
+    are matched by IoU of bounding boxes: the geometry of a matched figure is updated if its tags
+    are the same, otherwise the figure is replaced with a new figure of the same object.
+    Unmatched figures are removed and unmatched labels are added.
+
+    :param previous: Figures uploaded for the frame before.
+    :type previous: List[UploadedFigure]
+    :param labels: New labels of the frame.
+    :type labels: List[sly.Label]
+    :param class_ids: Project class ids of the labels.
+    :type class_ids: List[int]
+    :param iou_threshold: Minimum IoU of a moved figure and the label.
+    :type iou_threshold: float
+    :return: Diff of the figures.
+    :rtype: FigureDiff
+    """
+    diff = FigureDiff()
+    geometry_hashes = [geometry_hash(label) for label in labels]
+    label_tags_hashes = [tags_hash(label) for label in labels]
+
+    exact: Dict[Tuple, List[UploadedFigure]] = {}
+    for figure in previous:
+        exact.setdefault((figure.class_id, figure.geometry_hash, figure.tags_hash), []).append(
+            figure
+        )
+    unmatched_labels = []
+    for i, class_id in enumerate(class_ids):
+        same = exact.get((class_id, geometry_hashes[i], label_tags_hashes[i]))
+        if same:
+            diff.keep.append((i, same.pop()))
+        else:
+            unmatched_labels.append(i)
+    unmatched_figures = [figure for figures in exact.values() for figure in figures]
+
+    matched_labels, matched_figures = set(), set()
+    for class_id in set(class_ids[i] for i in unmatched_labels):
+        rows = [i for i in unmatched_labels if class_ids[i] == class_id]
+        cols = [j for j, figure in enumerate(unmatched_figures) if figure.class_id == class_id]
+        if len(cols) == 0:
+            continue
+        iou = boxes_iou(
+            np.array([label_box(labels[i]) for i in rows], dtype=np.float64),
+            np.array([unmatched_figures[j].box for j in cols], dtype=np.float64),
+        )
+        for row, col in match_boxes(iou, iou_threshold):
+            i, figure = rows[row], unmatched_figures[cols[col]]
+            if figure.tags_hash == label_tags_hashes[i]:
+                diff.update.append((i, figure))
+            else:
+                diff.replace.append((i, figure))
+            matched_labels.add(i)
+            matched_figures.add(cols[col])
+
+    diff.add = [i for i in unmatched_labels if i not in matched_labels]
+    diff.remove = [figure for j, figure in enumerate(unmatched_figures) if j not in matched_figures]
+    return diff
+
+
+class FigureRegistry:
+    """Figures uploaded by the app for each frame and set of models, kept in memory.
+    Used to replace the previous predictions of the models when they are applied to the frame again.
+
+    :param max_frames: Maximum number of frames to remember, the least recently used are forgotten.
+    :type max_frames: int
+    """
+
+    def __init__(self, max_frames: int = 10000):
+        self.max_frames = max_frames
+        self._frames: "OrderedDict[FrameKey, List[UploadedFigure]]" = OrderedDict()
+        # Frames with the figures of each object, updated with the frames.
+        self._object_frames: Dict[int, Set[FrameKey]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: FrameKey) -> Optional[List[UploadedFigure]]:
+        with self._lock:
+            figures = self._frames.get(key)
+            if figures is not None:
+                self._frames.move_to_end(key)
+            return figures
+
+    def put(self, key: FrameKey, figures: List[UploadedFigure]) -> None:
+        with self._lock:
+            previous = self._frames.get(key)
+            if previous is not None:
+                self._unindex(key, previous)
+            self._frames[key] = figures
+            self._frames.move_to_end(key)
+            for figure in figures:
+                self._object_frames.setdefault(figure.object_id, set()).add(key)
+            while len(self._frames) > self.max_frames:
+                evicted_key, evicted = self._frames.popitem(last=False)
+                self._unindex(evicted_key, evicted)
+
+    def has_other_figures(self, object_id: int, exclude: Hashable) -> bool:
+        """Checks that the object has figures uploaded for frames other than `exclude`."""
+        with self._lock:
+            frames = self._object_frames.get(object_id, ())
+            return any(key != exclude for key in frames)
+
+    def _unindex(self, key: FrameKey, figures: List[UploadedFigure]) -> None:
+        for figure in figures:
+            frames = self._object_frames.get(figure.object_id)
+            if frames is None:
+                continue
+            frames.discard(key)
+            if len(frames) == 0:
+                del self._object_frames[figure.object_id]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self._object_frames.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "frames": len(self._frames),
+                "figures": sum(len(figures) for figures in self._frames.values()),
+            }
@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+import cv2
+import numpy as np
+import supervisely as sly
+
+# Frames are compared as grayscale thumbnails of this size.
+SIGNATURE_SIZE = 32
+DOWNLOAD_BATCH_SIZE = 50
+
+
+@dataclass(frozen=True)
+class SamplingSettings:
+    """Skipping of near-duplicate frames in the range and whole-video modes.
+
+    :param enabled: Run the model only on the keyframes.
+    :type enabled: bool
+    :param threshold: Minimum mean absolute difference (0..1) of the frame thumbnail
+        from the last keyframe thumbnail to make the frame a keyframe.
+    :type threshold: float
+    :param max_gap: Maximum distance in frames between keyframes.
+    :type max_gap: int
+    :param copy_figures: Copy figures of the last keyframe to the skipped frames.
+    :type copy_figures: bool
+    """
+
+    enabled: bool = False
+    threshold: float = 0.02
+    max_gap: int = 30
+    copy_figures: bool = False
+
+
+def frame_signature(frame: np.ndarray) -> np.ndarray:
+    """Returns the grayscale thumbnail of the frame with values in 0..1."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) if frame.ndim == 3 else frame
+    thumbnail = cv2.resize(gray, (SIGNATURE_SIZE, SIGNATURE_SIZE), interpolation=cv2.INTER_AREA)
+    return thumbnail.astype(np.float32) / 255
+
+
+class FrameSampler:
+    """Selects keyframes of a video by the difference of the downscaled frames.
+    Each frame is compared with the last keyframe, not with the previous frame,
+    so that a slow drift still produces a new keyframe. The state is kept between calls,
+    the frames of a video can be selected chunk by chunk.
+
+    :param api: Supervisely API to download the frames.
+    :type api: sly.Api
+    :param video_id: Video id.
+    :type video_id: int
+    :param settings: Sampling settings.
+    :type settings: SamplingSettings
+    """
+
+    def __init__(self, api: sly.Api, video_id: int, settings: SamplingSettings):
+        self.api = api
+        self.video_id = video_id
+        self.settings = settings
+        self.frames = 0
+        self.keyframes = 0
+        self._last_signature: Optional[np.ndarray] = None
+        self._last_keyframe: Optional[int] = None
+
+    @property
+    def skipped(self) -> int:
+        return self.frames - self.keyframes
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def select(self, frame_indexes: List[int]) -> List[bool]:
+        """Downloads the frames and decides which of them are keyframes.
+
+        :param frame_indexes: Frame indexes in the order of processing.
+        :type frame_indexes: List[int]
+        :return: For each frame, True if it is a keyframe.
+        :rtype: List[bool]
+        """
+        is_keyframe = []
+        for batch in sly.batched(frame_indexes, batch_size=DOWNLOAD_BATCH_SIZE):
+            frames = self.api.video.frame.download_nps(self.video_id, batch)
+            for frame_index, frame in zip(batch, frames):
+                is_keyframe.append(self._update(frame_index, frame_signature(frame)))
+        return is_keyframe
+
+    def _update(self, frame_index: int, signature: np.ndarray) -> bool:
+        self.frames += 1
+        keyframe = (
+            self._last_signature is None
+            or abs(frame_index - self._last_keyframe) >= self.settings.max_gap
+            or float(np.abs(signature - self._last_signature).mean()) > self.settings.threshold
+        )
+        if keyframe:
+            self.keyframes += 1
+            self._last_signature = signature
+            self._last_keyframe = frame_index
+        return keyframe
+
+    def __str__(self) -> str:
+        return (
+            f"{self.keyframes} keyframes of {self.frames} frames, "
+            f"{self.skipped} frames skipped ({self.skip_ratio:.0%})"
+        )
@@ -0,0 +1,156 @@
+import threading
+from dataclasses import asdict, dataclass, field
+from functools import cached_property
+from typing import Dict, FrozenSet, Hashable, List, Optional, Tuple
+
+import supervisely as sly
+
+from src.ensemble import FusionSettings
+from src.filtering import FilterSettings
+from src.geometry import GeometrySettings
+from src.prefetch import settings_hash
+from src.sampling import SamplingSettings
+from src.tiling import TilingSettings
+
+
+@dataclass
+class AnnotatorState:
+    """State of a single annotation tool session (one annotator working with the app).
+    Fields are changed only under the `lock` of the state.
+    """
+
+    session_id: str
+    api: Optional[sly.Api] = None
+    team_id: Optional[int] = None
+    video_id: Optional[int] = None
+    project_id: Optional[int] = None
+    frame: Optional[int] = None
+    job_id: Optional[int] = None
+    is_my_labeling_job: bool = False
+    allowed_classes: Optional[FrozenSet[str]] = None
+    allowed_tags: Optional[FrozenSet[str]] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+
+@dataclass(frozen=True)
+class ApplyContext:
+    """Immutable snapshot of everything the apply pipeline needs.
+    It is created when the request is received and passed through the inference, postprocessing
+    and upload stages, so that later events and other annotators can't change it.
+    """
+
+    api: sly.Api
+    session_id: str
+    video_id: int
+    project_id: int
+    frame: int
+    model_session: sly.nn.inference.Session
+    model_meta: sly.ProjectMeta
+    selected_classes: List[sly.ObjClass]
+    selected_tags: List[sly.TagMeta]
+    suffix: str
+    use_suffix: bool
+    # Fingerprint of the main model checkpoint, predictions are stored on disk under it.
+    model_key: Optional[str] = None
+    # Cross-frame association: new figures extend objects on the nearby frames.
+    associate: bool = False
+    association_window: int = 5
+    association_iou: float = 0.5
+    filters: FilterSettings = FilterSettings()
+    geometry: GeometrySettings = GeometrySettings()
+    sampling: SamplingSettings = SamplingSettings()
+    # Sessions of the additional models queried together with the main model.
+    extra_sessions: List[sly.nn.inference.Session] = field(default_factory=list)
+    fusion: FusionSettings = FusionSettings()
+    tiling: TilingSettings = TilingSettings()
+    # Previous predictions of the same models on the frame are replaced with the diff.
+    replace_previous: bool = False
+
+    @property
+    def task_ids(self) -> Tuple[int, ...]:
+        """Task ids of the main and the additional model sessions."""
+        return tuple(session.task_id for session in [self.model_session, *self.extra_sessions])
+
+    @cached_property
+    def selected_class_names(self) -> FrozenSet[str]:
+        return frozenset(obj_class.name for obj_class in self.selected_classes)
+
+    @cached_property
+    def selected_tag_names(self) -> FrozenSet[str]:
+        return frozenset(tag_meta.name for tag_meta in self.selected_tags)
+
+    def idempotency_key(self, *extra: Hashable) -> Tuple:
+        """Returns the key identifying the apply request: the annotator session, the video,
+        the frame, the models and the hash of all settings that change the result.
+
+        :param extra: Other request parameters, e.g. the frames range.
+        :type extra: Hashable
+        :return: Idempotency key.
+        :rtype: Tuple
+        """
+        return (
+            self.session_id,
+            self.video_id,
+            self.frame,
+            self.task_ids,
+            settings_hash({**self._result_settings(), "extra": extra}),
+        )
+
+    def settings_fingerprint(self) -> str:
+        """Returns the hash of the models and all settings that change the result,
+        the same for all videos and frames.
+
+        :return: Settings hash.
+        :rtype: str
+        """
+        return settings_hash(
+            {**self._result_settings(), "task_ids": self.task_ids, "model_key": self.model_key}
+        )
+
+    def _result_settings(self) -> Dict:
+        return {
+            "inference": [
+                session.inference_settings for session in [self.model_session, *self.extra_sessions]
+            ],
+            "classes": [obj_class.name for obj_class in self.selected_classes],
+            "tags": [tag_meta.name for tag_meta in self.selected_tags],
+            "suffix": [self.suffix, self.use_suffix],
+            "association": [self.associate, self.association_window, self.association_iou],
+            "filters": asdict(self.filters),
+            "geometry": asdict(self.geometry),
+            "sampling": asdict(self.sampling),
+            "fusion": asdict(self.fusion),
+            "tiling": asdict(self.tiling),
+            "replace_previous": self.replace_previous,
+        }
+
+
+class StateStore:
+    """Thread-safe store of the annotator states keyed by the annotation tool session id.
+    The store lock is held only to find or create the state, requests of different annotators
+    don't block each other.
+
+    :param max_states: Maximum number of stored states, the least recently used are removed.
+    :type max_states: int
+    """
+
+    def __init__(self, max_states: int = 1000):
+        self.max_states = max_states
+        self._states: Dict[str, AnnotatorState] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> AnnotatorState:
+        """Returns the state of the annotation tool session, creating it if needed."""
+        with self._lock:
+            state = self._states.pop(session_id, None)
+            if state is None:
+                state = AnnotatorState(session_id)
+            # Reinserting the state to keep the dict ordered by the last access.
+            self._states[session_id] = state
+            while len(self._states) > self.max_states:
+                self._states.pop(next(iter(self._states)))
+            return state
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._states)
@@ -0,0 +1,304 @@
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import supervisely as sly
+from supervisely.annotation.label import LabelJsonFields
+from supervisely.geometry.constants import GEOMETRY_TYPE
+from supervisely.geometry.geometry import Geometry
+from supervisely.geometry.point_location import row_col_list_to_points
+
+from src.prefetch import settings_hash
+
+# Session info fields that differ between deployments of the same checkpoint.
+DEPLOYMENT_INFO_KEYS = {"session_id", "device"}
+# After the store exceeds the size limit, the least recently used predictions are removed
+# until it is below this fraction of the limit, so that eviction doesn't run on every write.
+EVICTION_TARGET = 0.9
+# Version of the prediction format, the predictions stored in other formats are treated as misses.
+STORE_FORMAT = 2
+# Marks the objects whose geometry is stored in the binary part of the prediction.
+BINARY_GEOMETRY = "binaryGeometry"
+
+
+def model_fingerprint(session_info: Dict[str, Any], model_meta: sly.ProjectMeta) -> str:
+    """Returns the hash identifying the model checkpoint, the same for all deployments of it.
+
+    :param session_info: Session info returned by the serving app.
+    :type session_info: Dict[str, Any]
+    :param model_meta: Classes and tags of the model.
+    :type model_meta: sly.ProjectMeta
+    :return: Hash of the model.
+    :rtype: str
+    """
+    info = {key: value for key, value in session_info.items() if key not in DEPLOYMENT_INFO_KEYS}
+    return settings_hash({"info": info, "meta": model_meta.to_json()})
+
+
+def _pack_points(points: np.ndarray) -> bytes:
+    return struct.pack("<I", len(points)) + np.asarray(points, dtype="<i4").tobytes()
+
+
+def _unpack_points(data: memoryview, offset: int) -> Tuple[np.ndarray, int]:
+    (count,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    points = np.frombuffer(data, dtype="<i4", count=count * 2, offset=offset).reshape(count, 2)
+    return points, offset + count * 8
+
+
+def _pack_geometry(geometry: Geometry) -> Optional[bytes]:
+    """Returns the binary record of the geometry or None if the geometry type is stored as JSON."""
+    if type(geometry) is sly.Bitmap:
+        height, width = geometry.data.shape
+        origin = struct.pack("<4i", geometry.origin.row, geometry.origin.col, height, width)
+        return origin + np.packbits(geometry.data).tobytes()
+    if type(geometry) is sly.Polygon:
+        rings = [geometry.exterior_np, *geometry.interior_np]
+        return struct.pack("<I", len(rings)) + b"".join(_pack_points(ring) for ring in rings)
+    if type(geometry) is sly.Rectangle:
+        return struct.pack("<4i", geometry.top, geometry.left, geometry.bottom, geometry.right)
+    return None
+
+
+def _unpack_geometry(geometry_type: str, data: memoryview, offset: int) -> Tuple[Geometry, int]:
+    if geometry_type == sly.Bitmap.geometry_name():
+        row, col, height, width = struct.unpack_from("<4i", data, offset)
+        offset += 16
+        size = (height * width + 7) // 8
+        bits = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+        mask = np.unpackbits(bits, count=height * width).reshape(height, width).astype(bool)
+        return sly.Bitmap(mask, origin=sly.PointLocation(row, col)), offset + size
+    if geometry_type == sly.Polygon.geometry_name():
+        (count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        rings = []
+        for _ in range(count):
+            ring, offset = _unpack_points(data, offset)
+            rings.append(row_col_list_to_points(ring.tolist()))
+        return sly.Polygon(rings[0], rings[1:]), offset
+    if geometry_type == sly.Rectangle.geometry_name():
+        return sly.Rectangle(*struct.unpack_from("<4i", data, offset)), offset + 16
+    raise ValueError(f"Unknown binary geometry type: {geometry_type}")
+
+
+def encode_annotation(ann: sly.Annotation) -> bytes:
+    """Serializes the annotation to the store format. Bitmaps are stored as packed bits and
+    polygons and rectangles as int32 arrays after a compact JSON header with the rest of the
+    annotation, other geometries are kept in the header as JSON. The result is compressed with zlib.
+
+    :param ann: Annotation to serialize.
+    :type ann: sly.Annotation
+    :return: Serialized annotation.
+    :rtype: bytes
+    """
+    objects = []
+    records = []
+    for label in ann.labels:
+        record = _pack_geometry(label.geometry)
+        if record is None:
+            objects.append(label.to_json())
+            continue
+        objects.append(
+            {
+                LabelJsonFields.OBJ_CLASS_NAME: label.obj_class.name,
+                LabelJsonFields.TAGS: label.tags.to_json(),
+                LabelJsonFields.DESCRIPTION: label.description,
+                LabelJsonFields.INSTANCE_KEY: label.binding_key,
+                GEOMETRY_TYPE: label.geometry.geometry_name(),
+                BINARY_GEOMETRY: True,
+            }
+        )
+        records.append(record)
+    header = {
+        "size": ann.img_size,
+        "tags": ann.img_tags.to_json(),
+        "description": ann.img_description,
+        "customData": ann.custom_data,
+        "objects": objects,
+    }
+    dumped = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    payload = b"".join([struct.pack("<I", len(dumped)), dumped, *records])
+    return bytes([STORE_FORMAT]) + zlib.compress(payload)
+
+
+def decode_annotation(data: bytes, model_meta: sly.ProjectMeta) -> sly.Annotation:
+    if not data or data[0] != STORE_FORMAT:
+        raise ValueError("Prediction was stored in an unsupported format.")
+    payload = memoryview(zlib.decompress(data[1:]))
+    (size,) = struct.unpack_from("<I", payload)
+    header = json.loads(bytes(payload[4 : 4 + size]))
+    offset = 4 + size
+    labels = []
+    for obj in header["objects"]:
+        if not obj.get(BINARY_GEOMETRY):
+            labels.append(sly.Label.from_json(obj, model_meta))
+            continue
+        geometry, offset = _unpack_geometry(obj[GEOMETRY_TYPE], payload, offset)
+        obj_class = model_meta.get_obj_class(obj[LabelJsonFields.OBJ_CLASS_NAME])
+        if obj_class is None:
+            raise KeyError(f"Class {obj[LabelJsonFields.OBJ_CLASS_NAME]} is not in the model meta.")
+        tags = sly.TagCollection.from_json(obj[LabelJsonFields.TAGS], model_meta.tag_metas)
+        label = sly.Label(geometry, obj_class, tags, obj[LabelJsonFields.DESCRIPTION])
+        label.binding_key = obj[LabelJsonFields.INSTANCE_KEY]
+        labels.append(label)
+    return sly.Annotation(
+        tuple(header["size"]),
+        labels,
+        img_tags=sly.TagCollection.from_json(header["tags"], model_meta.tag_metas),
+        img_description=header["description"],
+        custom_data=header["customData"],
+    )
+
+
+class PredictionStore:
+    """Raw model predictions saved to a local SQLite database, so that the frames inferred before
+    a reconnect or a restart of the app are not inferred again. Predictions are keyed by the model
+    fingerprint, the video, the frame and the inference settings hash. The database is limited
+    by the total size of the stored predictions, the least recently used are removed.
+
+    :param path: Path to the database file.
+    :type path: str
+    :param max_bytes: Maximum total size of the stored predictions, 0 disables the store.
+    :type max_bytes: int
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(
+        self, model: str, video_id: int, frame: int, settings: str, model_meta: sly.ProjectMeta
+    ) -> Optional[sly.Annotation]:
+        """Returns the stored prediction or None. Predictions that can't be decoded
+        with the model meta are removed.
+        """
+        if not self.enabled:
+            return None
+        key = (model, video_id, frame, settings)
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT data FROM predictions "
+                "WHERE model = ? AND video_id = ? AND frame = ? AND settings = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute(
+                "UPDATE predictions SET accessed_at = ? "
+                "WHERE model = ? AND video_id = ? AND frame = ? AND settings = ?",
+                (time.time(), *key),
+            )
+            connection.commit()
+        try:
+            ann = decode_annotation(row[0], model_meta)
+        except Exception as e:
+            sly.logger.warning(f"Stored prediction for frame {frame} can't be decoded: {repr(e)}")
+            self.remove(model, video_id, frame, settings)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return ann
+
+    def put(
+        self, model: str, video_id: int, frame: int, settings: str, ann: sly.Annotation
+    ) -> None:
+        if not self.enabled:
+            return
+        data = encode_annotation(ann)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            connection = self._connect()
+            old = connection.execute(
+                "SELECT size FROM predictions "
+                "WHERE model = ? AND video_id = ? AND frame = ? AND settings = ?",
+                (model, video_id, frame, settings),
+            ).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (model, video_id, frame, settings, data, len(data), time.time()),
+            )
+            self._bytes += len(data) - (old[0] if old is not None else 0)
+            if self._bytes > self.max_bytes:
+                self._evict(connection)
+            connection.commit()
+
+    def remove(self, model: str, video_id: int, frame: int, settings: str) -> None:
+        with self._lock:
+            connection = self._connect()
+            key = (model, video_id, frame, settings)
+            condition = "WHERE model = ? AND video_id = ? AND frame = ? AND settings = ?"
+            row = connection.execute(f"SELECT size FROM predictions {condition}", key).fetchone()
+            if row is None:
+                return
+            connection.execute(f"DELETE FROM predictions {condition}", key)
+            connection.commit()
+            self._bytes -= row[0]
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        target = self.max_bytes * EVICTION_TARGET
+        rows = connection.execute(
+            "SELECT rowid, size FROM predictions ORDER BY accessed_at"
+        ).fetchall()
+        evicted = []
+        for rowid, size in rows:
+            if self._bytes <= target:
+                break
+            evicted.append((rowid,))
+            self._bytes -= size
+        connection.executemany("DELETE FROM predictions WHERE rowid = ?", evicted)
+        self.evictions += len(evicted)
+        sly.logger.debug(f"{len(evicted)} predictions were evicted from the store.")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens the database on the first use, must be called under the lock."""
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "model TEXT, video_id INTEGER, frame INTEGER, settings TEXT, "
+                "data BLOB, size INTEGER, accessed_at REAL, "
+                "PRIMARY KEY (model, video_id, frame, settings))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS predictions_accessed_at ON predictions (accessed_at)"
+            )
+            connection.commit()
+            self._bytes = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM predictions"
+            ).fetchone()[0]
+            self._connection = connection
+        return self._connection
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
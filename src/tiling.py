@@ -0,0 +1,190 @@
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+import supervisely as sly
+
+from src.filtering import label_confidence, suppress
+from src.tracking import label_box
+
+# Tiles are sent to the serving app in batches of this size.
+TILES_BATCH_SIZE = 16
+
+
+@dataclass(frozen=True)
+class TilingSettings:
+    """Sliding-window inference of high-resolution frames.
+
+    :param enabled: Infer the frames tile by tile instead of the whole frame at once.
+    :type enabled: bool
+    :param tile_size: Size of the square tiles in pixels.
+    :type tile_size: int
+    :param overlap: Overlap of the neighbouring tiles as a fraction of the tile size (0..0.9).
+    :type overlap: float
+    :param roi: Region of the frame to tile in (top, left, bottom, right) format,
+        None for the whole frame.
+    :type roi: Tuple[int, int, int, int], optional
+    :param merge_threshold: Labels of the same class from different tiles are merged
+        if their intersection covers more than this fraction of the smaller bounding box.
+    :type merge_threshold: float
+    """
+
+    enabled: bool = False
+    tile_size: int = 1024
+    overlap: float = 0.2
+    roi: Optional[Tuple[int, int, int, int]] = None
+    merge_threshold: float = 0.5
+
+
+def parse_roi(text: str) -> Optional[Tuple[int, int, int, int]]:
+    """Parses the region of interest written as "top, left, bottom, right" in pixels.
+
+    :param text: ROI text.
+    :type text: str
+    :return: ROI or None if the text is empty.
+    :rtype: Optional[Tuple[int, int, int, int]]
+    :raises ValueError: If the text is not four integers or the region is empty.
+    """
+    if text is None or text.strip() == "":
+        return None
+    try:
+        top, left, bottom, right = [int(value) for value in text.replace(",", " ").split()]
+    except ValueError:
+        raise ValueError("ROI must be written as 'top, left, bottom, right' in pixels.")
+    if top < 0 or left < 0 or bottom <= top or right <= left:
+        raise ValueError("ROI must have non-negative coordinates and a non-empty area.")
+    return top, left, bottom, right
+
+
+def tile_grid(height: int, width: int, settings: TilingSettings) -> List[Tuple[int, int, int, int]]:
+    """Returns the tiles covering the ROI of the frame. The last tile of each row and column
+    is aligned with the ROI edge, so all tiles have the same size if the ROI is larger than a tile.
+
+    :param height: Frame height.
+    :type height: int
+    :param width: Frame width.
+    :type width: int
+    :param settings: Tiling settings.
+    :type settings: TilingSettings
+    :return: Tiles in (top, left, bottom, right) format, bottom and right are exclusive.
+    :rtype: List[Tuple[int, int, int, int]]
+    """
+    top, left, bottom, right = settings.roi or (0, 0, height, width)
+    bottom, right = min(bottom, height), min(width, right)
+    if bottom <= top or right <= left:
+        raise ValueError(f"ROI {settings.roi} is outside of the frame {height}x{width}.")
+    stride = max(1, int(settings.tile_size * (1 - settings.overlap)))
+
+    def _starts(start: int, end: int) -> List[int]:
+        if end - start <= settings.tile_size:
+            return [start]
+        starts = list(range(start, end - settings.tile_size, stride))
+        return starts + [end - settings.tile_size]
+
+    return [
+        (row, col, min(row + settings.tile_size, bottom), min(col + settings.tile_size, right))
+        for row in _starts(top, bottom)
+        for col in _starts(left, right)
+    ]
+
+
+def infer_tiled(
+    session: sly.nn.inference.Session, frames: List[np.ndarray], settings: TilingSettings
+) -> List[sly.Annotation]:
+    """Infers the frames tile by tile. Tiles of all frames are cropped locally and sent
+    to the model in batches, the predicted geometries are shifted back to the frame coordinates
+    and the duplicates on the tile seams are merged.
+
+    :param session: Model session.
+    :type session: sly.nn.inference.Session
+    :param frames: RGB frames.
+    :type frames: List[np.ndarray]
+    :param settings: Tiling settings.
+    :type settings: TilingSettings
+    :return: Predictions for the frames in the same order.
+    :rtype: List[sly.Annotation]
+    """
+    tiles = [
+        (frame_number, tile)
+        for frame_number, frame in enumerate(frames)
+        for tile in tile_grid(frame.shape[0], frame.shape[1], settings)
+    ]
+    tile_anns = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for batch in sly.batched(tiles, batch_size=TILES_BATCH_SIZE):
+            paths = []
+            for frame_number, (top, left, bottom, right) in batch:
+                path = os.path.join(tmp_dir, f"{len(tile_anns) + len(paths)}.jpg")
+                sly.image.write(path, frames[frame_number][top:bottom, left:right])
+                paths.append(path)
+            tile_anns.extend(session.inference_image_paths(paths))
+            for path in paths:
+                os.remove(path)
+
+    labels = [[] for _ in frames]
+    label_tiles = [[] for _ in frames]
+    img_tags = [None] * len(frames)
+    for tile_number, ((frame_number, (top, left, _, _)), ann) in enumerate(zip(tiles, tile_anns)):
+        for label in ann.labels:
+            labels[frame_number].append(label.translate(top, left))
+            label_tiles[frame_number].append(tile_number)
+        if img_tags[frame_number] is None:
+            img_tags[frame_number] = ann.img_tags
+    anns = []
+    for frame, frame_labels, tile_numbers, tags in zip(frames, labels, label_tiles, img_tags):
+        merged = merge_tile_labels(frame_labels, tile_numbers, settings.merge_threshold)
+        anns.append(sly.Annotation(frame.shape[:2], labels=merged, img_tags=tags))
+    return anns
+
+
+def boxes_ios(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Intersection over the smaller box for each pair of boxes in (top, left, bottom, right)
+    format. Unlike IoU, it is high for a box cut by the tile edge and the full box of the object
+    from the neighbouring tile.
+
+    :return: Matrix with shape (len(boxes_a), len(boxes_b)).
+    :rtype: np.ndarray
+    """
+    top = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    left = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    bottom = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    right = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(bottom - top + 1, 0, None) * np.clip(right - left + 1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0] + 1) * (boxes_a[:, 3] - boxes_a[:, 1] + 1)
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0] + 1) * (boxes_b[:, 3] - boxes_b[:, 1] + 1)
+    return intersection / np.minimum(area_a[:, None], area_b[None, :])
+
+
+def merge_tile_labels(
+    labels: List[sly.Label], tile_numbers: List[int], threshold: float
+) -> List[sly.Label]:
+    """Removes the duplicates of the objects predicted on several overlapping tiles.
+    Labels of each class are suppressed by more confident labels from other tiles,
+    labels of the same tile are already deduplicated by the model.
+
+    :param labels: Labels of the frame in the frame coordinates.
+    :type labels: List[sly.Label]
+    :param tile_numbers: Tile of each label.
+    :type tile_numbers: List[int]
+    :param threshold: Minimum intersection over the smaller bounding box of the duplicates.
+    :type threshold: float
+    :return: Kept labels.
+    :rtype: List[sly.Label]
+    """
+    if len(labels) < 2:
+        return labels
+    boxes = np.array([label_box(label) for label in labels], dtype=np.float64)
+    class_names = np.array([label.obj_class.name for label in labels])
+    scores = np.array([label_confidence(label) for label in labels], dtype=np.float64)
+    tiles = np.array(tile_numbers)
+
+    keep = np.zeros(len(labels), dtype=bool)
+    for class_name in np.unique(class_names):
+        indexes = np.nonzero(class_names == class_name)[0]
+        indexes = indexes[np.argsort(-scores[indexes], kind="stable")]
+        overlaps = boxes_ios(boxes[indexes], boxes[indexes])
+        overlaps[tiles[indexes][:, None] == tiles[indexes][None, :]] = 0
+        keep[indexes[suppress(overlaps, threshold)]] = True
+    return [label for label, kept in zip(labels, keep) if kept]
@@ -0,0 +1,300 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import supervisely as sly
+from supervisely.api.module_api import ApiField
+
+
+def boxes_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Computes pairwise IoU of the boxes.
+
+    :param boxes_a: Boxes with shape (N, 4) in (top, left, bottom, right) format.
+    :type boxes_a: np.ndarray
+    :param boxes_b: Boxes with shape (M, 4) in (top, left, bottom, right) format.
+    :type boxes_b: np.ndarray
+    :return: IoU matrix with shape (N, M).
+    :rtype: np.ndarray
+    """
+    # Supervisely rectangles include the bottom and right pixels.
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0] + 1) * (boxes_a[:, 3] - boxes_a[:, 1] + 1)
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0] + 1) * (boxes_b[:, 3] - boxes_b[:, 1] + 1)
+    top = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    left = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    bottom = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    right = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(bottom - top + 1, 0, None) * np.clip(right - left + 1, 0, None)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+@lru_cache(maxsize=1)
+def _get_linear_sum_assignment() -> Optional[Callable]:
+    """Imports scipy on the first matching, the import takes a noticeable part of the app startup.
+
+    :return: `scipy.optimize.linear_sum_assignment` or None if scipy is not installed.
+    :rtype: Optional[Callable]
+    """
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        return None
+    return linear_sum_assignment
+
+
+def match_boxes(iou: np.ndarray, iou_threshold: float) -> List[Tuple[int, int]]:
+    """Matches rows to columns of the IoU matrix maximizing the total IoU.
+    Uses the Hungarian algorithm if scipy is installed, otherwise greedy matching.
+
+    :param iou: IoU matrix with shape (N, M).
+    :type iou: np.ndarray
+    :param iou_threshold: Minimum IoU of a matched pair.
+    :type iou_threshold: float
+    :return: Matched pairs (row, column).
+    :rtype: List[Tuple[int, int]]
+    """
+    if iou.size == 0:
+        return []
+    linear_sum_assignment = _get_linear_sum_assignment()
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(-iou)
+        keep = iou[rows, cols] >= iou_threshold
+        return list(zip(rows[keep].tolist(), cols[keep].tolist()))
+
+    rows, cols = np.nonzero(iou >= iou_threshold)
+    order = np.argsort(-iou[rows, cols], kind="stable")
+    used_rows, used_cols, pairs = set(), set(), []
+    for row, col in zip(rows[order].tolist(), cols[order].tolist()):
+        if row in used_rows or col in used_cols:
+            continue
+        used_rows.add(row)
+        used_cols.add(col)
+        pairs.append((row, col))
+    return pairs
+
+
+def label_box(label: sly.Label) -> List[int]:
+    bbox = label.geometry.to_bbox()
+    return [bbox.top, bbox.left, bbox.bottom, bbox.right]
+
+
+class ObjectIndex:
+    """Bounding boxes of the video figures used to find objects on the nearby frames.
+    Stored as arrays, so that the candidates for a frame are selected without loops.
+    The index is shared by the jobs of the same video (see `ObjectIndexCache`): figures are only
+    appended or removed under the lock, and the arrays are replaced, not modified in place.
+    """
+
+    def __init__(self):
+        self.object_ids = np.zeros(0, dtype=np.int64)
+        self.class_ids = np.zeros(0, dtype=np.int64)
+        self.frames = np.zeros(0, dtype=np.int64)
+        self.boxes = np.zeros((0, 4), dtype=np.float64)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, api: sly.Api, video_id: int, dataset_id: int) -> "ObjectIndex":
+        """Downloads figures of the video without geometries, bounding boxes are taken from
+        the geometry meta.
+
+        :param api: Supervisely API.
+        :type api: sly.Api
+        :param video_id: Video id.
+        :type video_id: int
+        :param dataset_id: Dataset id of the video.
+        :type dataset_id: int
+        :return: Index of the video figures.
+        :rtype: ObjectIndex
+        """
+        index = cls()
+        figures = api.video.figure.download(dataset_id, [video_id], skip_geometry=True)
+        figures = figures.get(video_id, [])
+        rows = []
+        for figure in figures:
+            frame = (figure.meta or {}).get(ApiField.FRAME, figure.frame_index)
+            geometry_meta = figure.geometry_meta or {}
+            if frame is None or "bbox" not in geometry_meta:
+                continue
+            rows.append((figure.object_id, figure.class_id, frame, *geometry_meta["bbox"]))
+        if len(rows) > 0:
+            data = np.array(rows, dtype=np.float64)
+            index.object_ids = data[:, 0].astype(np.int64)
+            index.class_ids = data[:, 1].astype(np.int64)
+            index.frames = data[:, 2].astype(np.int64)
+            index.boxes = data[:, 3:7]
+        sly.logger.debug(f"Object index of video {video_id}: {len(rows)} figures.")
+        return index
+
+    def add(self, object_ids: List[int], class_ids: List[int], frame: int, boxes: List[List[int]]):
+        """Adds the uploaded figures to the index."""
+        if len(object_ids) == 0:
+            return
+        with self._lock:
+            self._set(
+                np.concatenate([self.object_ids, np.array(object_ids, dtype=np.int64)]),
+                np.concatenate([self.class_ids, np.array(class_ids, dtype=np.int64)]),
+                np.concatenate([self.frames, np.full(len(object_ids), frame, np.int64)]),
+                np.concatenate([self.boxes, np.array(boxes, dtype=np.float64)]),
+            )
+
+    def remove(self, object_ids: List[int], frame: Optional[int] = None) -> None:
+        """Removes the figures of the objects from the index, only on the frame if it is passed."""
+        if len(object_ids) == 0:
+            return
+        with self._lock:
+            mask = np.isin(self.object_ids, np.array(object_ids, dtype=np.int64))
+            if frame is not None:
+                mask &= self.frames == frame
+            keep = ~mask
+            self._set(
+                self.object_ids[keep], self.class_ids[keep], self.frames[keep], self.boxes[keep]
+            )
+
+    def candidates(self, frame: int, window: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the figures to match with the frame: the nearest figure of each object
+        within the window. Objects that already have a figure on the frame are skipped.
+
+        :return: Object ids, class ids and boxes of the figures.
+        :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        with self._lock:
+            object_ids, class_ids, frames, boxes = (
+                self.object_ids,
+                self.class_ids,
+                self.frames,
+                self.boxes,
+            )
+        distance = np.abs(frames - frame)
+        occupied = np.unique(object_ids[distance == 0])
+        mask = (distance > 0) & (distance <= window) & ~np.isin(object_ids, occupied)
+        indexes = np.nonzero(mask)[0]
+        if len(indexes) > 0:
+            # Sorting by the distance and taking the first figure of each object.
+            indexes = indexes[np.argsort(distance[indexes], kind="stable")]
+            _, first = np.unique(object_ids[indexes], return_index=True)
+            indexes = indexes[first]
+        return object_ids[indexes], class_ids[indexes], boxes[indexes]
+
+    def __len__(self) -> int:
+        return len(self.object_ids)
+
+    def _set(
+        self, object_ids: np.ndarray, class_ids: np.ndarray, frames: np.ndarray, boxes: np.ndarray
+    ) -> None:
+        self.object_ids, self.class_ids, self.frames, self.boxes = (
+            object_ids,
+            class_ids,
+            frames,
+            boxes,
+        )
+
+
+class ObjectIndexCache:
+    """Thread-safe LRU cache of the object indexes of the videos. The index of a video is downloaded
+    once and then updated with the figures the app uploads and removes, so that a click doesn't list
+    all figures of the video. The index is downloaded again after `ttl` seconds to pick up the figures
+    changed by the annotators, or after it was invalidated.
+
+    :param max_entries: Maximum number of cached video indexes.
+    :type max_entries: int
+    :param ttl: Time in seconds during which the index is used without downloading it again.
+    :type ttl: float
+    """
+
+    def __init__(self, max_entries: int = 16, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[ObjectIndex, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, api: sly.Api, video_id: int, dataset_id: int) -> ObjectIndex:
+        """Returns the index of the video, downloading it if it isn't cached or is outdated.
+
+        :param api: Supervisely API.
+        :type api: sly.Api
+        :param video_id: Video id.
+        :type video_id: int
+        :param dataset_id: Dataset id of the video.
+        :type dataset_id: int
+        :return: Index of the video figures.
+        :rtype: ObjectIndex
+        """
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(video_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        index = ObjectIndex.load(api, video_id, dataset_id)
+        with self._lock:
+            self._entries[video_id] = (index, time.monotonic())
+            self._entries.move_to_end(video_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
+
+    def invalidate(self, video_id: int) -> None:
+        """Removes the index of the video from the cache."""
+        with self._lock:
+            self._entries.pop(video_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "figures": sum(len(index) for index, _ in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+
+def associate(
+    labels: List[sly.Label],
+    class_ids: List[int],
+    index: ObjectIndex,
+    frame: int,
+    window: int,
+    iou_threshold: float,
+) -> List[Optional[int]]:
+    """Matches the labels with the objects on the nearby frames by IoU of bounding boxes
+    separately for each class.
+
+    :param labels: Labels of the frame.
+    :type labels: List[sly.Label]
+    :param class_ids: Project class ids of the labels.
+    :type class_ids: List[int]
+    :param index: Index of the video figures.
+    :type index: ObjectIndex
+    :param frame: Index of the frame.
+    :type frame: int
+    :param window: Maximum distance in frames to the matched figure.
+    :type window: int
+    :param iou_threshold: Minimum IoU of the matched boxes.
+    :type iou_threshold: float
+    :return: Id of the matched object for each label or None if the label is not matched.
+    :rtype: List[Optional[int]]
+    """
+    object_ids = [None] * len(labels)
+    candidate_objects, candidate_classes, candidate_boxes = index.candidates(frame, window)
+    if len(labels) == 0 or len(candidate_objects) == 0:
+        return object_ids
+
+    label_boxes = np.array([label_box(label) for label in labels], dtype=np.float64)
+    label_classes = np.array(class_ids, dtype=np.int64)
+    for class_id in np.intersect1d(label_classes, candidate_classes):
+        rows = np.nonzero(label_classes == class_id)[0]
+        cols = np.nonzero(candidate_classes == class_id)[0]
+        iou = boxes_iou(label_boxes[rows], candidate_boxes[cols])
+        for row, col in match_boxes(iou, iou_threshold):
+            object_ids[rows[row]] = int(candidate_objects[cols[col]])
+    matched = sum(object_id is not None for object_id in object_ids)
+    sly.logger.debug(f"Frame {frame}: {matched} of {len(labels)} labels matched existing objects.")
+    return object_ids
@@ -0,0 +1,278 @@
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import requests
+import supervisely as sly
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+from urllib3.exceptions import NewConnectionError
+
+from src.metrics import Metrics
+
+# Responses with these statuses are retried for the idempotent calls.
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# With these statuses the request was rejected before it was processed, any call is retried.
+REJECTED_STATUS_CODES = {429, 503}
+# Read-only endpoints of the public API (all of them are POST requests) can be repeated safely.
+READ_ENDPOINT_PATTERN = re.compile(r"(^|\.)(info|list|meta|me|exists|[\w-]*download[\w-]*)$")
+# Endpoints that replace the state with the value from the request, a repeat changes nothing.
+IDEMPOTENT_ENDPOINTS = {"projects.meta.update"}
+# Endpoints of the serving app that don't change its state. Async inference requests
+# start a job in the serving app and are not repeated.
+MODEL_READ_ENDPOINTS = {
+    "get_session_info",
+    "get_output_classes_and_tags",
+    "get_custom_inference_settings",
+    "get_inference_progress",
+    "inference_image_id",
+    "inference_image_url",
+    "inference_batch_ids",
+    "inference_video_id",
+}
+
+
+@dataclass(frozen=True)
+class TransportSettings:
+    """HTTP transport of the API clients.
+
+    :param pool_size: Number of keep-alive connections kept open to the instance.
+    :type pool_size: int
+    :param max_concurrency: Maximum number of requests in flight, the other requests wait.
+    :type max_concurrency: int
+    :param retries: Number of retries of a failed idempotent request.
+    :type retries: int
+    :param backoff: Base delay of the exponential backoff in seconds.
+    :type backoff: float
+    :param max_backoff: Maximum delay between the retries in seconds.
+    :type max_backoff: float
+    """
+
+    pool_size: int = 16
+    max_concurrency: int = 8
+    retries: int = 4
+    backoff: float = 0.5
+    max_backoff: float = 10.0
+
+
+class Transport:
+    """Connection pool shared by the API clients. Limits the number of concurrent requests,
+    retries failed requests with exponential backoff and full jitter,
+    and records the latency of each endpoint.
+
+    :param settings: Transport settings.
+    :type settings: TransportSettings
+    :param metrics: Metrics to record the latencies to, the `api:<endpoint>` stages.
+    :type metrics: Metrics, optional
+    """
+
+    def __init__(self, settings: TransportSettings = TransportSettings(), metrics: Metrics = None):
+        self.settings = settings
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=settings.pool_size, pool_maxsize=settings.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._semaphore = threading.BoundedSemaphore(settings.max_concurrency)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_idempotent(http_method: str, endpoint: str) -> bool:
+        """Checks that the request can be repeated without side effects."""
+        return (
+            http_method == "GET"
+            or READ_ENDPOINT_PATTERN.search(endpoint) is not None
+            or endpoint in IDEMPOTENT_ENDPOINTS
+            or endpoint in MODEL_READ_ENDPOINTS
+        )
+
+    def request(
+        self,
+        http_method: str,
+        url: str,
+        endpoint: str,
+        retries: Optional[int] = None,
+        **kwargs,
+    ) -> requests.Response:
+        """Sends the request through the pool with retries. Idempotent requests are retried
+        on connection errors and transient server errors. Other requests are retried only
+        if they didn't reach the server: the connection wasn't established or the request
+        was rejected with 429 or 503. Multipart bodies and files are streamed and are never repeated.
+
+        :param http_method: HTTP method.
+        :type http_method: str
+        :param url: Request URL.
+        :type url: str
+        :param endpoint: API method name, used for the metrics and the retry policy.
+        :type endpoint: str
+        :param retries: Maximum number of attempts requested by the caller.
+        :type retries: int, optional
+        :return: The last response, the status is not checked.
+        :rtype: requests.Response
+        :raises requests.RequestException: If the request has failed without a response.
+        """
+        idempotent = self.is_idempotent(http_method, endpoint)
+        retry_statuses = RETRY_STATUS_CODES if idempotent else REJECTED_STATUS_CODES
+        attempts = self.settings.retries + 1
+        if retries is not None:
+            attempts = max(1, min(attempts, retries))
+        if "files" in kwargs or isinstance(
+            kwargs.get("data"), (MultipartEncoder, MultipartEncoderMonitor)
+        ):
+            attempts = 1
+
+        for attempt in range(attempts):
+            response, error = None, None
+            start = time.perf_counter()
+            try:
+                with self._semaphore:
+                    with self._lock:
+                        self._in_flight += 1
+                    try:
+                        response = self.session.request(http_method, url, **kwargs)
+                    finally:
+                        with self._lock:
+                            self._in_flight -= 1
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                # A write that may have reached the server is not repeated.
+                if not idempotent and not _is_not_sent(e):
+                    raise
+                error = e
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe(f"api:{endpoint}", time.perf_counter() - start)
+            if response is not None and response.status_code not in retry_statuses:
+                return response
+            if attempt == attempts - 1:
+                break
+            # Full jitter spreads the retries of the parallel requests after a common failure.
+            delay = random.uniform(
+                0, min(self.settings.max_backoff, self.settings.backoff * 2**attempt)
+            )
+            reason = repr(error) if error is not None else f"status {response.status_code}"
+            sly.logger.warning(
+                f"Request {endpoint} failed ({reason}), retrying in {delay:.2f} s "
+                f"({attempt + 1}/{attempts - 1})."
+            )
+            if self.metrics is not None:
+                self.metrics.inc("api_retries")
+            time.sleep(delay)
+        if response is not None:
+            return response
+        raise error
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {"in_flight": self._in_flight, "max_concurrency": self.settings.max_concurrency}
+
+
+def _is_not_sent(error: requests.RequestException) -> bool:
+    """Checks that the request failed before it was sent to the server."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if len(error.args) > 0 else None
+    return isinstance(reason, NewConnectionError)
+
+
+class PooledApi(sly.Api):
+    """Supervisely API client that sends the requests through the shared `Transport`
+    instead of opening a new connection for each request.
+    The status of the response is checked the same way as in `sly.Api`.
+    """
+
+    transport: Transport = None
+
+    def post(
+        self,
+        method: str,
+        data: Dict,
+        retries: Optional[int] = None,
+        stream: Optional[bool] = False,
+        raise_error: Optional[bool] = False,
+    ) -> requests.Response:
+        self._check_https_redirect()
+        url = self.api_server_address + "/v3/" + method
+        headers = self.headers
+        if isinstance(data, (MultipartEncoder, MultipartEncoderMonitor)):
+            headers = {**self.headers, "Content-Type": data.content_type}
+            body = {"data": data}
+        elif type(data) is bytes:
+            body = {"data": data}
+        else:
+            body = {"json": {**data, **self.additional_fields} if type(data) is dict else data}
+        if raise_error:
+            retries = 1
+        response = self.transport.request(
+            "POST", url, method, retries=retries, headers=headers, stream=stream, **body
+        )
+        if response.status_code != requests.codes.ok:  # pylint: disable=no-member
+            sly.Api._raise_for_status(response)
+        return response
+
+    def get(
+        self,
+        method: str,
+        params: Dict,
+        retries: Optional[int] = None,
+        stream: Optional[bool] = False,
+        use_public_api: Optional[bool] = True,
+    ) -> requests.Response:
+        self._check_https_redirect()
+        url = self.api_server_address + "/v3/" + method
+        if use_public_api is False:
+            url = f"{self.server_address.rstrip('/')}/{method}"
+        if type(params) is dict:
+            params = {**params, **self.additional_fields}
+        response = self.transport.request(
+            "GET", url, method, retries=retries, params=params, headers=self.headers, stream=stream
+        )
+        if response.status_code != requests.codes.ok:  # pylint: disable=no-member
+            sly.Api._raise_for_status(response)
+        return response
+
+
+class PooledSession(sly.nn.inference.Session):
+    """Model session that sends the requests to the serving app (`/net/<session token>`)
+    through the `Transport` of its `PooledApi` client, like the API requests.
+    The SDK session posts them with `requests.post`, a new connection for each request.
+    """
+
+    def _post(self, url: str, retries: int = 5, **kwargs) -> requests.Response:
+        transport = getattr(self.api, "transport", None)
+        if transport is None:
+            return super()._post(url, retries=retries, **kwargs)
+        endpoint = url[len(self._base_url) :].strip("/")
+        response = transport.request("POST", url, endpoint, retries=retries, **kwargs)
+        if response.status_code != requests.codes.ok:  # pylint: disable=no-member
+            sly.Api._raise_for_status(response)
+        return response
+
+
+def create_api(
+    transport: Transport, server_address: Optional[str] = None, token: Optional[str] = None
+) -> PooledApi:
+    """Creates the API client using the transport, from the environment if the address is not passed.
+
+    :param transport: Shared transport.
+    :type transport: Transport
+    :param server_address: Address of the instance.
+    :type server_address: str, optional
+    :param token: API token.
+    :type token: str, optional
+    :return: API client.
+    :rtype: PooledApi
+    """
+    if server_address is None:
+        api = PooledApi.from_env()
+    else:
+        api = PooledApi(server_address=server_address, token=token)
+    api.transport = transport
+    return api
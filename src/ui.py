@@ -1,9 +1,21 @@
+from typing import Optional
+
 import supervisely as sly
 import yaml
 from supervisely.app import widgets as w
 
 import src.functions as f
 import src.globals as g
+from src.ensemble import FusionSettings, combine_model_metas
+from src.filtering import FilterSettings, parse_class_confidence
+from src.geometry import GeometrySettings
+from src.jobs import Job, JobCancelled
+from src.prelabel import label_videos
+from src.sampling import SamplingSettings
+from src.state import AnnotatorState, ApplyContext
+from src.store import model_fingerprint
+from src.tiling import TilingSettings, parse_roi
+from src.upload import get_video_info
 
 # ACTIONS
 select_session = w.SelectAppSession(g.team_id, ["deployed_nn"], size="small")
@@ -58,16 +70,258 @@ suffix_field = w.Field(
     title="Classes/Tags suffix",
     description="Add suffix to model class/tag name if it has conflicts with existing one",
 )
+range_checkbox = w.Checkbox("Apply model to the range of frames starting from the current one")
+range_frames_count = w.InputNumber(10, min=1, step=1)
+range_direction = w.SelectString(["forward", "backward"], labels=["Forward", "Backward"])
+range_stride = w.InputNumber(1, min=1, step=1)
+range_settings = w.Container(
+    [
+        w.Field(range_frames_count, title="Number of frames"),
+        w.Field(range_direction, title="Direction"),
+        w.Field(range_stride, title="Step between frames"),
+    ],
+    direction="horizontal",
+)
+range_settings.hide()
+range_field = w.Field(
+    content=w.Container([range_checkbox, range_settings]),
+    title="Frames range",
+    description="Label several frames with one click, each frame is uploaded as soon as it is inferred",
+)
+prefetch_checkbox = w.Checkbox("Prefetch predictions for neighbouring frames")
+prefetch_frames_count = w.InputNumber(3, min=1, max=30, step=1)
+prefetch_frames_count.hide()
+prefetch_field = w.Field(
+    content=w.Container([prefetch_checkbox, prefetch_frames_count]),
+    title="Prefetching",
+    description=(
+        "Infer the next and previous frames in the background while you review the current one, "
+        "so that only the upload remains when you apply the model"
+    ),
+)
+associate_checkbox = w.Checkbox("Extend existing objects on nearby frames")
+associate_window = w.InputNumber(5, min=1, max=100, step=1)
+associate_iou = w.InputNumber(0.5, min=0.05, max=1, step=0.05, precision=2)
+associate_settings = w.Container(
+    [
+        w.Field(associate_window, title="Max distance in frames"),
+        w.Field(associate_iou, title="Min IoU"),
+    ],
+    direction="horizontal",
+)
+associate_settings.hide()
+associate_field = w.Field(
+    content=w.Container([associate_checkbox, associate_settings]),
+    title="Objects association",
+    description=(
+        "Add predictions as new figures of the objects of the same class on nearby frames "
+        "if their boxes overlap, instead of creating new objects"
+    ),
+)
+replace_previous_checkbox = w.Checkbox("Replace previous predictions of the models on the frame")
+replace_previous_field = w.Field(
+    content=replace_previous_checkbox,
+    title="Re-applying",
+    description=(
+        "When the same models are applied to a frame again, keep the unchanged figures, "
+        "move the shifted ones and remove the vanished ones instead of adding duplicates. "
+        "Only figures created by this app session are replaced"
+    ),
+)
+extra_models_input = w.Input(placeholder="Task ids of deployed models, e.g. 1234, 1240")
+connect_extra_models_button = w.Button("Connect", icon="zmdi zmdi-plus", button_size="small")
+extra_models_status = w.Text(status="info")
+extra_models_status.hide()
+fusion_method = w.SelectString(
+    ["none", "dedup", "wbf"],
+    labels=["Keep all predictions", "Remove duplicates", "Weighted fusion"],
+)
+fusion_iou = w.InputNumber(0.55, min=0.05, max=1, step=0.05, precision=2)
+extra_models_field = w.Field(
+    content=w.Container(
+        [
+            w.Flexbox([extra_models_input, connect_extra_models_button]),
+            extra_models_status,
+            w.Container(
+                [
+                    w.Field(fusion_method, title="Overlapping predictions"),
+                    w.Field(fusion_iou, title="Min IoU"),
+                ],
+                direction="horizontal",
+            ),
+        ]
+    ),
+    title="Additional models",
+    description=(
+        "Query other deployed models for the same frames in parallel and upload their predictions "
+        "together. Overlapping predictions of the same class can be deduplicated or fused"
+    ),
+)
+filter_confidence = w.InputNumber(0, min=0, max=1, step=0.05, precision=2)
+filter_top_k = w.InputNumber(0, min=0, step=1)
+filter_min_area = w.InputNumber(0, min=0, step=10)
+filter_max_area = w.InputNumber(0, min=0, step=100)
+filter_class_confidence = w.TextArea(placeholder="person: 0.6\ncar: 0.4", rows=2)
+nms_checkbox = w.Checkbox("Class-wise NMS")
+nms_iou = w.InputNumber(0.5, min=0.05, max=1, step=0.05, precision=2)
+filters_field = w.Field(
+    content=w.Container(
+        [
+            w.Container(
+                [
+                    w.Field(filter_confidence, title="Min confidence"),
+                    w.Field(filter_top_k, title="Top-K per class"),
+                    w.Field(filter_min_area, title="Min box area, px"),
+                    w.Field(filter_max_area, title="Max box area, px"),
+                ],
+                direction="horizontal",
+            ),
+            w.Field(
+                filter_class_confidence,
+                title="Min confidence per class",
+                description="One class per line, overrides the min confidence",
+            ),
+            w.Container([nms_checkbox, w.Field(nms_iou, title="NMS IoU")]),
+        ]
+    ),
+    title="Predictions filtering",
+    description=(
+        "Remove low-confidence, too small or too large and overlapping predictions before "
+        "they are added to the video, 0 disables the limit"
+    ),
+)
+masks_to_polygons_checkbox = w.Checkbox("Convert masks to polygons")
+simplify_polygons_checkbox = w.Checkbox("Simplify polygons")
+geometry_tolerance = w.InputNumber(1, min=0, max=50, step=0.5, precision=1)
+geometry_min_area = w.InputNumber(0, min=0, step=10)
+geometry_settings = w.Container(
+    [
+        w.Field(geometry_tolerance, title="Tolerance, px"),
+        w.Field(geometry_min_area, title="Min area, px"),
+    ],
+    direction="horizontal",
+)
+geometry_field = w.Field(
+    content=w.Container(
+        [masks_to_polygons_checkbox, simplify_polygons_checkbox, geometry_settings]
+    ),
+    title="Geometry optimization",
+    description=(
+        "Reduce the upload size of segmentation predictions: remove objects and mask fragments "
+        "smaller than the min area, convert masks to polygons and simplify polygons with the tolerance"
+    ),
+)
+sampling_checkbox = w.Checkbox("Skip near-duplicate frames")
+sampling_copy_checkbox = w.Checkbox("Copy figures of the last keyframe to the skipped frames")
+sampling_threshold = w.InputNumber(0.02, min=0.001, max=1, step=0.005, precision=3)
+sampling_max_gap = w.InputNumber(30, min=1, step=5)
+sampling_settings = w.Container(
+    [
+        w.Container(
+            [
+                w.Field(sampling_threshold, title="Min change"),
+                w.Field(sampling_max_gap, title="Max distance between keyframes"),
+            ],
+            direction="horizontal",
+        ),
+        sampling_copy_checkbox,
+    ]
+)
+sampling_settings.hide()
+sampling_field = w.Field(
+    content=w.Container([sampling_checkbox, sampling_settings]),
+    title="Frame sampling",
+    description=(
+        "In the range and whole-video modes, run the model only on the keyframes: frames whose "
+        "downscaled image differs from the last keyframe by more than the min change (0..1)"
+    ),
+)
+tiling_checkbox = w.Checkbox("Infer frames tile by tile")
+tiling_tile_size = w.InputNumber(1024, min=128, max=8192, step=128)
+tiling_overlap = w.InputNumber(0.2, min=0, max=0.9, step=0.05, precision=2)
+tiling_merge_threshold = w.InputNumber(0.5, min=0.05, max=1, step=0.05, precision=2)
+tiling_roi = w.Input(placeholder="top, left, bottom, right; empty for the whole frame")
+tiling_settings = w.Container(
+    [
+        w.Container(
+            [
+                w.Field(tiling_tile_size, title="Tile size, px"),
+                w.Field(tiling_overlap, title="Overlap"),
+                w.Field(tiling_merge_threshold, title="Merge threshold"),
+            ],
+            direction="horizontal",
+        ),
+        w.Field(tiling_roi, title="Region of interest, px"),
+    ]
+)
+tiling_settings.hide()
+tiling_field = w.Field(
+    content=w.Container([tiling_checkbox, tiling_settings]),
+    title="Tiled inference",
+    description=(
+        "For high-resolution videos with small objects: the frame (or the region of interest) "
+        "is cut into overlapping tiles, the model is applied to the tiles and the duplicates "
+        "on the tile seams are merged. Prefetching is disabled in this mode"
+    ),
+)
 inference_settings = w.Editor(height_lines=30)
-settings_container = w.Container([suffix_field, inference_settings])
+settings_container = w.Container(
+    [
+        suffix_field,
+        range_field,
+        prefetch_field,
+        associate_field,
+        replace_previous_field,
+        extra_models_field,
+        filters_field,
+        geometry_field,
+        sampling_field,
+        tiling_field,
+        inference_settings,
+    ]
+)
+
+# PRE-LABELING
+prelabel_chunk_size = w.InputNumber(50, min=1, max=1000, step=10)
+prelabel_resume_checkbox = w.Checkbox("Resume from the last checkpoint", checked=True)
+label_video_button = w.Button(
+    "Label whole video", icon="zmdi zmdi-movie", button_size="small", button_type="success"
+)
+label_dataset_button = w.Button(
+    "Label all videos in dataset", icon="zmdi zmdi-collection-video", button_size="small"
+)
+cancel_prelabel_button = w.Button(
+    "Cancel", icon="zmdi zmdi-close", button_type="danger", button_size="small"
+)
+cancel_prelabel_button.hide()
+prelabel_status = w.Text(status="info")
+prelabel_status.hide()
+prelabel_container = w.Container(
+    [
+        w.Field(
+            prelabel_chunk_size,
+            title="Frames per chunk",
+            description=(
+                "Frames are inferred in chunks, the next chunk is inferred while the previous one "
+                "is uploaded. The progress is saved after each chunk"
+            ),
+        ),
+        prelabel_resume_checkbox,
+        w.Flexbox([label_video_button, label_dataset_button, cancel_prelabel_button]),
+        prelabel_status,
+    ]
+)
+# Whole-video labeling job, only one can run at a time because it loads the model completely.
+prelabel_job: Optional[Job] = None
 
 tabs = w.Tabs(
-    labels=["Info", "Classes", "Tags", "Inference"],
+    labels=["Info", "Classes", "Tags", "Inference", "Pre-labeling"],
     contents=[
         model_info,
         classes_info,
         tags_info,
         settings_container,
+        prelabel_container,
     ],
     type="card",
 )
@@ -76,6 +330,70 @@ tabs.hide()
 ui_content = w.Container([connect_field, error_container, tabs])
 
 
+@range_checkbox.value_changed
+def range_checkbox_changed(is_checked: bool):
+    """Shows or hides the frames range settings."""
+    if is_checked:
+        range_settings.show()
+    else:
+        range_settings.hide()
+
+
+@associate_checkbox.value_changed
+def associate_checkbox_changed(is_checked: bool):
+    """Shows or hides the objects association settings."""
+    if is_checked:
+        associate_settings.show()
+    else:
+        associate_settings.hide()
+
+
+@sampling_checkbox.value_changed
+def sampling_checkbox_changed(is_checked: bool):
+    """Shows or hides the frame sampling settings."""
+    if is_checked:
+        sampling_settings.show()
+    else:
+        sampling_settings.hide()
+
+
+@tiling_checkbox.value_changed
+def tiling_checkbox_changed(is_checked: bool):
+    """Shows or hides the tiled inference settings."""
+    if is_checked:
+        tiling_settings.show()
+    else:
+        tiling_settings.hide()
+    update_prefetcher()
+
+
+def update_prefetcher():
+    """Updates the number of prefetched frames from the UI state.
+    Whole-frame predictions are not prefetched in the tiled mode.
+    """
+    if prefetch_checkbox.is_checked() and not tiling_checkbox.is_checked():
+        g.prefetcher.frames_count = int(prefetch_frames_count.get_value())
+    else:
+        g.prefetcher.frames_count = 0
+
+
+@prefetch_checkbox.value_changed
+def prefetch_checkbox_changed(is_checked: bool):
+    """Enables or disables prefetching of the neighbouring frames."""
+    if is_checked:
+        prefetch_frames_count.show()
+    else:
+        prefetch_frames_count.hide()
+        g.prediction_cache.clear()
+    update_prefetcher()
+
+
+@prefetch_frames_count.value_changed
+def prefetch_frames_count_changed(value: int):
+    """Changes the number of prefetched frames in each direction."""
+    update_prefetcher()
+
+
 @connect_button.click
 def connect_button_clicked():
     """Connects to the selected model session and changes the UI state."""
@@ -94,8 +412,7 @@ def connect_button_clicked():
     error_button.text = "OPEN SERVING APP"
     error_button.link = app_url
     try:
-        g.session = sly.nn.inference.Session(g.api, task_id=g.model_session_id)
-        session_info = g.session.get_session_info()
+        g.session, session_info = g.session_manager.connect(g.api, g.model_session_id)
         g.task_type = session_info.get("task type")
     except Exception as e:
         error_text.text = (
@@ -118,18 +435,17 @@ def connect_button_clicked():
     model_info.set_model_info(g.model_session_id, session_info)
 
     # Get the model meta.
-    g.model_meta = g.session.get_model_meta()
+    g.model_metas[g.model_session_id] = g.session.get_model_meta()
+    update_model_meta()
 
     # Load the inference settings from the model.
     g.inference_settings = yaml.dump(g.session.get_default_inference_settings(), allow_unicode=True)
     inference_settings.set_text(g.inference_settings, language_mode="yaml")
 
     # Load the classes and tags from the model metadata.
-    g.selected_classes = f.load_classes(g.model_meta)
-    select_classes.set(g.selected_classes)
+    select_classes.set(f.load_classes(g.model_meta))
     select_classes.select_all()
-    g.selected_tags = f.load_tags(g.model_meta)
-    select_tags.set(g.selected_tags)
+    select_tags.set(f.load_tags(g.model_meta))
     select_tags.select_all()
 
     select_session.hide()
@@ -140,6 +456,60 @@ def connect_button_clicked():
     connect_button.loading = False
 
 
+def update_model_meta():
+    """Combines the metas of the main and the additional models."""
+    task_ids = [g.model_session_id, *g.extra_model_session_ids]
+    g.model_meta = combine_model_metas([g.model_metas[task_id] for task_id in task_ids])
+
+
+@connect_extra_models_button.click
+def connect_extra_models_button_clicked():
+    """Connects to the additional models and adds their classes and tags to the lists."""
+    error_container.hide()
+    error_button.hide()
+    try:
+        task_ids = [
+            int(task_id) for task_id in extra_models_input.get_value().replace(",", " ").split()
+        ]
+    except ValueError:
+        error_text.text = "Task ids of the additional models must be numbers."
+        error_container.show()
+        return
+    task_ids = [task_id for task_id in dict.fromkeys(task_ids) if task_id != g.model_session_id]
+
+    connect_extra_models_button.loading = True
+    try:
+        for task_id in task_ids:
+            session, _ = g.session_manager.connect(g.api, task_id)
+            g.model_metas[task_id] = session.get_model_meta()
+    except Exception as e:
+        sly.logger.warning(f"Couldn't connect to model session {task_id}", exc_info=True)
+        error_text.text = f"Couldn't connect to model session {task_id}. {repr(e)}"
+        error_container.show()
+        connect_extra_models_button.loading = False
+        return
+    for task_id in g.extra_model_session_ids:
+        if task_id not in task_ids:
+            g.session_manager.disconnect(task_id)
+            g.model_metas.pop(task_id, None)
+    g.extra_model_session_ids = task_ids
+    update_model_meta()
+    select_classes.set(f.load_classes(g.model_meta))
+    select_classes.select_all()
+    select_tags.set(f.load_tags(g.model_meta))
+    select_tags.select_all()
+    g.prediction_cache.clear()
+    if len(task_ids) > 0:
+        extra_models_status.text = (
+            f"Connected {len(task_ids)} additional model(s): "
+            f"{len(g.model_meta.obj_classes)} classes in total"
+        )
+        extra_models_status.show()
+    else:
+        extra_models_status.hide()
+    connect_extra_models_button.loading = False
+
+
 @disconnect_button.click
 def disconnect_button_click():
     """Changes the UI state when the model is changed."""
@@ -150,10 +520,18 @@ def disconnect_button_click():
     apply_button.hide()
 
     sly.logger.info(f"Disconnect from model session: {g.model_session_id}")
+    g.session_manager.disconnect(g.model_session_id)
+    for task_id in g.extra_model_session_ids:
+        g.session_manager.disconnect(task_id)
+    g.extra_model_session_ids = []
+    g.model_metas = {}
+    extra_models_input.set_value("")
+    extra_models_status.hide()
     g.model_session_id = None
     g.model_meta = None
     g.inference_settings = None
     g.session = None
+    g.prediction_cache.clear()
     disconnect_button.loading = False
     disconnect_button.hide()
     tabs.hide()
@@ -161,26 +539,51 @@ def disconnect_button_click():
     select_session.show()
 
 
-# @apply_button.click
-def apply_button_clicked():
-    """Applies the model to the selected image."""
+def get_apply_context(state: AnnotatorState) -> Optional[ApplyContext]:
+    """Checks the model session and collects the settings from the UI into the apply context.
+    Errors are shown in the UI.
+
+    :param state: State of the annotator who clicked the button.
+    :type state: AnnotatorState
+    :return: Apply context or None if the settings are invalid or the model is not available.
+    :rtype: Optional[ApplyContext]
+    """
+    with state.lock:
+        api = state.api or g.api
+        session_id = state.session_id
+        video_id = state.video_id
+        project_id = state.project_id
+        frame = state.frame
+        allowed_classes = state.allowed_classes if state.is_my_labeling_job else None
+        allowed_tags = state.allowed_tags if state.is_my_labeling_job else None
 
-    apply_button.loading = True
     error_button.hide()
     error_container.hide()
-    disconnect_button.disable()
     selected_classes = select_classes.get_selected_classes()
     selected_tags = select_tags.get_selected_tags()
     suffix = suffix_input.get_value()
     use_suffix = suffix_checkbox.is_checked()
+    try:
+        class_confidence = parse_class_confidence(filter_class_confidence.get_value())
+    except (ValueError, yaml.YAMLError) as e:
+        error_text.text = f"Invalid min confidence per class. {repr(e)}"
+        error_container.show()
+        return None
+    try:
+        roi = parse_roi(tiling_roi.get_value())
+    except ValueError as e:
+        error_text.text = f"Invalid region of interest. {repr(e)}"
+        error_container.show()
+        return None
 
     app_url = f"{g.api.server_address}/apps/sessions/{g.model_session_id}"
     error_button.text = "OPEN SERVING APP"
     error_button.link = app_url
 
     try:
-        new_session = sly.nn.inference.Session(g.api, task_id=g.model_session_id)
-        new_session_info = new_session.get_session_info()
+        with g.metrics.span("session_check", task_id=g.model_session_id):
+            model_session, new_session_info = g.session_manager.get(g.api, g.model_session_id)
+        g.session = model_session
         if g.task_type != new_session_info.get("task type"):
             error_text.text = "Model task type has been changed. Reconnecting..."
             error_container.show()
@@ -189,48 +592,242 @@ def apply_button_clicked():
             select_tags.select([tag.name for tag in selected_tags])
             suffix_input.set_value(suffix)
             suffix_checkbox.check() if use_suffix else suffix_checkbox.uncheck()
+            model_session, new_session_info = g.session_manager.get(g.api, g.model_session_id)
+
+        extra_sessions = []
+        for task_id in g.extra_model_session_ids:
+            with g.metrics.span("session_check", task_id=task_id):
+                extra_sessions.append(g.session_manager.get(g.api, task_id)[0])
 
-        if g.is_my_labeling_job:
-            checked_classes = [obj for obj in selected_classes if obj.name in g.allowed_classes]
-            checked_tags = [tag for tag in selected_tags if tag.name in g.allowed_tags]
+        if allowed_classes is not None:
+            checked_classes = [obj for obj in selected_classes if obj.name in allowed_classes]
+            checked_tags = [tag for tag in selected_tags if tag.name in allowed_tags]
             if len(checked_classes) != len(selected_classes):
                 selected_classes = checked_classes
                 select_classes.select([obj_class.name for obj_class in selected_classes])
             if len(checked_tags) != len(selected_tags):
                 selected_tags = checked_tags
                 select_tags.select([tag.name for tag in selected_tags])
-        g.selected_classes = selected_classes
-        g.selected_tags = selected_tags
-        g.suffix = suffix
-        g.use_suffix = use_suffix
 
+        g.session_manager.apply_settings(
+            model_session, inference_settings.get_value(), g.inference_settings
+        )
+        ctx = ApplyContext(
+            api=api,
+            session_id=session_id,
+            video_id=video_id,
+            project_id=project_id,
+            frame=frame,
+            model_session=model_session,
+            model_meta=g.model_meta,
+            model_key=model_fingerprint(new_session_info, g.model_metas[g.model_session_id]),
+            selected_classes=list(selected_classes),
+            selected_tags=list(selected_tags),
+            suffix=suffix,
+            use_suffix=use_suffix,
+            associate=associate_checkbox.is_checked(),
+            association_window=int(associate_window.get_value()),
+            association_iou=float(associate_iou.get_value()),
+            filters=FilterSettings(
+                confidence=float(filter_confidence.get_value()),
+                class_confidence=class_confidence,
+                min_area=int(filter_min_area.get_value()),
+                max_area=int(filter_max_area.get_value()),
+                top_k=int(filter_top_k.get_value()),
+                nms=nms_checkbox.is_checked(),
+                nms_iou=float(nms_iou.get_value()),
+            ),
+            geometry=GeometrySettings(
+                min_area=int(geometry_min_area.get_value()),
+                masks_to_polygons=masks_to_polygons_checkbox.is_checked(),
+                simplify_polygons=simplify_polygons_checkbox.is_checked(),
+                tolerance=float(geometry_tolerance.get_value()),
+            ),
+            sampling=SamplingSettings(
+                enabled=sampling_checkbox.is_checked(),
+                threshold=float(sampling_threshold.get_value()),
+                max_gap=int(sampling_max_gap.get_value()),
+                copy_figures=sampling_copy_checkbox.is_checked(),
+            ),
+            extra_sessions=extra_sessions,
+            fusion=FusionSettings(
+                method=fusion_method.get_value(), iou=float(fusion_iou.get_value())
+            ),
+            tiling=TilingSettings(
+                enabled=tiling_checkbox.is_checked(),
+                tile_size=int(tiling_tile_size.get_value()),
+                overlap=float(tiling_overlap.get_value()),
+                roi=roi,
+                merge_threshold=float(tiling_merge_threshold.get_value()),
+            ),
+            replace_previous=replace_previous_checkbox.is_checked(),
+        )
+    except Exception as e:
+        sly.logger.warning("Couldn't connect to the model", exc_info=True)
+        error_text.text = f"Couldn't connect to the model. Make sure that model is deployed and try again. {repr(e)}"
+        error_button.show()
+        error_container.show()
+        return None
+    return ctx
+
+
+# @apply_button.click
+def apply_button_clicked(state: AnnotatorState) -> Optional[Job]:
+    """Prepares the model and submits the inference of the selected frame to the job queue.
+
+    :param state: State of the annotator who clicked the button.
+    :type state: AnnotatorState
+    :return: Submitted job or None if the model is not available.
+    :rtype: Optional[Job]
+    """
+    apply_button.loading = True
+    ctx = get_apply_context(state)
+    if ctx is None:
+        apply_button.loading = False
+        return None
+
+    if range_checkbox.is_checked():
+        range_params = (
+            int(range_frames_count.get_value()),
+            range_direction.get_value(),
+            int(range_stride.get_value()),
+        )
+    else:
+        range_params = None
+
+    def _apply(job: Job):
+        """Runs the inference and the upload in the job queue worker."""
+        disconnect_button.disable()
+        g.spawn_api.vid_ann_tool.disable_job_controls(ctx.session_id)
         try:
-            inf_settings = yaml.safe_load(inference_settings.get_value())
-            print(f"Inference Settings: {inf_settings}")
-        except Exception as e:
-            inf_settings = yaml.safe_load(g.inference_settings)
-            sly.logger.warning(
-                f"Model Inference launched without additional settings. \n" f"Reason: {e}",
-                exc_info=True,
-            )
-        g.session.set_inference_settings(inf_settings)
-        g.spawn_api.vid_ann_tool.disable_job_controls(g.session_id)
-        try:
-            f.inference()
+            with g.metrics.span("apply_job", video_id=ctx.video_id):
+                if range_params is not None:
+                    f.inference_range(ctx, *range_params, job=job)
+                else:
+                    f.inference(ctx, job=job)
+            g.metrics.inc("jobs_done")
             print("Inference done.")
+            sly.logger.debug(f"Project meta cache: {g.project_meta_cache.stats()}")
+        except JobCancelled:
+            sly.logger.info(f"Job {job.id} was cancelled.")
+            g.metrics.inc("jobs_cancelled")
+            raise
         except Exception as e:
+            g.metrics.inc("jobs_failed")
+            g.session_manager.invalidate(ctx.model_session.task_id)
+            # The meta could be changed by someone else, so it will be downloaded again.
+            g.project_meta_cache.invalidate(ctx.project_id)
             sly.logger.warning("Model Inference failed", exc_info=True)
             error_text.text = (
                 f"Model Inference failed. Check the serving app logs for more details. {repr(e)}"
             )
             error_button.show()
             error_container.show()
-    except Exception as e:
-        sly.logger.warning("Couldn't connect to the model", exc_info=True)
-        error_text.text = f"Couldn't connect to the model. Make sure that model is deployed and try again. {repr(e)}"
-        error_button.show()
-        error_container.show()
-    finally:
+            raise
+        finally:
+            if not any(
+                not other.finished and other is not job and other.kind == "apply"
+                for other in g.job_queue.list()
+            ):
+                apply_button.loading = False
+                if prelabel_job is None or prelabel_job.finished:
+                    disconnect_button.enable()
+            g.spawn_api.vid_ann_tool.enable_job_controls(ctx.session_id)
+
+    # A double click or a retried request with the same settings doesn't create duplicate objects.
+    job = g.job_queue.submit(
+        ctx.video_id, _apply, idempotency_key=ctx.idempotency_key(range_params)
+    )
+    if job.finished:
         apply_button.loading = False
-        disconnect_button.enable()
-        g.spawn_api.vid_ann_tool.enable_job_controls(g.session_id)
+    return job
+
+
+def update_prelabel_status(job: Job):
+    """Shows the progress of the whole-video labeling."""
+    prelabel_status.text = (
+        f"{job.uploaded + job.skipped} / {job.total} frames, {job.fps:.1f} FPS"
+        + (f", {job.skipped} skipped" if job.skipped > 0 else "")
+    )
+
+
+# @label_video_button.click and @label_dataset_button.click
+def prelabel_clicked(state: AnnotatorState, whole_dataset: bool = False) -> Optional[Job]:
+    """Submits labeling of the whole video or all videos of its dataset to the job queue.
+
+    :param state: State of the annotator who clicked the button.
+    :type state: AnnotatorState
+    :param whole_dataset: Label all videos of the dataset instead of the current video.
+    :type whole_dataset: bool
+    :return: Submitted job or None if the model is not available.
+    :rtype: Optional[Job]
+    """
+    global prelabel_job
+
+    if prelabel_job is not None and not prelabel_job.finished:
+        error_text.text = (
+            "Videos are already being labeled, wait for the job to finish or cancel it."
+        )
+        error_container.show()
+        return None
+    ctx = get_apply_context(state)
+    if ctx is None:
+        return None
+
+    if whole_dataset:
+        dataset_id = get_video_info(ctx.api, ctx.video_id).dataset_id
+        video_ids = [video_info.id for video_info in ctx.api.video.get_list(dataset_id)]
+    else:
+        video_ids = [ctx.video_id]
+    chunk_size = int(prelabel_chunk_size.get_value())
+    resume = prelabel_resume_checkbox.is_checked()
+
+    def _prelabel(job: Job):
+        """Runs the labeling of the videos in the job queue worker."""
+        disconnect_button.disable()
+        label_video_button.disable()
+        label_dataset_button.disable()
+        cancel_prelabel_button.show()
+        try:
+            with g.metrics.span("prelabel_job", videos=len(video_ids)):
+                stats = label_videos(
+                    ctx, video_ids, chunk_size, job, resume, on_progress=update_prelabel_status
+                )
+            prelabel_status.text = (
+                f"Done: {job.uploaded} frames, {stats.figures} figures, {job.fps:.1f} FPS"
+            )
+        except JobCancelled:
+            prelabel_status.text = f"Cancelled after {job.uploaded} frames, the progress is saved."
+            raise
+        except Exception as e:
+            g.project_meta_cache.invalidate(ctx.project_id)
+            sly.logger.warning("Video labeling failed", exc_info=True)
+            prelabel_status.text = (
+                f"Failed after {job.uploaded} frames, the progress is saved. {repr(e)}"
+            )
+            raise
+        finally:
+            label_video_button.enable()
+            label_dataset_button.enable()
+            cancel_prelabel_button.hide()
+            if not any(
+                not other.finished and other.kind == "apply" for other in g.job_queue.list()
+            ):
+                disconnect_button.enable()
+
+    prelabel_status.text = f"Queued {len(video_ids)} video(s)"
+    prelabel_status.show()
+    # Jobs share the key, so that the model isn't loaded by several pre-labeling jobs at once.
+    prelabel_job = g.job_queue.submit(
+        None if whole_dataset else ctx.video_id,
+        _prelabel,
+        kind="dataset" if whole_dataset else "video",
+        key="prelabel",
+    )
+    return prelabel_job
+
+
+@cancel_prelabel_button.click
+def cancel_prelabel_button_clicked():
+    if prelabel_job is not None:
+        g.job_queue.cancel(prelabel_job.id)
@@ -0,0 +1,537 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import supervisely as sly
+from requests import HTTPError
+from supervisely.api.module_api import ApiField
+
+from src.geometry import geometries_to_json
+from src.registry import FigureDiff
+
+# Requests are split into chunks by the serialized payload size, not only by the number of items,
+# because a single bitmap mask of a 4K frame can weigh several megabytes.
+MAX_PAYLOAD_BYTES = 8 * 1024 * 1024
+MAX_BATCH_SIZE = 1000
+# The remove endpoints take fewer ids per request.
+REMOVE_BATCH_SIZE = 50
+# Statuses of the errors for figures and objects that don't exist anymore,
+# e.g. removed by the annotator after the app uploaded them.
+MISSING_ENTITY_STATUSES = (400, 404)
+# There is no bulk endpoint to edit figures, moved figures are updated with concurrent requests
+# through the pooled transport.
+UPDATE_WORKERS = 8
+_update_executor = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="update")
+
+# Older instances don't have the bulk endpoint for figure tags, in that case tags are added one by one.
+_bulk_figure_tags_supported = True
+
+# Video info is required to create video objects and to check frame ranges, we will store it
+# so that we do not have to request it on every click. The cache is limited to the recently used
+# videos, and the info is requested again after the TTL in case the video was replaced.
+VIDEO_INFO_CACHE_SIZE = 256
+VIDEO_INFO_TTL = 300
+_video_infos: "OrderedDict[int, Tuple[sly.api.video_api.VideoInfo, float]]" = OrderedDict()
+_video_infos_lock = threading.Lock()
+
+
+@dataclass
+class UploadStats:
+    """Statistics of the upload of a single frame annotation.
+    `object_ids` contains ids of the objects the uploaded figures belong to (in the order of labels).
+    """
+
+    api_calls: int = 0
+    objects: int = 0
+    figures: int = 0
+    tags: int = 0
+    payload_bytes: int = 0
+    # Size of the geometry JSONs in the payload.
+    geometry_bytes: int = 0
+    extended_objects: int = 0
+    kept: int = 0
+    updated: int = 0
+    removed: int = 0
+    object_ids: List[int] = field(default_factory=list, repr=False)
+    figure_ids: List[int] = field(default_factory=list, repr=False)
+    removed_object_ids: List[int] = field(default_factory=list, repr=False)
+
+    def update(self, other: "UploadStats") -> None:
+        """Adds the values of other statistics to this one."""
+        self.api_calls += other.api_calls
+        self.objects += other.objects
+        self.figures += other.figures
+        self.tags += other.tags
+        self.payload_bytes += other.payload_bytes
+        self.geometry_bytes += other.geometry_bytes
+        self.extended_objects += other.extended_objects
+        self.kept += other.kept
+        self.updated += other.updated
+        self.removed += other.removed
+
+    def __str__(self) -> str:
+        text = (
+            f"{self.objects} new objects, {self.extended_objects} extended objects, "
+            f"{self.figures} figures, {self.tags} tags, "
+            f"{self.payload_bytes} bytes in {self.api_calls} API calls"
+        )
+        if self.kept or self.updated or self.removed:
+            text += (
+                f" (previous figures: {self.kept} kept, {self.updated} updated, "
+                f"{self.removed} removed)"
+            )
+        return text
+
+
+def get_video_info(
+    api: sly.Api, video_id: int, stats: UploadStats = None
+) -> sly.api.video_api.VideoInfo:
+    """Returns the video info, the value is cached for each video for `VIDEO_INFO_TTL` seconds.
+
+    :param api: Supervisely API.
+    :type api: sly.Api
+    :param video_id: Video id.
+    :type video_id: int
+    :param stats: Upload statistics to count the API call in.
+    :type stats: UploadStats, optional
+    :return: Video info.
+    :rtype: sly.api.video_api.VideoInfo
+    """
+    with _video_infos_lock:
+        entry = _video_infos.get(video_id)
+        if entry is not None and time.monotonic() - entry[1] < VIDEO_INFO_TTL:
+            _video_infos.move_to_end(video_id)
+            return entry[0]
+    video_info = api.video.get_info_by_id(video_id)
+    if stats is not None:
+        stats.api_calls += 1
+    with _video_infos_lock:
+        _video_infos[video_id] = (video_info, time.monotonic())
+        _video_infos.move_to_end(video_id)
+        while len(_video_infos) > VIDEO_INFO_CACHE_SIZE:
+            _video_infos.popitem(last=False)
+    return video_info
+
+
+def chunk_by_size(items: List[Dict], sizes: List[int]) -> Iterator[List[Dict]]:
+    """Splits items into chunks limited by MAX_PAYLOAD_BYTES and MAX_BATCH_SIZE.
+    An item larger than the limit is sent in a separate chunk.
+
+    :param items: Items to split.
+    :type items: List[Dict]
+    :param sizes: Serialized size of each item in bytes.
+    :type sizes: List[int]
+    :return: Iterator over the chunks.
+    :rtype: Iterator[List[Dict]]
+    """
+    chunk, chunk_size = [], 0
+    for item, size in zip(items, sizes):
+        if chunk and (chunk_size + size > MAX_PAYLOAD_BYTES or len(chunk) >= MAX_BATCH_SIZE):
+            yield chunk
+            chunk, chunk_size = [], 0
+        chunk.append(item)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+
+def create_objects(
+    api: sly.Api,
+    video_id: int,
+    labels: List[sly.Label],
+    project_meta: sly.ProjectMeta,
+    stats: UploadStats,
+) -> List[int]:
+    """Creates a video object for each label in bulk requests.
+    Classes in the project meta must have ids (see `api.project.pull_meta_ids`).
+
+    :return: Ids of the created objects in the order of labels.
+    :rtype: List[int]
+    """
+    if len(labels) == 0:
+        return []
+    dataset_id = get_video_info(api, video_id, stats).dataset_id
+    items = []
+    for label in labels:
+        obj_class = project_meta.get_obj_class(label.obj_class.name)
+        items.append({ApiField.CLASS_ID: obj_class.sly_id, ApiField.ENTITY_ID: video_id})
+
+    ids = []
+    for batch in sly.batched(items, batch_size=MAX_BATCH_SIZE):
+        response = api.post(
+            "annotation-objects.bulk.add",
+            {ApiField.DATASET_ID: dataset_id, ApiField.ANNOTATION_OBJECTS: batch},
+        )
+        stats.api_calls += 1
+        ids.extend(obj[ApiField.ID] for obj in response.json())
+    stats.objects += len(ids)
+    return ids
+
+
+def create_figures(
+    api: sly.Api,
+    video_id: int,
+    frame_index: int,
+    labels: List[sly.Label],
+    object_ids: List[int],
+    stats: UploadStats,
+) -> List[int]:
+    """Creates a figure on the frame for each label in bulk requests chunked by payload size.
+
+    :return: Ids of the created figures in the order of labels.
+    :rtype: List[int]
+    """
+    figures, sizes = [], []
+    geometries = geometries_to_json([label.geometry for label in labels])
+    for label, obj_id, geometry in zip(labels, object_ids, geometries):
+        figure = {
+            ApiField.META: {ApiField.FRAME: frame_index},
+            ApiField.OBJECT_ID: obj_id,
+            ApiField.GEOMETRY_TYPE: label.geometry.geometry_name(),
+            ApiField.GEOMETRY: None,
+        }
+        # The geometry is serialized once, the size of the figure is the size without it
+        # ("null") plus the size of the geometry.
+        geometry_bytes = len(json.dumps(geometry))
+        sizes.append(len(json.dumps(figure)) - len("null") + geometry_bytes)
+        figure[ApiField.GEOMETRY] = geometry
+        figures.append(figure)
+        stats.geometry_bytes += geometry_bytes
+
+    ids = []
+    for chunk in chunk_by_size(figures, sizes):
+        response = api.post(
+            "figures.bulk.add", {ApiField.ENTITY_ID: video_id, ApiField.FIGURES: chunk}
+        )
+        stats.api_calls += 1
+        ids.extend(obj[ApiField.ID] for obj in response.json())
+    stats.figures += len(ids)
+    stats.payload_bytes += sum(sizes)
+    return ids
+
+
+def add_figure_tags(
+    api: sly.Api,
+    project_id: int,
+    labels: List[sly.Label],
+    figure_ids: List[int],
+    project_meta: sly.ProjectMeta,
+    stats: UploadStats,
+) -> None:
+    """Adds tags of the labels to the created figures in bulk requests.
+    Tag metas in the project meta must have ids (see `api.project.pull_meta_ids`).
+    """
+    global _bulk_figure_tags_supported
+
+    tags = []
+    for label, fig_id in zip(labels, figure_ids):
+        for tag in label.tags:
+            tag_meta = project_meta.get_tag_meta(tag.meta.name)
+            tag_json = {ApiField.TAG_ID: tag_meta.sly_id, ApiField.FIGURE_ID: fig_id}
+            if tag.value is not None:
+                tag_json[ApiField.VALUE] = tag.value
+            tags.append(tag_json)
+    if len(tags) == 0:
+        return
+
+    if _bulk_figure_tags_supported:
+        try:
+            for batch in sly.batched(tags, batch_size=MAX_BATCH_SIZE):
+                api.post(
+                    "figures.tags.bulk.add", {ApiField.PROJECT_ID: project_id, ApiField.TAGS: batch}
+                )
+                stats.api_calls += 1
+            stats.tags += len(tags)
+            return
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            stats.api_calls += 1
+            _bulk_figure_tags_supported = False
+            sly.logger.info(
+                "Bulk figure tags endpoint is not available, tags will be added one by one."
+            )
+
+    for tag_json in tags:
+        api.advanced.add_tag_to_object(
+            tag_json[ApiField.TAG_ID], tag_json[ApiField.FIGURE_ID], tag_json.get(ApiField.VALUE)
+        )
+        stats.api_calls += 1
+    stats.tags += len(tags)
+
+
+def upload_annotation(
+    api: sly.Api,
+    video_id: int,
+    project_id: int,
+    frame_index: int,
+    ann: sly.Annotation,
+    project_meta: sly.ProjectMeta,
+    object_ids: Optional[List[Optional[int]]] = None,
+) -> UploadStats:
+    """Uploads labels of the frame annotation as figures on the frame.
+    Labels matched with existing objects become their new figures, other labels become new objects.
+    The number of API calls doesn't depend on the number of labels (up to the chunk limits).
+
+    :param api: Supervisely API.
+    :type api: sly.Api
+    :param video_id: Video id.
+    :type video_id: int
+    :param project_id: Project id.
+    :type project_id: int
+    :param frame_index: Index of the frame to upload figures to.
+    :type frame_index: int
+    :param ann: Frame annotation.
+    :type ann: sly.Annotation
+    :param project_meta: Project meta with ids of classes and tags.
+    :type project_meta: sly.ProjectMeta
+    :param object_ids: Existing object id for each label or None to create a new object.
+    :type object_ids: List[Optional[int]], optional
+    :return: Upload statistics.
+    :rtype: UploadStats
+    """
+    stats = UploadStats()
+    labels = list(ann.labels)
+    if len(labels) == 0:
+        return stats
+    if object_ids is None:
+        object_ids = [None] * len(labels)
+    new_indexes = [i for i, object_id in enumerate(object_ids) if object_id is None]
+    new_ids = create_objects(api, video_id, [labels[i] for i in new_indexes], project_meta, stats)
+    object_ids = list(object_ids)
+    for i, object_id in zip(new_indexes, new_ids):
+        object_ids[i] = object_id
+    stats.extended_objects = len(labels) - len(new_indexes)
+    stats.object_ids = object_ids
+    figure_ids = create_figures(api, video_id, frame_index, labels, object_ids, stats)
+    stats.figure_ids = figure_ids
+    add_figure_tags(api, project_id, labels, figure_ids, project_meta, stats)
+    sly.logger.info(f"Frame {frame_index} uploaded: {stats}")
+    return stats
+
+
+def is_missing_entity_error(e: HTTPError) -> bool:
+    """Checks that the request has failed because the figure or object doesn't exist."""
+    return e.response is not None and e.response.status_code in MISSING_ENTITY_STATUSES
+
+
+def update_figures(
+    api: sly.Api, labels: List[sly.Label], figure_ids: List[int], stats: UploadStats
+) -> List[int]:
+    """Replaces the geometries of the figures with the geometries of the labels,
+    one request for each figure, `UPDATE_WORKERS` requests at a time.
+    Figures that don't exist anymore are skipped.
+
+    :return: Indexes of the figures that don't exist anymore.
+    :rtype: List[int]
+    """
+
+    def _update(payload: Dict) -> bool:
+        try:
+            api.post("figures.editInfo", payload)
+        except HTTPError as e:
+            if not is_missing_entity_error(e):
+                raise
+            return False
+        return True
+
+    geometries = geometries_to_json([label.geometry for label in labels])
+    futures = []
+    for figure_id, geometry in zip(figure_ids, geometries):
+        geometry_bytes = len(json.dumps(geometry))
+        futures.append(
+            _update_executor.submit(_update, {ApiField.ID: figure_id, ApiField.GEOMETRY: geometry})
+        )
+        stats.api_calls += 1
+        stats.payload_bytes += len(json.dumps({ApiField.ID: figure_id})) + geometry_bytes
+        stats.geometry_bytes += geometry_bytes
+    # All requests are awaited before an error is re-raised, so that they don't pile up.
+    for future in futures:
+        future.exception()
+    missing = [i for i, future in enumerate(futures) if not future.result()]
+    stats.updated += len(figure_ids) - len(missing)
+    return missing
+
+
+def remove_figures(api: sly.Api, figure_ids: List[int], stats: UploadStats) -> None:
+    """Removes the figures in bulk requests, figures that don't exist anymore are skipped."""
+    remove_entities(api, "figures.bulk.remove", figure_ids, stats, ApiField.FIGURE_IDS)
+
+
+def remove_objects(api: sly.Api, object_ids: List[int], stats: UploadStats) -> None:
+    """Removes the objects in bulk requests, objects that don't exist anymore are skipped."""
+    remove_entities(api, "annotation-objects.bulk.remove", object_ids, stats)
+
+
+def remove_entities(
+    api: sly.Api, method: str, ids: List[int], stats: UploadStats, field: Optional[str] = None
+) -> None:
+    """Removes the entities in bulk requests. If a batch fails because some of the entities
+    don't exist anymore, the entities of the batch are removed one by one and the missing ones are skipped.
+
+    :param api: Supervisely API.
+    :type api: sly.Api
+    :param method: Bulk remove API method.
+    :type method: str
+    :param ids: Ids of the entities.
+    :type ids: List[int]
+    :param stats: Upload statistics to count the requests in.
+    :type stats: UploadStats
+    :param field: Field of the ids in the payload, the ids are sent as a list if it isn't passed.
+    :type field: str, optional
+    """
+
+    def _post(batch: List[int]) -> bool:
+        stats.api_calls += 1
+        try:
+            api.post(method, {field: batch} if field is not None else batch)
+        except HTTPError as e:
+            if not is_missing_entity_error(e):
+                raise
+            return False
+        return True
+
+    for batch in sly.batched(ids, batch_size=REMOVE_BATCH_SIZE):
+        if _post(batch) or len(batch) == 1:
+            continue
+        for entity_id in batch:
+            _post([entity_id])
+
+
+def objects_with_figures(
+    api: sly.Api, video_id: int, object_ids: List[int], stats: UploadStats
+) -> Set[int]:
+    """Returns the objects that have figures in the video on the server, including the figures
+    created by the annotator or by tracking, that the app doesn't know about.
+    Only the figures of the objects are listed, without geometries.
+
+    :return: Ids of the objects with figures.
+    :rtype: Set[int]
+    """
+    if len(object_ids) == 0:
+        return set()
+    dataset_id = get_video_info(api, video_id, stats).dataset_id
+    result = set()
+    for batch in sly.batched(list(object_ids), batch_size=REMOVE_BATCH_SIZE):
+        data = {
+            ApiField.DATASET_ID: dataset_id,
+            ApiField.FIELDS: [ApiField.ID, ApiField.OBJECT_ID],
+            ApiField.FILTER: [
+                {ApiField.FIELD: ApiField.ENTITY_ID, "operator": "=", "value": video_id},
+                {ApiField.FIELD: ApiField.OBJECT_ID, "operator": "in", "value": batch},
+            ],
+        }
+        page, pages_count = 1, 1
+        while page <= pages_count:
+            response = api.post("figures.list", {**data, ApiField.PAGE: page}).json()
+            stats.api_calls += 1
+            result.update(figure[ApiField.OBJECT_ID] for figure in response["entities"])
+            pages_count = response["pagesCount"]
+            page += 1
+    return result
+
+
+def upload_diff(
+    api: sly.Api,
+    video_id: int,
+    project_id: int,
+    frame_index: int,
+    ann: sly.Annotation,
+    project_meta: sly.ProjectMeta,
+    diff: FigureDiff,
+    object_ids: Optional[List[Optional[int]]] = None,
+    remove_object_ids: Optional[List[int]] = None,
+) -> UploadStats:
+    """Uploads only the changes between the previously uploaded figures of the frame and
+    the new annotation. New figures are created before the old ones are removed, so a failed
+    upload can leave duplicates, but never loses figures.
+
+    :param api: Supervisely API.
+    :type api: sly.Api
+    :param video_id: Video id.
+    :type video_id: int
+    :param project_id: Project id.
+    :type project_id: int
+    :param frame_index: Index of the frame.
+    :type frame_index: int
+    :param ann: New frame annotation.
+    :type ann: sly.Annotation
+    :param project_meta: Project meta with ids of classes and tags.
+    :type project_meta: sly.ProjectMeta
+    :param diff: Diff of the previous figures and the labels of the annotation.
+    :type diff: FigureDiff
+    :param object_ids: Existing object id for each label or None to create a new object,
+        used for the added labels.
+    :type object_ids: List[Optional[int]], optional
+    :param remove_object_ids: Objects to remove after their figures are removed,
+        if they don't have other figures on the server.
+    :type remove_object_ids: List[int], optional
+    :return: Upload statistics, object and figure ids are in the order of the labels.
+    :rtype: UploadStats
+    """
+    labels = list(ann.labels)
+    result_object_ids = [None] * len(labels)
+    result_figure_ids = [None] * len(labels)
+    for i, figure in diff.keep + diff.update:
+        result_object_ids[i] = figure.object_id
+        result_figure_ids[i] = figure.figure_id
+
+    # Replaced figures are created again for the same objects.
+    new_indexes = diff.add + [i for i, _ in diff.replace]
+    new_object_ids = [object_ids[i] if object_ids is not None else None for i in diff.add]
+    new_object_ids += [figure.object_id for _, figure in diff.replace]
+    new_ann = ann.clone(labels=[labels[i] for i in new_indexes])
+    stats = upload_annotation(
+        api, video_id, project_id, frame_index, new_ann, project_meta, new_object_ids
+    )
+    for i, object_id, figure_id in zip(new_indexes, stats.object_ids, stats.figure_ids):
+        result_object_ids[i] = object_id
+        result_figure_ids[i] = figure_id
+
+    missing = update_figures(
+        api,
+        [labels[i] for i, _ in diff.update],
+        [figure.figure_id for _, figure in diff.update],
+        stats,
+    )
+    if len(missing) > 0:
+        # The figures were removed after they were uploaded, e.g. by the annotator.
+        # Their labels are uploaded again as new objects.
+        recreated_indexes = [diff.update[j][0] for j in missing]
+        sly.logger.warning(
+            f"{len(missing)} figures of frame {frame_index} don't exist anymore, "
+            "they will be uploaded again."
+        )
+        recreated_ann = ann.clone(labels=[labels[i] for i in recreated_indexes])
+        recreated_stats = upload_annotation(
+            api, video_id, project_id, frame_index, recreated_ann, project_meta
+        )
+        for i, object_id, figure_id in zip(
+            recreated_indexes, recreated_stats.object_ids, recreated_stats.figure_ids
+        ):
+            result_object_ids[i] = object_id
+            result_figure_ids[i] = figure_id
+        stats.update(recreated_stats)
+
+    removed_figure_ids = [figure.figure_id for figure in diff.remove]
+    removed_figure_ids += [figure.figure_id for _, figure in diff.replace]
+    remove_figures(api, removed_figure_ids, stats)
+    # The app doesn't know about the figures added by the annotator or by tracking,
+    # so only the objects without figures on the server are removed.
+    remove_object_ids = remove_object_ids or []
+    keep_object_ids = objects_with_figures(api, video_id, remove_object_ids, stats)
+    removed_object_ids = [
+        object_id for object_id in remove_object_ids if object_id not in keep_object_ids
+    ]
+    remove_objects(api, removed_object_ids, stats)
+    stats.removed = len(diff.remove)
+    stats.kept = len(diff.keep)
+    stats.object_ids = result_object_ids
+    stats.figure_ids = result_figure_ids
+    stats.removed_object_ids = removed_object_ids
+    sly.logger.info(f"Frame {frame_index} updated: {diff}, {stats}")
+    return stats